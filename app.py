@@ -6,15 +6,41 @@ Super-Democracy - 班委投票系统
 
 import os
 import sqlite3
+import atexit
+import base64
+import csv
+import hashlib
+import heapq
 import json
+import multiprocessing
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from functools import wraps
-from io import BytesIO
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
+from functools import partial, wraps
+from io import StringIO
+from itertools import islice
+from urllib.parse import quote
+from flask import (Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file,
+                   g, has_app_context, has_request_context, make_response, Request, Response, stream_with_context,
+                   before_render_template, template_rendered)
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 import openpyxl
 import openpyxl.styles
+import openpyxl.utils
+from openpyxl.cell import WriteOnlyCell
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # 初始化 Flask 应用
 app = Flask(__name__)
@@ -23,9 +49,70 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['UPLOAD_SPOOL_MAX_SIZE'] = int(os.environ.get('UPLOAD_SPOOL_MAX_SIZE', 4 * 1024 * 1024))  # 超过则写入临时文件
+
+# 数据库配置
+app.config['DATABASE'] = os.environ.get('DATABASE', 'database.db')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 8))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 10))  # 秒
+app.config['DB_BUSY_TIMEOUT'] = int(os.environ.get('DB_BUSY_TIMEOUT', 5000))  # 毫秒
+app.config['DB_CACHE_SIZE_KB'] = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+app.config['DB_MMAP_SIZE'] = int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024))
+app.config['DB_MIGRATION_BATCH_SIZE'] = int(os.environ.get('DB_MIGRATION_BATCH_SIZE', 5000))  # 迁移回填每批行数
+
+# 分库配置（默认不分库）。DB_SHARD_BY 为 class 时每个班级一个库；也可以是正则表达式，
+# 按第一个分组（没有分组时按整个匹配）把班级归入同一个库，如 ^(\d{4})级 按年级分库，匹配不到的班级归入 default
+app.config['DB_SHARD_BY'] = os.environ.get('DB_SHARD_BY', '')
+app.config['DB_SHARD_DIR'] = os.environ.get('DB_SHARD_DIR', '')  # 分库文件目录，默认为 <DATABASE 去掉扩展名>_shards
+app.config['DB_SHARD_FANOUT_WORKERS'] = int(os.environ.get('DB_SHARD_FANOUT_WORKERS', 8))  # 跨库查询的并发数
+
+# 报表快照：统计页面和导出读取定期复制的只读快照，快照最多落后 REPORT_SNAPSHOT_MAX_AGE 秒（0 表示直接读取实时数据）
+app.config['REPORT_SNAPSHOT_MAX_AGE'] = float(os.environ.get('REPORT_SNAPSHOT_MAX_AGE', 0))
+app.config['REPORT_SNAPSHOT_DIR'] = os.environ.get('REPORT_SNAPSHOT_DIR', '')  # 默认为 <DATABASE 去掉扩展名>_snapshots
+
+# 管理列表每页条数
+app.config['ADMIN_PAGE_SIZE'] = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+
+# 查询结果缓存配置
+app.config['QUERY_CACHE_SIZE'] = int(os.environ.get('QUERY_CACHE_SIZE', 256))
+app.config['QUERY_CACHE_TTL'] = float(os.environ.get('QUERY_CACHE_TTL', 60))  # 秒
+
+# 慢查询日志阈值（毫秒），0 表示不记录
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+
+# 批量导入配置
+app.config['IMPORT_HASH_WORKERS'] = int(os.environ.get('IMPORT_HASH_WORKERS', os.cpu_count() or 1))
+app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+
+# 后台任务配置
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_RESULT_FOLDER'] = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], 'jobs')
+app.config['JOB_RESULT_TTL'] = int(os.environ.get('JOB_RESULT_TTL', 24 * 3600))  # 秒
+
+# 登录密码校验配置
+app.config['LOGIN_VERIFY_CONCURRENCY'] = int(os.environ.get('LOGIN_VERIFY_CONCURRENCY', os.cpu_count() or 1))
+app.config['LOGIN_VERIFY_MAX_QUEUE'] = int(os.environ.get('LOGIN_VERIFY_MAX_QUEUE', 64))
+app.config['LOGIN_VERIFY_QUEUE_TIMEOUT'] = float(os.environ.get('LOGIN_VERIFY_QUEUE_TIMEOUT', 3))  # 秒
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD')  # 如 pbkdf2:sha256:260000，未设置时使用 werkzeug 的默认方法
+app.config['LOGIN_REHASH'] = os.environ.get('LOGIN_REHASH', '0') == '1'  # 登录成功时按上述方法重新计算哈希
+
+# 投票写入队列配置（默认关闭，投票直接写库）
+app.config['VOTE_QUEUE_ENABLED'] = os.environ.get('VOTE_QUEUE_ENABLED', '0') == '1'
+app.config['VOTE_QUEUE_ACK'] = os.environ.get('VOTE_QUEUE_ACK', 'flushed')  # queued: 入队即返回；flushed: 提交后返回
+app.config['VOTE_QUEUE_MAX_PENDING'] = int(os.environ.get('VOTE_QUEUE_MAX_PENDING', 10000))
+app.config['VOTE_QUEUE_PUT_TIMEOUT'] = float(os.environ.get('VOTE_QUEUE_PUT_TIMEOUT', 2))  # 秒
+app.config['VOTE_QUEUE_BATCH_SIZE'] = int(os.environ.get('VOTE_QUEUE_BATCH_SIZE', 500))
+app.config['VOTE_QUEUE_FLUSH_INTERVAL'] = float(os.environ.get('VOTE_QUEUE_FLUSH_INTERVAL', 0.05))  # 秒
+app.config['VOTE_QUEUE_FLUSH_TIMEOUT'] = float(os.environ.get('VOTE_QUEUE_FLUSH_TIMEOUT', 10))  # 秒
+
+# 统计页面实时推送（SSE）配置
+app.config['STATS_STREAM_INTERVAL'] = float(os.environ.get('STATS_STREAM_INTERVAL', 1.0))  # 合并推送间隔（秒）
+app.config['STATS_STREAM_MAX_SUBSCRIBERS'] = int(os.environ.get('STATS_STREAM_MAX_SUBSCRIBERS', 50))
+app.config['STATS_STREAM_RESYNC'] = float(os.environ.get('STATS_STREAM_RESYNC', 10))  # 全量对比的最短间隔（秒）
 
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['JOB_RESULT_FOLDER'], exist_ok=True)
 
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
@@ -34,16 +121,490 @@ def allowed_file(filename):
     """检查文件扩展名是否允许"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# 数据库连接函数
-def get_db():
-    """创建数据库连接"""
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+def spooled_upload_buffer():
+    """上传缓冲区：小文件留在内存中，超过阈值才写入匿名临时文件（文件名唯一、关闭即删除）"""
+    return tempfile.SpooledTemporaryFile(max_size=app.config['UPLOAD_SPOOL_MAX_SIZE'], mode='w+b')
 
-def init_db():
-    """初始化数据库"""
-    conn = get_db()
+class SpooledUploadRequest(Request):
+    """上传文件直接解析到 spooled 缓冲区，而不是先保存到 uploads 目录"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return spooled_upload_buffer()
+
+app.request_class = SpooledUploadRequest
+
+def open_upload_workbook(stream):
+    """以只读模式从上传缓冲区打开 Excel，按行流式读取"""
+    stream.seek(0)
+    return openpyxl.load_workbook(stream, read_only=True)
+
+# 数据库连接池
+class PoolTimeout(Exception):
+    """等待空闲数据库连接超时"""
+
+
+class PooledConnection(sqlite3.Connection):
+    """连接池中的连接，close() 时归还连接池而不是真正关闭"""
+
+    def close(self):
+        pool = getattr(self, 'pool', None)
+        if pool is None:
+            super().close()
+        else:
+            # 提前归还时同时解除与当前请求的绑定，否则请求结束时会把已被其他线程取走的连接再归还一次
+            if has_app_context():
+                conns = g.get('_dbs')
+                if conns and conns.get(pool.database) is self:
+                    del conns[pool.database]
+            pool.release(self)
+
+    def discard(self):
+        """真正关闭底层连接"""
+        self.pool = None
+        super().close()
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool:
+    """有界 SQLite 连接池
+
+    每个连接只在创建时设置一次 WAL、synchronous 等 PRAGMA，之后在请求之间复用；
+    同时记录等待空闲连接的时间，便于调整连接池大小。
+    """
+
+    def __init__(self, database, size=8, timeout=10.0, busy_timeout=5000,
+                 cache_size_kb=16384, mmap_size=64 * 1024 * 1024):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquire_count = 0
+        self._timeout_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def connect(self):
+        """创建一个设置好 PRAGMA 的独立连接（不受连接池管理，需自行 discard）"""
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout / 1000,
+                               check_same_thread=False, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _connect(self):
+        conn = self.connect()
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        """取出一个空闲连接，连接数已满时等待，超时抛出 PoolTimeout"""
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeout_count += 1
+                    raise PoolTimeout(f'等待数据库连接超时（{self.timeout} 秒）')
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._acquire_count += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        conn.row_factory = sqlite3.Row
+        conn.in_pool = False
+        return conn
+
+    def release(self, conn):
+        """归还连接，未提交的事务会被回滚"""
+        if getattr(conn, 'in_pool', True):
+            return
+        conn.in_pool = True
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            with self._lock:
+                self._created -= 1
+            conn.discard()
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            conn.discard()
+
+    def stats(self):
+        """连接池统计信息"""
+        with self._lock:
+            count = self._acquire_count
+            return {
+                'size': self.size,
+                'created': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'acquire_count': count,
+                'timeout_count': self._timeout_count,
+                'wait_total_ms': round(self._wait_total * 1000, 3),
+                'wait_avg_ms': round(self._wait_total / count * 1000, 3) if count else 0,
+                'wait_max_ms': round(self._wait_max * 1000, 3),
+            }
+
+
+_pools = {}  # 数据库文件 → 连接池
+_pool_lock = threading.Lock()
+_migrated = set()
+
+def get_pool(database=None):
+    """获取当前进程某个数据库（默认主库 DATABASE）的连接池，fork 后的子进程会重新创建
+
+    第一次为某个数据库创建连接池时先执行数据库迁移，
+    因此直接导入 app 的 WSGI 服务器不需要单独调用 init_db()，新建的分库也会自动建表。
+    """
+    database = database or app.config['DATABASE']
+    pool = _pools.get(database)
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pools.get(database)
+            if pool is None or pool.pid != os.getpid():
+                pool = ConnectionPool(
+                    database,
+                    size=app.config['DB_POOL_SIZE'],
+                    timeout=app.config['DB_POOL_TIMEOUT'],
+                    busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+                    cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+                    mmap_size=app.config['DB_MMAP_SIZE'],
+                )
+                if pool.database not in _migrated:
+                    conn = pool.acquire()
+                    try:
+                        migrate_db(conn)
+                    finally:
+                        conn.close()
+                    _migrated.add(pool.database)
+                _pools[database] = pool
+    return pool
+
+def close_pool():
+    """关闭本进程的数据库连接，fork 工作进程之前调用
+
+    SQLite 连接不能跨 fork 使用：子进程关闭继承来的连接时，可能误以为自己是最后一个连接，
+    执行检查点并删除 WAL 文件。关闭后子进程会各自创建连接池。
+    """
+    with _pool_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        if pool.pid == os.getpid():
+            pool.close_all()
+    data_version.close()
+
+def get_db(database=None):
+    """获取数据库连接
+
+    database 为 None 时使用当前请求所在的库（学生请求为其所在的分库，见 use_shard），否则为主库。
+    在请求（应用上下文）内每个库复用同一个连接，请求结束时自动归还连接池；
+    调用 conn.close() 也只是提前归还连接。
+    """
+    if has_app_context():
+        database = database or g.get('_database') or app.config['DATABASE']
+        conns = g.get('_dbs')
+        if conns is None:
+            conns = g._dbs = {}
+        conn = conns.get(database)
+        if conn is None or conn.in_pool:
+            conn = get_pool(database).acquire()
+            conns[database] = conn
+        return conn
+    return get_pool(database).acquire()
+
+def use_shard(database):
+    """本请求之后不带参数的 get_db() 都使用该库"""
+    g._database = database
+
+@app.teardown_appcontext
+def release_db(exception):
+    """请求结束时归还数据库连接"""
+    conns = g.pop('_dbs', None)
+    for conn in list((conns or {}).values()):
+        conn.close()
+
+# 性能指标（Prometheus 文本格式，见 /admin/metrics），每个进程分别统计
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def format_labels(names, values, le=None):
+    """生成 {a="x",b="y"} 形式的标签"""
+    pairs = [(name, str(value)) for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(('le', le))
+    if not pairs:
+        return ''
+    escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter:
+    """按标签分组的计数器"""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{format_labels(self.labels, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """按标签分组的直方图"""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._values.items())
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, labels, str(bound))} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_labels(self.labels, labels, "+Inf")} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {total:.6f}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {count}')
+        return lines
+
+
+request_count = Counter('http_requests_total', '请求数', ('endpoint', 'method', 'status'))
+request_latency = Histogram('http_request_duration_seconds', '请求耗时', ('endpoint', 'method'))
+request_sql_queries = Histogram('http_request_sql_queries', '每个请求执行的 SQL 语句数',
+                                ('endpoint',), buckets=COUNT_BUCKETS)
+request_sql_seconds = Histogram('http_request_sql_seconds', '每个请求的 SQL 耗时', ('endpoint',))
+request_template_seconds = Histogram('http_request_template_seconds', '每个请求的模板渲染耗时', ('endpoint',))
+query_latency = Histogram('db_query_duration_seconds', '单条 SQL 语句耗时', ('endpoint',))
+slow_query_count = Counter('db_slow_queries_total', '超过 SLOW_QUERY_MS 的 SQL 语句数', ('endpoint',))
+phase_latency = Histogram('phase_duration_seconds', '导出文件等耗时步骤的用时', ('phase',))
+
+
+def metrics_endpoint():
+    """当前请求的端点名，请求之外（后台线程）为 background"""
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'background'
+
+def param_shape(parameters):
+    """描述绑定参数的形状（类型和数量），不记录参数值"""
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in parameters.items()) + '}'
+    if isinstance(parameters, (list, tuple)):
+        types = [type(value).__name__ for value in parameters]
+        if len(types) > 8 and len(set(types)) == 1:
+            return f'({len(types)} × {types[0]})'
+        return '(' + ', '.join(types) + ')'
+    return type(parameters).__name__
+
+def record_query(sql, parameters, seconds, many=False):
+    """记录一条 SQL 的耗时，计入当前请求，超过阈值时写慢查询日志"""
+    endpoint = metrics_endpoint()
+    query_latency.observe((endpoint,), seconds)
+    if has_app_context():
+        g._sql_count = g.get('_sql_count', 0) + 1
+        g._sql_seconds = g.get('_sql_seconds', 0.0) + seconds
+    
+    threshold = app.config['SLOW_QUERY_MS']
+    if threshold and seconds * 1000 >= threshold:
+        slow_query_count.inc((endpoint,))
+        if many:
+            rows = parameters if isinstance(parameters, (list, tuple)) else None
+            shape = f'{len(rows)} 行 × {param_shape(rows[0])}' if rows else '迭代器'
+        else:
+            shape = param_shape(parameters)
+        app.logger.warning('慢查询 %.1f ms [%s]：%s 参数 %s', seconds * 1000, endpoint,
+                           ' '.join(sql.split()), shape)
+
+def record_fetch(seconds):
+    """读取结果集的耗时只计入当前请求的 SQL 时间"""
+    if has_app_context():
+        g._sql_seconds = g.get('_sql_seconds', 0.0) + seconds
+
+
+class TimedCursor(sqlite3.Cursor):
+    """统计执行耗时的游标，连接池中的连接默认使用"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, seq_of_parameters, time.perf_counter() - start, many=True)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            record_fetch(time.perf_counter() - start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            record_fetch(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            record_fetch(time.perf_counter() - start)
+
+
+class timed_phase:
+    """记录一个耗时步骤的用时：with timed_phase('xlsx_export'): ..."""
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        phase_latency.observe((self.phase,), time.perf_counter() - self.start)
+
+
+@app.before_request
+def start_request_timer():
+    g._request_start = time.perf_counter()
+    g._sql_count = 0
+    g._sql_seconds = 0.0
+    g._template_seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    """记录请求耗时，并通过 Server-Timing 响应头给出 SQL 和模板渲染用时"""
+    start = g.get('_request_start')
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    endpoint = metrics_endpoint()
+    sql_count = g.get('_sql_count', 0)
+    sql_seconds = g.get('_sql_seconds', 0.0)
+    template_seconds = g.get('_template_seconds', 0.0)
+    
+    request_count.inc((endpoint, request.method, response.status_code))
+    request_latency.observe((endpoint, request.method), elapsed)
+    request_sql_queries.observe((endpoint,), sql_count)
+    request_sql_seconds.observe((endpoint,), sql_seconds)
+    if template_seconds:
+        request_template_seconds.observe((endpoint,), template_seconds)
+    
+    response.headers['Server-Timing'] = (
+        f'sql;dur={sql_seconds * 1000:.2f};desc="{sql_count} queries", '
+        f'template;dur={template_seconds * 1000:.2f}, total;dur={elapsed * 1000:.2f}')
+    return response
+
+def start_template_timer(sender, template, context, **extra):
+    g._template_start = time.perf_counter()
+
+def record_template_time(sender, template, context, **extra):
+    start = g.pop('_template_start', None)
+    if start is not None:
+        g._template_seconds = g.get('_template_seconds', 0.0) + time.perf_counter() - start
+
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(record_template_time, app)
+
+def migrate_base_tables(conn):
+    """用户、岗位、投票表"""
     c = conn.cursor()
     
     # 用户表
@@ -68,14 +629,6 @@ def init_db():
         UNIQUE(class_name, position_name)
     )''')
     
-    # 检查是否需要添加 sort_order 列（用于已存在的数据库）
-    c.execute("PRAGMA table_info(positions)")
-    columns = [col[1] for col in c.fetchall()]
-    if 'sort_order' not in columns:
-        c.execute('ALTER TABLE positions ADD COLUMN sort_order INTEGER DEFAULT 0')
-        # 为现有数据设置默认排序
-        c.execute('''UPDATE positions SET sort_order = id WHERE sort_order = 0''')
-    
     # 投票记录表
     c.execute('''CREATE TABLE IF NOT EXISTS votes (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -88,24 +641,1492 @@ def init_db():
         UNIQUE(user_id, position_id)
     )''')
     
-    # 创建索引以提高查询性能
-    c.execute('CREATE INDEX IF NOT EXISTS idx_users_class ON users(class_name)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_positions_class ON positions(class_name)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_votes_user ON votes(user_id)')
-    
+    # 早期版本的数据库没有 sort_order 列
+    c.execute("PRAGMA table_info(positions)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'sort_order' not in columns:
+        c.execute('ALTER TABLE positions ADD COLUMN sort_order INTEGER DEFAULT 0')
+        conn.commit()
+        # 为现有数据设置默认排序
+        run_in_batches(conn, 'positions', '''UPDATE positions SET sort_order = id
+                                             WHERE sort_order = 0 AND id >= :lo AND id < :hi''')
+
+def migrate_indexes(conn):
+    """查询所需的索引
+
+    SQLite 建索引无法拆分，因此每个索引单独提交，避免所有索引在一个事务里长时间持有写锁。
+    """
+    statements = [
+        'CREATE INDEX IF NOT EXISTS idx_votes_user ON votes(user_id)',
+        # 删除岗位时按岗位查找投票（UNIQUE(user_id, position_id) 的自动索引以 user_id 开头，用不上）
+        'CREATE INDEX IF NOT EXISTS idx_votes_position ON votes(position_id)',
+        # 只索引管理员行：(is_admin, ...) 普通索引会被管理列表查询选中，导致分页时额外排序
+        'CREATE INDEX IF NOT EXISTS idx_users_admin ON users(id) WHERE is_admin = 1',
+        # 管理列表键集分页使用的索引，同时覆盖按班级查询，原来的单列班级索引不再需要
+        'CREATE INDEX IF NOT EXISTS idx_users_class_name ON users(class_name, name)',
+        'CREATE INDEX IF NOT EXISTS idx_positions_class_order ON positions(class_name, sort_order)',
+        'DROP INDEX IF EXISTS idx_users_class',
+        'DROP INDEX IF EXISTS idx_positions_class',
+    ]
+    for sql in statements:
+        conn.execute(sql)
+        conn.commit()
+
+def migrate_tallies(conn):
+    """岗位计票表，由触发器随投票增删改实时维护"""
+    create_tally_schema(conn.cursor())
     conn.commit()
-    
-    # 检查是否有管理员账号，如果没有则创建默认管理员
+    # 先建触发器再分批回填：每批在一个事务里按 votes 重新计算，
+    # 回填前后到达的投票分别由计算结果和触发器计入
+    run_in_batches(conn, 'positions', '''INSERT OR REPLACE INTO position_tallies
+                                         (position_id, total_votes, satisfied_votes)
+                                         SELECT p.id, COUNT(v.id), COALESCE(SUM(v.is_satisfied = 1), 0)
+                                         FROM positions p
+                                         LEFT JOIN votes v ON p.id = v.position_id
+                                         WHERE p.id >= :lo AND p.id < :hi
+                                         GROUP BY p.id''')
+
+def migrate_class_stats(conn):
+    """班级统计表（人数、岗位数、已投票人数），同样由触发器维护"""
+    create_class_stats_schema(conn.cursor())
+    conn.commit()
+    # 按班级分批回填，做法同计票表
+    c = conn.cursor()
+    c.execute('''SELECT class_name FROM users WHERE is_admin = 0
+                 UNION SELECT class_name FROM positions ORDER BY class_name''')
+    classes = [row[0] for row in c.fetchall()]
+    batch_size = max(1, app.config['DB_MIGRATION_BATCH_SIZE'] // 100)
+    sql = f'''INSERT OR REPLACE INTO class_stats (class_name, user_count, position_count, voter_count)
+              {CLASS_STATS_BATCH_SQL}'''
+    for i in range(0, len(classes), batch_size):
+        batch = classes[i:i + batch_size]
+        c.execute(sql, {'first': batch[0], 'last': batch[-1]})
+        conn.commit()
+
+def migrate_jobs(conn):
+    """后台任务表"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        total INTEGER,
+        processed INTEGER NOT NULL DEFAULT 0,
+        succeeded INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        message TEXT,
+        result_path TEXT,
+        result_name TEXT,
+        created_by INTEGER,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        started_at REAL,
+        finished_at REAL,
+        updated_at REAL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at)')
+
+def migrate_default_admin(conn):
+    """没有管理员账号时创建默认管理员（分库中不创建，管理员只在主库）"""
+    if getattr(conn, 'pool', None) is not None and conn.pool.database != app.config['DATABASE']:
+        return
+    c = conn.cursor()
     c.execute('SELECT COUNT(*) as count FROM users WHERE is_admin = 1')
     if c.fetchone()['count'] == 0:
-        admin_hash = generate_password_hash('admin123')
+        admin_hash = hash_password('admin123')
         c.execute('''INSERT INTO users (name, class_name, username, password_hash, is_admin) 
                      VALUES (?, ?, ?, ?, ?)''', 
                   ('系统管理员', '管理员', 'admin', admin_hash, 1))
-        conn.commit()
         print("已创建默认管理员账号 - 用户名: admin, 密码: admin123")
+
+def migrate_page_versions(conn):
+    """页面校验用的版本号：各班级岗位的版本和每个用户投票的版本
+
+    由触发器在数据变化时递增，投票页面据此生成 ETag，不必查询岗位和投票就能回答条件请求。
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS class_versions (
+        class_name TEXT PRIMARY KEY,
+        positions_version INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute("PRAGMA table_info(users)")
+    if 'vote_version' not in [col[1] for col in c.fetchall()]:
+        c.execute('ALTER TABLE users ADD COLUMN vote_version INTEGER NOT NULL DEFAULT 0')
+
+    # 岗位增删改时递增所在班级的版本
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_insert_version AFTER INSERT ON positions
+        BEGIN
+            INSERT OR IGNORE INTO class_versions (class_name) VALUES (NEW.class_name);
+            UPDATE class_versions SET positions_version = positions_version + 1
+            WHERE class_name = NEW.class_name;
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_update_version AFTER UPDATE ON positions
+        BEGIN
+            INSERT OR IGNORE INTO class_versions (class_name) VALUES (NEW.class_name);
+            UPDATE class_versions SET positions_version = positions_version + 1
+            WHERE class_name IN (OLD.class_name, NEW.class_name);
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_delete_version AFTER DELETE ON positions
+        BEGIN
+            UPDATE class_versions SET positions_version = positions_version + 1
+            WHERE class_name = OLD.class_name;
+        END''')
+
+    # 投票增删改时递增投票人的版本
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_insert_version AFTER INSERT ON votes
+        BEGIN
+            UPDATE users SET vote_version = vote_version + 1 WHERE id = NEW.user_id;
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_update_version AFTER UPDATE ON votes
+        BEGIN
+            UPDATE users SET vote_version = vote_version + 1 WHERE id IN (OLD.user_id, NEW.user_id);
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_delete_version AFTER DELETE ON votes
+        BEGIN
+            UPDATE users SET vote_version = vote_version + 1 WHERE id = OLD.user_id;
+        END''')
+
+def migrate_shard_directory(conn):
+    """分库登记表和账号目录（只有主库中的有数据）
+
+    shards 记录每个分组对应的分库编号；user_directory 记录学生账号所在的分库，
+    登录时据此找到学生，它的主键同时保证账号在所有分库中唯一。
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS shards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_directory (
+        username TEXT PRIMARY KEY,
+        shard_id INTEGER NOT NULL
+    )''')
+
+def migrate_rounds(conn):
+    """投票轮次和已结束轮次的冻结结果
+
+    rounds 只有主库中的有数据；每个库都有自己的 round_results、round_class_stats，
+    结束轮次时各库在同一个事务里冻结本库的计票结果并清空投票，不需要跨库事务，
+    round_closures 记录哪些轮次已在本库冻结，中断后重新结束时跳过已完成的库。
+    冻结的结果只允许插入，由触发器拒绝修改和删除。
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS rounds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        opened_at REAL NOT NULL,
+        closed_at REAL,
+        position_count INTEGER,
+        voter_count INTEGER,
+        total_votes INTEGER
+    )''')
+    # 主键与统计、导出的排序 (班级, 岗位) 一致，按轮次读取是一次有序的范围扫描
+    conn.execute('''CREATE TABLE IF NOT EXISTS round_results (
+        round_id INTEGER NOT NULL,
+        class_name TEXT NOT NULL,
+        position_name TEXT NOT NULL,
+        position_id INTEGER NOT NULL,
+        member_name TEXT NOT NULL,
+        sort_order INTEGER NOT NULL,
+        total_votes INTEGER NOT NULL,
+        satisfied_votes INTEGER NOT NULL,
+        PRIMARY KEY (round_id, class_name, position_name)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS round_class_stats (
+        round_id INTEGER NOT NULL,
+        class_name TEXT NOT NULL,
+        user_count INTEGER NOT NULL,
+        position_count INTEGER NOT NULL,
+        voter_count INTEGER NOT NULL,
+        PRIMARY KEY (round_id, class_name)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS round_closures (
+        round_id INTEGER PRIMARY KEY,
+        closed_at REAL NOT NULL,
+        pruned_votes INTEGER NOT NULL
+    )''')
+    for table in ('round_results', 'round_class_stats'):
+        for event in ('UPDATE', 'DELETE'):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_frozen BEFORE {event} ON {table}
+                BEGIN
+                    SELECT RAISE(ABORT, '已结束轮次的结果不能修改');
+                END''')
+    
+    # 已有的投票属于第 1 轮
+    if getattr(conn, 'pool', None) is not None and conn.pool.database != app.config['DATABASE']:
+        return
+    if conn.execute('SELECT COUNT(*) FROM rounds').fetchone()[0] == 0:
+        conn.execute("INSERT INTO rounds (name, opened_at) VALUES ('第 1 轮', ?)", (time.time(),))
+
+def migrate_vote_events(conn):
+    """投票事件日志
+
+    votes 表的每次写入、修改和删除（包括删除用户、岗位和结束轮次时的删除）都由触发器
+    在同一个事务里追加一条事件，批量写入投票时事件也随同一批提交。is_satisfied 为 NULL
+    表示这张选票被撤销。日志只能追加，是重建 votes 表的依据（见 replay_vote_log）。
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS vote_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        position_id INTEGER NOT NULL,
+        is_satisfied INTEGER,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_insert_event AFTER INSERT ON votes
+        BEGIN
+            INSERT INTO vote_events (user_id, position_id, is_satisfied)
+            VALUES (NEW.user_id, NEW.position_id, NEW.is_satisfied);
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_update_event AFTER UPDATE OF user_id, position_id, is_satisfied ON votes
+        BEGIN
+            INSERT INTO vote_events (user_id, position_id, is_satisfied)
+            SELECT OLD.user_id, OLD.position_id, NULL
+            WHERE OLD.user_id != NEW.user_id OR OLD.position_id != NEW.position_id;
+            INSERT INTO vote_events (user_id, position_id, is_satisfied)
+            VALUES (NEW.user_id, NEW.position_id, NEW.is_satisfied);
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_delete_event AFTER DELETE ON votes
+        BEGIN
+            INSERT INTO vote_events (user_id, position_id, is_satisfied)
+            VALUES (OLD.user_id, OLD.position_id, NULL);
+        END''')
+    for event in ('UPDATE', 'DELETE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_vote_events_{event.lower()}_append_only
+            BEFORE {event} ON vote_events
+            BEGIN
+                SELECT RAISE(ABORT, '投票事件日志只能追加');
+            END''')
+    
+    # 结束轮次时记录日志位置，重建进行中的轮次只需要重放其后的事件
+    c.execute("PRAGMA table_info(round_closures)")
+    if 'last_event_id' not in [col[1] for col in c.fetchall()]:
+        c.execute('ALTER TABLE round_closures ADD COLUMN last_event_id INTEGER')
+    conn.commit()
+    
+    # 先建触发器再分批回填现有投票：回填期间修改的投票，触发器记下的事件和回填读到的都是最新值
+    run_in_batches(conn, 'votes', '''INSERT INTO vote_events (user_id, position_id, is_satisfied, created_at)
+                                     SELECT user_id, position_id, is_satisfied, created_at FROM votes
+                                     WHERE id >= :lo AND id < :hi''')
+
+def migrate_participation(conn):
+    """参与索引：users.has_voted 标记学生是否已投票，由触发器维护
+
+    未投票学生的部分索引按 (班级, 姓名, id) 排序，只包含尚未投票的学生，
+    未投票名单按班级读取时只扫描名单本身，不需要对 users、votes 做反连接。
+    """
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(users)")
+    if 'has_voted' not in [col[1] for col in c.fetchall()]:
+        c.execute('ALTER TABLE users ADD COLUMN has_voted INTEGER NOT NULL DEFAULT 0')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_users_non_voters ON users(class_name, name, id)
+                 WHERE is_admin = 0 AND has_voted = 0''')
+    # 投票时只有第一票真正写入 users；最后一票被删除（删除岗位、结束轮次）时恢复为未投票
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_insert_participation AFTER INSERT ON votes
+        BEGIN
+            UPDATE users SET has_voted = 1 WHERE id = NEW.user_id AND has_voted = 0;
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_delete_participation AFTER DELETE ON votes
+        WHEN NOT EXISTS (SELECT 1 FROM votes WHERE user_id = OLD.user_id)
+        BEGIN
+            UPDATE users SET has_voted = 0 WHERE id = OLD.user_id;
+        END''')
+    conn.commit()
     
+    # 先建触发器再分批回填，做法同计票表
+    run_in_batches(conn, 'users', f'''UPDATE users SET has_voted = {HAS_VOTED_SQL}
+                                      WHERE id >= :lo AND id < :hi AND is_admin = 0''')
+
+def migrate_data_generation(conn):
+    """数据代数：管理页面校验用的版本号
+
+    每个库一行，用户、岗位、投票和轮次变化时由触发器在同一个事务里递增。与 PRAGMA data_version
+    不同，所有进程读到的值都一样，一个工作进程签发的 ETag 在其他工作进程中同样有效。
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS data_generation (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        generation INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute('INSERT OR IGNORE INTO data_generation (id) VALUES (1)')
+    # 用户只有页面上显示的列变化时才递增，登录重算哈希和投票触发器维护的列不算
+    events = {
+        'users': ['INSERT', 'UPDATE OF name, class_name, username, is_admin', 'DELETE'],
+        'positions': ['INSERT', 'UPDATE', 'DELETE'],
+        'votes': ['INSERT', 'UPDATE', 'DELETE'],
+        'rounds': ['INSERT', 'UPDATE'],
+        'round_closures': ['INSERT'],
+    }
+    for table, table_events in events.items():
+        for event in table_events:
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.split()[0].lower()}_generation
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_generation SET generation = generation + 1 WHERE id = 1;
+                END''')
+
+# 数据库结构迁移，按顺序执行，版本号记录在 PRAGMA user_version 中。
+# 已发布的迁移不要修改，结构变更请在末尾追加新的迁移。
+MIGRATIONS = [
+    (1, migrate_base_tables),
+    (2, migrate_indexes),
+    (3, migrate_tallies),
+    (4, migrate_class_stats),
+    (5, migrate_jobs),
+    (6, migrate_default_admin),
+    (7, migrate_page_versions),
+    (8, migrate_shard_directory),
+    (9, migrate_rounds),
+    (10, migrate_vote_events),
+    (11, migrate_participation),
+    (12, migrate_data_generation),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def run_in_batches(conn, table, sql):
+    """按 rowid 区间分批执行带 :lo、:hi 参数的语句，每批单独提交
+
+    大表的回填拆成多个短事务，其他连接可以在批次之间写入，不会被长时间锁住。
+    """
+    batch_size = app.config['DB_MIGRATION_BATCH_SIZE']
+    max_id = conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+    for lo in range(0, max_id + 1, batch_size):
+        conn.execute(sql, {'lo': lo, 'hi': lo + batch_size})
+        conn.commit()
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+@contextmanager
+def migration_lock(conn):
+    """跨进程的迁移锁，在整个迁移期间持有
+
+    迁移中的分批回填、逐个建索引会多次提交，BEGIN IMMEDIATE 取得的写锁在第一次提交时就释放了，
+    只靠它，另一个进程可能在这时通过版本检查，把同一个迁移再执行一遍（如重复回填）。
+    锁是数据库旁的 <数据库文件>.migrate-lock 文件上的 flock，进程退出时自动释放。
+    内存数据库和没有 fcntl 的平台（Windows）不加锁，请不要在这些平台上多进程同时启动。
+    """
+    path = conn.execute('PRAGMA database_list').fetchone()['file']
+    if fcntl is None or not path:
+        yield
+        return
+    with open(path + '.migrate-lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def migrate_db(conn):
+    """执行尚未应用的迁移，返回执行的迁移数
+
+    结构已是最新时只读一次 PRAGMA user_version。否则先取得迁移锁（见 migration_lock），
+    每个迁移开始前用 BEGIN IMMEDIATE 取得写锁并重新检查版本，多个进程同时启动时只有一个会执行，
+    其他进程等它完成后发现版本已是最新，直接跳过。
+    """
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return 0
+    
+    applied = 0
+    with migration_lock(conn):
+        for version, migrate in MIGRATIONS:
+            conn.execute('BEGIN IMMEDIATE')
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            start = time.perf_counter()
+            migrate(conn)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+            applied += 1
+            app.logger.info('数据库迁移 %d（%s）完成，用时 %.2f 秒',
+                            version, migrate.__name__, time.perf_counter() - start)
+    if applied:
+        data_version.bump()
+    return applied
+
+def init_db():
+    """初始化数据库：执行迁移，清理中断的任务并预热缓存
+
+    导入 app 的 WSGI 服务器在第一次使用数据库时也会自动执行迁移（见 get_pool）。
+    """
+    conn = get_db()
+    migrate_db(conn)
+    
+    # 上次运行中断的任务不会再继续
+    conn.execute('''UPDATE jobs SET status = 'failed', message = '服务重启，任务已中断', finished_at = ?
+                    WHERE status IN ('pending', 'running')''', (time.time(),))
+    conn.commit()
     conn.close()
+    
+    # 打开各分库的连接池，结构有更新时在启动阶段完成迁移
+    for database in shard_router.databases():
+        get_pool(database)
+    
+    # 预热班级统计缓存和岗位目录
+    with app.app_context():
+        class_stats_cache.get()
+        position_catalog.load_all()
+
+def create_tally_schema(c):
+    """创建岗位计票表及维护它的触发器"""
+    c.execute('''CREATE TABLE IF NOT EXISTS position_tallies (
+        position_id INTEGER PRIMARY KEY,
+        total_votes INTEGER NOT NULL DEFAULT 0,
+        satisfied_votes INTEGER NOT NULL DEFAULT 0
+    )''')
+    
+    # 岗位增删时同步计票行
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_insert_tally AFTER INSERT ON positions
+        BEGIN
+            INSERT OR IGNORE INTO position_tallies (position_id) VALUES (NEW.id);
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_delete_tally AFTER DELETE ON positions
+        BEGIN
+            DELETE FROM position_tallies WHERE position_id = OLD.id;
+        END''')
+    
+    # 投票增删改时增量更新计数
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_insert_tally AFTER INSERT ON votes
+        BEGIN
+            UPDATE position_tallies
+            SET total_votes = total_votes + 1,
+                satisfied_votes = satisfied_votes + (NEW.is_satisfied = 1)
+            WHERE position_id = NEW.position_id;
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_delete_tally AFTER DELETE ON votes
+        BEGIN
+            UPDATE position_tallies
+            SET total_votes = total_votes - 1,
+                satisfied_votes = satisfied_votes - (OLD.is_satisfied = 1)
+            WHERE position_id = OLD.position_id;
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_update_tally AFTER UPDATE OF position_id, is_satisfied ON votes
+        BEGIN
+            UPDATE position_tallies
+            SET total_votes = total_votes - 1,
+                satisfied_votes = satisfied_votes - (OLD.is_satisfied = 1)
+            WHERE position_id = OLD.position_id;
+            UPDATE position_tallies
+            SET total_votes = total_votes + 1,
+                satisfied_votes = satisfied_votes + (NEW.is_satisfied = 1)
+            WHERE position_id = NEW.position_id;
+        END''')
+
+# 从 votes 表重新计算的计票结果
+TALLY_SOURCE_SQL = '''
+    SELECT p.id as position_id,
+           COUNT(v.id) as total_votes,
+           COALESCE(SUM(v.is_satisfied = 1), 0) as satisfied_votes
+    FROM positions p
+    LEFT JOIN votes v ON p.id = v.position_id
+    GROUP BY p.id
+'''
+
+def rebuild_tallies(conn):
+    """根据 votes 表重建岗位计票表"""
+    c = conn.cursor()
+    c.execute('DELETE FROM position_tallies')
+    c.execute(f'''INSERT INTO position_tallies (position_id, total_votes, satisfied_votes)
+                  {TALLY_SOURCE_SQL}''')
+    conn.commit()
+    return c.rowcount
+
+def verify_tallies(conn):
+    """校验岗位计票表，返回与 votes 表不一致的岗位列表"""
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT s.position_id,
+               s.total_votes as expected_total, t.total_votes as actual_total,
+               s.satisfied_votes as expected_satisfied, t.satisfied_votes as actual_satisfied
+        FROM ({TALLY_SOURCE_SQL}) s
+        LEFT JOIN position_tallies t ON t.position_id = s.position_id
+        WHERE t.position_id IS NULL
+           OR t.total_votes != s.total_votes
+           OR t.satisfied_votes != s.satisfied_votes
+    ''')
+    return [dict(row) for row in c.fetchall()]
+
+def create_class_stats_schema(c):
+    """创建班级统计表及维护它的触发器"""
+    c.execute('''CREATE TABLE IF NOT EXISTS class_stats (
+        class_name TEXT PRIMARY KEY,
+        user_count INTEGER NOT NULL DEFAULT 0,
+        position_count INTEGER NOT NULL DEFAULT 0,
+        voter_count INTEGER NOT NULL DEFAULT 0
+    )''')
+    
+    # 用户增删时更新班级人数（管理员不计入）
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_insert_class_stats AFTER INSERT ON users
+        WHEN NEW.is_admin = 0
+        BEGIN
+            INSERT OR IGNORE INTO class_stats (class_name) VALUES (NEW.class_name);
+            UPDATE class_stats SET user_count = user_count + 1 WHERE class_name = NEW.class_name;
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_delete_class_stats AFTER DELETE ON users
+        WHEN OLD.is_admin = 0
+        BEGIN
+            UPDATE class_stats
+            SET user_count = user_count - 1,
+                voter_count = voter_count - EXISTS (SELECT 1 FROM votes WHERE user_id = OLD.id)
+            WHERE class_name = OLD.class_name;
+        END''')
+    
+    # 岗位增删时更新班级岗位数
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_insert_class_stats AFTER INSERT ON positions
+        BEGIN
+            INSERT OR IGNORE INTO class_stats (class_name) VALUES (NEW.class_name);
+            UPDATE class_stats SET position_count = position_count + 1 WHERE class_name = NEW.class_name;
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_delete_class_stats AFTER DELETE ON positions
+        BEGIN
+            UPDATE class_stats SET position_count = position_count - 1 WHERE class_name = OLD.class_name;
+        END''')
+    
+    # 用户投出第一票时计为已投票，最后一票被删除时撤销
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_insert_class_stats AFTER INSERT ON votes
+        WHEN (SELECT COUNT(*) FROM (SELECT 1 FROM votes WHERE user_id = NEW.user_id LIMIT 2)) = 1
+        BEGIN
+            UPDATE class_stats SET voter_count = voter_count + 1
+            WHERE class_name = (SELECT class_name FROM users WHERE id = NEW.user_id AND is_admin = 0);
+        END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_votes_delete_class_stats AFTER DELETE ON votes
+        WHEN NOT EXISTS (SELECT 1 FROM votes WHERE user_id = OLD.user_id)
+        BEGIN
+            UPDATE class_stats SET voter_count = voter_count - 1
+            WHERE class_name = (SELECT class_name FROM users WHERE id = OLD.user_id AND is_admin = 0);
+        END''')
+
+# 从原始表重新计算的班级统计，{users_filter}、{positions_filter} 用于限定班级范围
+CLASS_STATS_SOURCE_TEMPLATE = '''
+    SELECT class_name,
+           SUM(user_count) as user_count,
+           SUM(position_count) as position_count,
+           SUM(voter_count) as voter_count
+    FROM (
+        SELECT class_name, COUNT(*) as user_count, 0 as position_count, 0 as voter_count
+        FROM users WHERE is_admin = 0 {users_filter} GROUP BY class_name
+        UNION ALL
+        SELECT class_name, 0, COUNT(*), 0 FROM positions {positions_filter} GROUP BY class_name
+        UNION ALL
+        SELECT u.class_name, 0, 0, COUNT(*) FROM users u
+        WHERE u.is_admin = 0 {users_filter} AND EXISTS (SELECT 1 FROM votes v WHERE v.user_id = u.id)
+        GROUP BY u.class_name
+    )
+    GROUP BY class_name
+'''
+CLASS_STATS_SOURCE_SQL = CLASS_STATS_SOURCE_TEMPLATE.format(users_filter='', positions_filter='')
+# 只计算 :first 到 :last 之间的班级（外层条件不会下推到 UNION ALL 子查询中，所以写在各分支里）
+CLASS_STATS_BATCH_SQL = CLASS_STATS_SOURCE_TEMPLATE.format(
+    users_filter='AND class_name BETWEEN :first AND :last',
+    positions_filter='WHERE class_name BETWEEN :first AND :last')
+
+# 学生是否已投票（users.has_voted 的来源）
+HAS_VOTED_SQL = 'EXISTS (SELECT 1 FROM votes WHERE user_id = users.id)'
+
+def rebuild_class_stats(conn):
+    """根据 users、positions、votes 表重建班级统计表和学生的已投票标记"""
+    c = conn.cursor()
+    c.execute('DELETE FROM class_stats')
+    c.execute(f'''INSERT INTO class_stats (class_name, user_count, position_count, voter_count)
+                  {CLASS_STATS_SOURCE_SQL}''')
+    count = c.rowcount
+    c.execute(f'UPDATE users SET has_voted = {HAS_VOTED_SQL} WHERE is_admin = 0 AND has_voted != {HAS_VOTED_SQL}')
+    conn.commit()
+    data_version.bump()
+    return count
+
+def verify_class_stats(conn):
+    """校验班级统计表，返回不一致的班级列表"""
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT s.class_name,
+               s.user_count as expected_users, COALESCE(t.user_count, 0) as actual_users,
+               s.position_count as expected_positions, COALESCE(t.position_count, 0) as actual_positions,
+               s.voter_count as expected_voters, COALESCE(t.voter_count, 0) as actual_voters
+        FROM ({CLASS_STATS_SOURCE_SQL}) s
+        LEFT JOIN class_stats t ON t.class_name = s.class_name
+        WHERE COALESCE(t.user_count, 0) != s.user_count
+           OR COALESCE(t.position_count, 0) != s.position_count
+           OR COALESCE(t.voter_count, 0) != s.voter_count
+        UNION ALL
+        SELECT t.class_name, 0, t.user_count, 0, t.position_count, 0, t.voter_count
+        FROM class_stats t
+        WHERE t.class_name NOT IN (SELECT class_name FROM ({CLASS_STATS_SOURCE_SQL}))
+          AND (t.user_count != 0 OR t.position_count != 0 OR t.voter_count != 0)
+    ''')
+    return [dict(row) for row in c.fetchall()]
+
+def verify_participation(conn):
+    """校验学生的已投票标记，返回不一致的学生列表"""
+    c = conn.execute(f'''SELECT id, username, has_voted as actual, {HAS_VOTED_SQL} as expected FROM users
+                         WHERE is_admin = 0 AND has_voted != {HAS_VOTED_SQL}''')
+    return [dict(row) for row in c.fetchall()]
+
+
+# 投票事件日志重放：每张选票（用户, 岗位）取最后一个事件，撤销的选票不计入。
+# SQLite 在带 MAX() 的聚合查询中，其他列取自使 MAX() 成立的那一行，一次分组扫描即可得到最终状态。
+# 已删除的用户、岗位不会有未撤销的选票，另加的存在性条件只为防止日志与 users、positions 不一致。
+VOTE_LOG_STATE_SQL = '''
+    SELECT user_id, position_id, is_satisfied, created_at FROM (
+        SELECT user_id, position_id, is_satisfied, created_at, MAX(id)
+        FROM vote_events WHERE id > :start
+        GROUP BY user_id, position_id
+    )
+    WHERE is_satisfied IS NOT NULL
+      AND user_id IN (SELECT id FROM users)
+      AND position_id IN (SELECT id FROM positions)
+'''
+
+def vote_log_start(conn):
+    """进行中轮次的第一个事件之前的位置（上次结束轮次时日志的末尾）"""
+    return conn.execute('SELECT COALESCE(MAX(last_event_id), 0) FROM round_closures').fetchone()[0]
+
+def replay_vote_log(conn):
+    """按投票事件日志重建 votes 表、岗位计票表和班级统计表，返回 (重放的事件数, 重建的投票数)
+
+    在一个写事务中完成：暂时删除 votes 上的触发器（重建不能再追加事件，也不必逐行维护计票），
+    整表写入各选票的最终状态后恢复触发器，再整体重算计票表、班级统计表和学生的已投票标记，
+    并使所有投票页面的 ETag 失效。
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        start = vote_log_start(conn)
+        events = conn.execute('SELECT COUNT(*) FROM vote_events WHERE id > ?', (start,)).fetchone()[0]
+        triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'votes'").fetchall()
+        for trigger in triggers:
+            conn.execute(f'DROP TRIGGER {trigger["name"]}')
+        conn.execute('DELETE FROM votes')
+        count = conn.execute(f'''INSERT INTO votes (user_id, position_id, is_satisfied, created_at)
+                                 {VOTE_LOG_STATE_SQL}''', {'start': start}).rowcount
+        for trigger in triggers:
+            conn.execute(trigger['sql'])
+        
+        conn.execute('DELETE FROM position_tallies')
+        conn.execute(f'''INSERT INTO position_tallies (position_id, total_votes, satisfied_votes)
+                         {TALLY_SOURCE_SQL}''')
+        conn.execute('DELETE FROM class_stats')
+        conn.execute(f'''INSERT INTO class_stats (class_name, user_count, position_count, voter_count)
+                         {CLASS_STATS_SOURCE_SQL}''')
+        conn.execute(f'UPDATE users SET vote_version = vote_version + 1, has_voted = {HAS_VOTED_SQL} WHERE is_admin = 0')
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    data_version.bump()
+    return events, count
+
+def verify_vote_log(conn):
+    """校验 votes 表是否与事件日志重放的结果一致，返回 (votes 表中多出或不同的行数, 缺少或不同的行数)"""
+    params = {'start': vote_log_start(conn)}
+    extra = conn.execute(f'''SELECT COUNT(*) FROM (
+                                SELECT user_id, position_id, is_satisfied FROM votes
+                                EXCEPT SELECT user_id, position_id, is_satisfied FROM ({VOTE_LOG_STATE_SQL}))''',
+                         params).fetchone()[0]
+    missing = conn.execute(f'''SELECT COUNT(*) FROM (
+                                  SELECT user_id, position_id, is_satisfied FROM ({VOTE_LOG_STATE_SQL})
+                                  EXCEPT SELECT user_id, position_id, is_satisfied FROM votes)''',
+                           params).fetchone()[0]
+    return extra, missing
+
+
+# 分库 n 的用户、岗位 id 从 n << SHARD_ID_BITS 开始，主库的 id 小于 1 << SHARD_ID_BITS
+SHARD_ID_BITS = 32
+
+
+class ShardRouter:
+    """分库路由：按班级找到所在的数据库文件
+
+    不分库时所有数据都在主库（DATABASE）。分库时主库保存管理员、后台任务、分库登记表和账号目录，
+    学生、岗位和投票按 DB_SHARD_BY 分组存放在各自的库中，不同分组的写入不再争抢同一把写锁。
+    各分库的结构与主库相同，自增 id 按分库编号划分区间、全局唯一，只带 id 的操作
+    （删除用户、岗位，批量写入投票）据此找到所在的库。
+    启用分库前已在主库中的班级没有登记分库，仍从主库读写。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = None
+        self._pattern = None
+        self._ids = {}  # 分组 → 分库编号
+        self._known = set()  # 已登记的分库编号
+
+    @property
+    def enabled(self):
+        return bool(app.config['DB_SHARD_BY'])
+
+    def _check_config(self):
+        """配置（主库、分组规则、目录）变化后丢弃已缓存的登记信息"""
+        config = (app.config['DATABASE'], app.config['DB_SHARD_BY'], app.config['DB_SHARD_DIR'])
+        if config != self._config:
+            with self._lock:
+                if config != self._config:
+                    shard_by = config[1]
+                    self._pattern = None if shard_by in ('', 'class') else re.compile(shard_by)
+                    self._ids = {}
+                    self._known = set()
+                    self._config = config
+
+    def shard_key(self, class_name):
+        """班级所属的分组"""
+        self._check_config()
+        if self._pattern is None:
+            return class_name
+        match = self._pattern.search(class_name)
+        if match is None:
+            return 'default'
+        return match.group(1) if self._pattern.groups else match.group(0)
+
+    def directory(self):
+        return app.config['DB_SHARD_DIR'] or os.path.splitext(app.config['DATABASE'])[0] + '_shards'
+
+    def database(self, shard_id):
+        """分库编号对应的数据库文件，0 为主库"""
+        if not shard_id:
+            return app.config['DATABASE']
+        return os.path.join(self.directory(), f'shard_{int(shard_id)}.db')
+
+    def shard_for_class(self, class_name, create=False):
+        """班级所在的分库编号，没有登记分库时为 0（主库）；create 为 True 时为它的分组登记分库"""
+        if not self.enabled:
+            return 0
+        key = self.shard_key(class_name)
+        shard_id = self._ids.get(key)
+        if shard_id is None:
+            shard_id = self._lookup(key, create)
+        return shard_id
+
+    def database_for_class(self, class_name, create=False):
+        return self.database(self.shard_for_class(class_name, create))
+
+    @staticmethod
+    def shard_of(row_id):
+        """用户、岗位 id 所在的分库编号"""
+        return row_id >> SHARD_ID_BITS
+
+    def database_for_id(self, row_id):
+        """用户、岗位 id 所在的库，对应的分库不存在时返回 None"""
+        shard_id = self.shard_of(row_id)
+        if not shard_id:
+            return app.config['DATABASE']
+        self._check_config()
+        if shard_id not in self._known:
+            self._load()
+            if shard_id not in self._known:
+                return None
+        return self.database(shard_id)
+
+    def shard_ids(self):
+        """主库（0）和所有已登记分库的编号，每次从主库读取，包括其他进程新建的分库"""
+        if not self.enabled:
+            return [0]
+        self._check_config()
+        return [0] + sorted(self._load())
+
+    def databases(self):
+        """跨库查询要访问的全部数据库文件"""
+        return [self.database(shard_id) for shard_id in self.shard_ids()]
+
+    def _load(self):
+        conn = get_pool().acquire()
+        try:
+            ids = {row['id'] for row in conn.execute('SELECT id FROM shards')}
+        finally:
+            conn.close()
+        with self._lock:
+            self._known |= ids
+        return ids
+
+    def _lookup(self, key, create):
+        conn = get_pool().acquire()
+        try:
+            row = conn.execute('SELECT id FROM shards WHERE key = ?', (key,)).fetchone()
+            if row is None and create:
+                # 多个进程同时登记同一分组时只有一个插入成功，其余读到同一个编号
+                conn.execute('INSERT OR IGNORE INTO shards (key) VALUES (?)', (key,))
+                conn.commit()
+                row = conn.execute('SELECT id FROM shards WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return 0
+        shard_id = row['id']
+        self._open(shard_id)
+        with self._lock:
+            self._ids[key] = shard_id
+            self._known.add(shard_id)
+        return shard_id
+
+    def _open(self, shard_id):
+        """建好分库（连接池第一次打开时执行迁移），并把自增 id 的起点设为该分库的区间"""
+        os.makedirs(self.directory(), exist_ok=True)
+        base = shard_id << SHARD_ID_BITS
+        conn = get_pool(self.database(shard_id)).acquire()
+        try:
+            for table in ('users', 'positions'):
+                conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?', (base, table, base))
+                conn.execute('''INSERT INTO sqlite_sequence (name, seq) SELECT ?, ?
+                                WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)''',
+                             (table, base, table))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+shard_router = ShardRouter()
+
+_fanout_executor = None
+_fanout_executor_lock = threading.Lock()
+
+def get_fanout_executor():
+    """获取跨库查询使用的线程池"""
+    global _fanout_executor
+    executor = _fanout_executor
+    if executor is None or executor.pid != os.getpid():
+        with _fanout_executor_lock:
+            executor = _fanout_executor
+            if executor is None or executor.pid != os.getpid():
+                executor = ThreadPoolExecutor(max_workers=app.config['DB_SHARD_FANOUT_WORKERS'],
+                                              thread_name_prefix='shard')
+                executor.pid = os.getpid()
+                _fanout_executor = executor
+    return executor
+
+def acquire_connection(database):
+    """取得某个库的连接：报表快照文件打开只读连接，其余从连接池取出，用完都要 close()"""
+    if report_snapshots.owns(database):
+        return report_snapshots.connect(database)
+    return get_pool(database).acquire()
+
+def fan_out(func, databases=None):
+    """对每个库调用 func(conn)，按 databases 的顺序返回结果列表
+
+    databases 默认为全部库，也可以是报表快照文件；不分库时只有主库，直接在当前线程执行，多个库时在线程池中并行执行。
+    func 中不要再调用 fan_out（线程池占满时会互相等待）。
+    """
+    if databases is None:
+        databases = shard_router.databases()
+
+    def run(database):
+        conn = acquire_connection(database)
+        try:
+            return func(conn)
+        finally:
+            conn.close()
+
+    if len(databases) == 1:
+        return [run(databases[0])]
+    return list(get_fanout_executor().map(run, databases))
+
+
+class _ShardReader:
+    """逐块读取一个库的查询结果，读取下一块的同时调用方可以处理当前块"""
+
+    def __init__(self, database, sql, params, chunk_size, executor):
+        self.conn = acquire_connection(database)
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.cursor = None
+        self.future = executor.submit(self._first, sql, params)
+
+    def _first(self, sql, params):
+        self.cursor = self.conn.execute(sql, params)
+        return self.cursor.fetchmany(self.chunk_size)
+
+    def __iter__(self):
+        while True:
+            chunk = self.future.result()
+            if not chunk:
+                return
+            self.future = self.executor.submit(self.cursor.fetchmany, self.chunk_size)
+            yield from chunk
+
+    def close(self):
+        try:
+            self.future.result()
+        except sqlite3.Error:
+            pass
+        if self.cursor is not None:
+            self.cursor.close()
+        self.conn.close()
+
+
+def iter_shards(sql, params=(), key=None, databases=None, chunk_size=500):
+    """在各库上执行同一条有序查询，按 key 归并后逐行产出
+
+    各库的查询在线程池中同时执行并预读下一块，结果边读边归并，内存占用与总行数无关。
+    key 必须与 SQL 的 ORDER BY 一致。只有一个库时直接读取。
+    """
+    if databases is None:
+        databases = shard_router.databases()
+    if len(databases) == 1:
+        conn = acquire_connection(databases[0])
+        try:
+            c = conn.execute(sql, params)
+            while True:
+                chunk = c.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                yield from chunk
+        finally:
+            conn.close()
+        return
+
+    executor = get_fanout_executor()
+    readers = []
+    try:
+        for database in databases:
+            readers.append(_ShardReader(database, sql, params, chunk_size, executor))
+        yield from heapq.merge(*readers, key=key)
+    finally:
+        for reader in readers:
+            reader.close()
+
+def read_shards(sql, params=(), key=None, limit=None, databases=None):
+    """iter_shards 的前 limit 行（分页查询的 SQL 里各库也要带上同样的 LIMIT）"""
+    with closing(iter_shards(sql, params, key, databases)) as rows:
+        return list(islice(rows, limit))
+
+# 账号目录（分库时学生账号 → 所在分库）
+def find_user_shard(conn, username):
+    """学生账号所在的分库编号，账号目录中没有时返回 None"""
+    row = conn.execute('SELECT shard_id FROM user_directory WHERE username = ?', (username,)).fetchone()
+    return row['shard_id'] if row else None
+
+def claim_usernames(conn, entries):
+    """在账号目录中登记 [(账号, 分库编号), ...] 并提交，返回登记成功的账号
+
+    账号已在目录或主库（管理员）中时跳过，因此账号在所有库中唯一。
+    """
+    claimed = set()
+    for username, shard_id in entries:
+        c = conn.execute('''INSERT OR IGNORE INTO user_directory (username, shard_id)
+                           SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM users WHERE username = ?)''',
+                         (username, shard_id, username))
+        if c.rowcount > 0:
+            claimed.add(str(username))
+    conn.commit()
+    return claimed
+
+def release_usernames(conn, usernames):
+    """从账号目录中删除账号并提交"""
+    conn.executemany('DELETE FROM user_directory WHERE username = ?', [(username,) for username in usernames])
+    conn.commit()
+
+
+class _VersionReader:
+    """读取 PRAGMA data_version 的一组连接（每个库一个），同一时刻只由一个线程使用"""
+
+    def __init__(self, key):
+        self.key = key  # (进程号, 主库)
+        self.conns = {}  # 数据库文件 → 连接
+        self.seen = {}  # 数据库文件 → 上次读到的 data_version
+
+    def close(self):
+        # 从父进程继承来的连接不关闭
+        if self.key[0] == os.getpid():
+            for conn in self.conns.values():
+                conn.close()
+        self.conns = {}
+
+
+class DataVersion:
+    """全局数据版本
+
+    写操作提交后调用 bump() 递增本进程的计数；另外用专门的连接读取各库的 PRAGMA data_version，
+    其他连接（包括其他进程）提交的修改都会使它变化。两者组合作为缓存的版本号，版本不变时缓存一定是最新的。
+
+    PRAGMA data_version 只在同一个连接内可比较，所以不直接作为版本号：读取连接放在一个小池子里，
+    每个连接记下上次读到的值，发现变化时为该库分配一个新的序号（本进程内全局递增）。库的版本是
+    最近一次变化的序号，分库时取各库的最大值，任何一个库有修改时都会增大。查询缓存时各线程取用
+    各自的读取连接，只有发现变化时才短暂持锁，不会在一把锁上排队。
+
+    新建的读取连接第一次读取也算一次变化，fork 出的工作进程、切换数据库或新增分库后，
+    从父进程继承来的或属于其他库的缓存条目因此全部作废。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = 0
+        self._seq = 0
+        self._changes = {}  # 数据库文件 → 最近一次变化的序号
+        self._idle = []  # 空闲的 _VersionReader
+        self._shards = ((None, None), ())  # ((主库, 读取时主库的序号), 分库文件)
+
+    def bump(self):
+        """写操作提交后调用"""
+        with self._lock:
+            self._local += 1
+
+    def current(self, database=None):
+        """返回当前版本号；指定 database 时只看这一个库，供只依赖一个库的缓存使用"""
+        main = app.config['DATABASE']
+        reader = self._checkout((os.getpid(), main))
+        try:
+            if database is not None:
+                return self._local, self._read(reader, database)
+            version = self._read(reader, main)
+            if not shard_router.enabled:
+                return self._local, version
+            loaded, shards = self._shards
+            if loaded != (main, version):
+                # 新增的分库登记在主库中，主库有修改时重新读取分库列表
+                shards = tuple(shard_router.database(row[0])
+                               for row in reader.conns[main].execute('SELECT id FROM shards'))
+                self._shards = ((main, version), shards)
+            return self._local, max([version] + [self._read(reader, shard) for shard in shards])
+        finally:
+            self._checkin(reader)
+
+    def _checkout(self, key):
+        while True:
+            try:
+                reader = self._idle.pop()
+            except IndexError:
+                return _VersionReader(key)
+            if reader.key == key:
+                return reader
+            reader.close()
+
+    def _checkin(self, reader):
+        if reader.key == (os.getpid(), app.config['DATABASE']):
+            self._idle.append(reader)
+        else:
+            reader.close()
+
+    def _read(self, reader, database):
+        conn = reader.conns.get(database)
+        if conn is None:
+            conn = reader.conns[database] = sqlite3.connect(database, check_same_thread=False)
+        value = conn.execute('PRAGMA data_version').fetchone()[0]
+        if reader.seen.get(database) != value:
+            reader.seen[database] = value
+            with self._lock:
+                self._seq += 1
+                self._changes[database] = self._seq
+        return self._changes[database]
+
+    def close(self):
+        """关闭空闲的读取连接（fork 之前调用），下次读取时重新连接"""
+        idle, self._idle = self._idle, []
+        for reader in idle:
+            reader.close()
+
+
+class VersionedCache:
+    """按数据版本失效的查询结果缓存（LRU + TTL）"""
+
+    def __init__(self, version, max_entries=256, ttl=60.0):
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get_or_load(self, key, loader):
+        """数据版本未变且未过期时返回缓存，否则调用 loader() 重新加载"""
+        version = self.version.current()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[2]
+            self._misses += 1
+        
+        # 以加载前的版本号保存，加载期间若有写入，下次读取时版本不同会重新加载
+        value = loader()
+        with self._lock:
+            self._entries[key] = (version, now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """缓存统计信息"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0,
+            }
+
+
+data_version = DataVersion()
+query_cache = VersionedCache(data_version,
+                             max_entries=app.config['QUERY_CACHE_SIZE'],
+                             ttl=app.config['QUERY_CACHE_TTL'])
+
+
+class ClassStatsCache:
+    """班级统计的进程内缓存
+
+    从 class_stats 表加载（只有班级数量那么多行，分库时并行读取各库后合并），
+    保存在 query_cache 中，数据版本变化后重新加载。
+    """
+
+    def get(self):
+        """返回 {班级: {'user_count', 'position_count', 'voter_count'}}"""
+        return query_cache.get_or_load('class_stats', self._load)
+
+    def _load(self):
+        return load_class_stats()
+
+    def class_users(self, class_name):
+        """班级人数（不含管理员）"""
+        stats = self.get().get(class_name)
+        return stats['user_count'] if stats else 0
+
+    def user_classes(self):
+        """有学生的班级列表"""
+        return [name for name, stats in self.get().items() if stats['user_count'] > 0]
+
+    def position_classes(self):
+        """设有岗位的班级列表"""
+        return [name for name, stats in self.get().items() if stats['position_count'] > 0]
+
+    def totals(self):
+        """全校汇总：学生数、班级数、岗位数、已投票人数"""
+        stats = self.get().values()
+        return {
+            'user_count': sum(s['user_count'] for s in stats),
+            'class_count': sum(1 for s in stats if s['user_count'] > 0),
+            'position_count': sum(s['position_count'] for s in stats),
+            'voted_count': sum(s['voter_count'] for s in stats),
+        }
+
+
+def load_class_stats(databases=None):
+    """读取各库（默认全部库）的 class_stats 表，合并为 {班级: {'user_count', 'position_count', 'voter_count'}}"""
+    merged = {}
+    for rows in fan_out(lambda conn: conn.execute('SELECT * FROM class_stats').fetchall(), databases):
+        for row in rows:
+            stats = merged.setdefault(row['class_name'],
+                                      {'user_count': 0, 'position_count': 0, 'voter_count': 0})
+            for key in stats:
+                stats[key] += row[key]
+    return dict(sorted(merged.items()))
+
+
+class_stats_cache = ClassStatsCache()
+
+
+class ReportSnapshots:
+    """报表快照：统计页面和导出读取的只读数据库副本
+
+    每个库的快照用 SQLite 在线备份接口一次复制完成，复制期间只持有一个短暂的读事务，
+    导出再慢也不会长时间占着实时库的读事务（WAL 检查点因此无法回收、WAL 文件持续增长）。
+    快照先写入临时文件再原子替换，文件修改时间设为开始复制的时间，即快照的数据时间；
+    各进程共用快照文件，读取时发现超过 REPORT_SNAPSHOT_MAX_AGE 才重新复制。
+    替换不影响已打开的读取连接，正在进行的导出读完的仍是同一份快照。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # 同一进程内同时只复制一个快照
+        self._stats_lock = threading.Lock()
+        self._paths = set()
+        self._refresh_count = 0
+        self._refresh_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return app.config['REPORT_SNAPSHOT_MAX_AGE'] > 0
+
+    def directory(self):
+        return app.config['REPORT_SNAPSHOT_DIR'] or os.path.splitext(app.config['DATABASE'])[0] + '_snapshots'
+
+    def path(self, database):
+        """某个库的快照文件"""
+        name = 'main.db' if database == app.config['DATABASE'] else os.path.basename(database)
+        path = os.path.join(self.directory(), name)
+        with self._stats_lock:
+            self._paths.add(path)
+        return path
+
+    def owns(self, path):
+        return path in self._paths
+
+    def acquire(self, databases):
+        """返回 (各库快照文件列表, 数据时间)，数据时间取其中最早的快照"""
+        paths, taken = [], []
+        for database in databases:
+            path = self.path(database)
+            paths.append(path)
+            taken.append(self._fresh(database, path))
+        return paths, min(taken, default=time.time())
+
+    def connect(self, path):
+        """打开快照文件的只读连接（不经过连接池，close() 即关闭）"""
+        # immutable：快照文件只会被整个替换，不会被修改，读取时不需要加锁
+        uri = 'file:' + quote(os.path.abspath(path)) + '?mode=ro&immutable=1'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _fresh(self, database, path):
+        taken = self._taken(path)
+        if taken is None or time.time() - taken > app.config['REPORT_SNAPSHOT_MAX_AGE']:
+            with self._lock:
+                # 等锁期间可能已被其他线程或进程刷新
+                taken = self._taken(path)
+                if taken is None or time.time() - taken > app.config['REPORT_SNAPSHOT_MAX_AGE']:
+                    taken = self._copy(database, path)
+        return taken
+
+    @staticmethod
+    def _taken(path):
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _copy(self, database, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        start = time.perf_counter()
+        with timed_phase('report_snapshot'):
+            src = get_pool(database).acquire()
+            try:
+                taken = time.time()
+                dst = sqlite3.connect(tmp)
+                try:
+                    src.backup(dst)
+                    # 副本改为普通日志模式，只读打开时不需要 -wal、-shm 文件
+                    dst.execute('PRAGMA journal_mode=DELETE')
+                finally:
+                    dst.close()
+                os.utime(tmp, (taken, taken))
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            finally:
+                src.close()
+        with self._stats_lock:
+            self._refresh_count += 1
+            self._refresh_seconds += time.perf_counter() - start
+        return taken
+
+    def stats(self):
+        """快照统计信息"""
+        with self._stats_lock:
+            paths = sorted(self._paths)
+            count = self._refresh_count
+            seconds = self._refresh_seconds
+        snapshots = {}
+        now = time.time()
+        for path in paths:
+            taken = self._taken(path)
+            if taken is not None:
+                snapshots[os.path.basename(path)] = {'age_seconds': round(now - taken, 3),
+                                                     'size': os.path.getsize(path)}
+        return {
+            'enabled': self.enabled,
+            'max_age_seconds': app.config['REPORT_SNAPSHOT_MAX_AGE'],
+            'refresh_count': count,
+            'refresh_avg_ms': round(seconds / count * 1000, 3) if count else 0,
+            'snapshots': snapshots,
+        }
+
+
+report_snapshots = ReportSnapshots()
+
+
+class PositionCatalog:
+    """进程内的岗位目录：各班级按序号排列的岗位，以及岗位 id → 岗位的映射
+
+    岗位一学期只改几次，投票页面和投票校验都从这里读取。本进程增删、导入岗位后调用
+    invalidate()；其他进程的修改由 class_versions 中的班级岗位版本发现：班级所在库的数据版本
+    变化后，下次访问该班级时按主键读取它的版本，版本不变就继续使用。
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self._lock = threading.Lock()
+        self._classes = {}  # 班级 → (岗位版本, 岗位列表, {岗位 id: 岗位})
+        self._checked = {}  # 班级 → 最近一次确认有效时 (所在库, 该库的数据版本)
+        self._loads = 0
+        self._checks = 0
+
+    def load_all(self):
+        """加载全部班级的岗位（启动时调用，分库时并行读取各库）"""
+        databases = shard_router.databases()
+        # 先读版本再读岗位：两次读取之间若有修改，保存的版本偏旧，下次检查时会重新加载
+        checked = [(database, self.version.current(database)) for database in databases]
+
+        def load(conn):
+            versions = {row['class_name']: row['positions_version']
+                        for row in conn.execute('SELECT class_name, positions_version FROM class_versions')}
+            rows = conn.execute('SELECT * FROM positions ORDER BY class_name, sort_order, id').fetchall()
+            return versions, rows
+
+        classes, classes_checked = {}, {}
+        for version, (versions, rows) in zip(checked, fan_out(load, databases)):
+            grouped = {}
+            for row in rows:
+                grouped.setdefault(row['class_name'], []).append(dict(row))
+            for class_name, positions in grouped.items():
+                classes[class_name] = self._entry(versions.get(class_name, 0), positions)
+                classes_checked[class_name] = version
+        with self._lock:
+            self._classes = classes
+            self._checked = classes_checked
+            self._loads += 1
+
+    def positions(self, class_name):
+        """班级的岗位列表（按序号排列的 dict）"""
+        return self._get(class_name)[1]
+
+    def get(self, class_name, position_id):
+        """岗位属于该班级时返回岗位，否则返回 None"""
+        return self._get(class_name)[2].get(position_id)
+
+    def invalidate(self, class_name=None):
+        """岗位修改提交后调用，class_name 为 None 时清空整个目录"""
+        with self._lock:
+            if class_name is None:
+                self._checked.clear()
+                self._classes.clear()
+            else:
+                self._checked.pop(class_name, None)
+                self._classes.pop(class_name, None)
+
+    @staticmethod
+    def _entry(positions_version, positions):
+        return positions_version, tuple(positions), {p['id']: p for p in positions}
+
+    def _get(self, class_name):
+        database = shard_router.database_for_class(class_name)
+        version = (database, self.version.current(database))
+        with self._lock:
+            entry = self._classes.get(class_name)
+            if entry is not None and self._checked.get(class_name) == version:
+                return entry
+
+        # 请求内复用请求的连接；预热和后台线程没有应用上下文，从连接池取出，用完归还
+        owned = not has_app_context()
+        conn = get_pool(database).acquire() if owned else get_db(database)
+        try:
+            c = conn.cursor()
+            c.execute('SELECT positions_version FROM class_versions WHERE class_name = ?', (class_name,))
+            row = c.fetchone()
+            positions_version = row['positions_version'] if row else 0
+            if entry is None or entry[0] != positions_version:
+                c.execute('SELECT * FROM positions WHERE class_name = ? ORDER BY sort_order, id', (class_name,))
+                entry = self._entry(positions_version, [dict(row) for row in c.fetchall()])
+                loaded = True
+            else:
+                loaded = False
+            c.close()
+        finally:
+            if owned:
+                conn.close()
+
+        with self._lock:
+            self._classes[class_name] = entry
+            self._checked[class_name] = version
+            self._checks += 1
+            self._loads += loaded
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                'classes': len(self._classes),
+                'positions': sum(len(entry[1]) for entry in self._classes.values()),
+                'checks': self._checks,
+                'loads': self._loads,
+            }
+
+
+position_catalog = PositionCatalog(data_version)
+
+@app.cli.command('rebuild-tallies')
+def rebuild_tallies_command():
+    """根据投票记录重建岗位计票表、班级统计表和已投票标记（分库时逐个库重建）"""
+    count = class_count = 0
+    for database in shard_router.databases():
+        conn = get_db(database)
+        count += rebuild_tallies(conn)
+        class_count += rebuild_class_stats(conn)
+        conn.close()
+    print(f'已重建 {count} 个岗位的计票、{class_count} 个班级的统计')
+
+@app.cli.command('verify-tallies')
+def verify_tallies_command():
+    """校验岗位计票表、班级统计表和已投票标记是否与原始记录一致（分库时逐个库校验）"""
+    mismatches, class_mismatches, user_mismatches = [], [], []
+    for database in shard_router.databases():
+        conn = get_db(database)
+        mismatches += verify_tallies(conn)
+        class_mismatches += verify_class_stats(conn)
+        user_mismatches += verify_participation(conn)
+        conn.close()
+    if not mismatches and not class_mismatches and not user_mismatches:
+        print('计票表、班级统计表、已投票标记与原始记录一致')
+        return
+    for row in mismatches:
+        print(f"岗位 {row['position_id']}：总票数 {row['actual_total']}（应为 {row['expected_total']}），"
+              f"满意票数 {row['actual_satisfied']}（应为 {row['expected_satisfied']}）")
+    for row in class_mismatches:
+        print(f"班级 {row['class_name']}：人数 {row['actual_users']}（应为 {row['expected_users']}），"
+              f"岗位数 {row['actual_positions']}（应为 {row['expected_positions']}），"
+              f"已投票 {row['actual_voters']}（应为 {row['expected_voters']}）")
+    for row in user_mismatches:
+        print(f"学生 {row['username']}：已投票标记 {row['actual']}（应为 {row['expected']}）")
+    raise SystemExit(1)
+
+@app.cli.command('replay-votes')
+def replay_votes_command():
+    """按投票事件日志重建投票记录、岗位计票表和班级统计表（分库时逐个库重放）"""
+    events = count = 0
+    start = time.perf_counter()
+    for database in shard_router.databases():
+        conn = get_db(database)
+        database_events, database_count = replay_vote_log(conn)
+        events += database_events
+        count += database_count
+        conn.close()
+    elapsed = time.perf_counter() - start
+    print(f'已重放 {events} 个事件，重建 {count} 张投票，用时 {elapsed:.2f} 秒'
+          f'（{events / elapsed if elapsed else 0:.0f} 个事件/秒）')
+
+@app.cli.command('verify-votes')
+def verify_votes_command():
+    """校验投票记录是否与事件日志一致（分库时逐个库校验）"""
+    extra = missing = 0
+    for database in shard_router.databases():
+        conn = get_db(database)
+        database_extra, database_missing = verify_vote_log(conn)
+        extra += database_extra
+        missing += database_missing
+        conn.close()
+    if not extra and not missing:
+        print('投票记录与事件日志一致')
+        return
+    print(f'投票记录与事件日志不一致：{extra} 张投票不在日志中或票面不同，日志中有 {missing} 张投票缺失或不同，'
+          f'可运行 flask replay-votes 重建')
+    raise SystemExit(1)
+
+# 学生的请求使用登录时记录的分库
+@app.before_request
+def route_to_shard():
+    shard_id = session.get('shard_id')
+    if shard_id:
+        use_shard(shard_router.database(shard_id))
 
 # 认证装饰器
 def login_required(f):
@@ -144,6 +2165,266 @@ def get_user_info():
         }
     return None
 
+# 条件请求（ETag）
+def template_build_id():
+    """app.py 和模板的最后修改时间，部署新版本后旧的 ETag 全部失效"""
+    paths = [os.path.abspath(__file__)]
+    for root, _, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+        paths.extend(os.path.join(root, name) for name in files)
+    return max(os.stat(path).st_mtime_ns for path in paths)
+
+PAGE_BUILD_ID = template_build_id()
+
+def page_etag(version):
+    return hashlib.blake2b(repr((PAGE_BUILD_ID, version)).encode(), digest_size=16).hexdigest()
+
+def conditional_page(validator):
+    """按校验值处理 If-None-Match 的装饰器
+
+    validator() 返回页面内容所依赖的数据版本，返回 None 时照常处理。版本相同时直接返回 304，
+    不查询数据、不渲染模板。页面只允许浏览器缓存，每次使用前都要重新验证。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # 待显示的闪现消息会改变页面内容，而且要渲染后才会从会话中清除
+            version = None if session.get('_flashes') else validator()
+            if version is None:
+                return f(*args, **kwargs)
+
+            # 先取版本再渲染：渲染期间数据若有变化，下次请求版本不同，只是多渲染一次
+            etag = page_etag(version)
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return decorated_function
+    return decorator
+
+def vote_page_version():
+    """投票页面的版本：本班岗位的版本 + 本人投票的版本，两次主键查找"""
+    user_info = get_user_info()
+    if user_info['is_admin']:
+        return None
+    c = get_db().cursor()
+    c.execute('''SELECT (SELECT vote_version FROM users WHERE id = ?) as vote_version,
+                        (SELECT positions_version FROM class_versions WHERE class_name = ?) as positions_version''',
+              (user_info['id'], user_info['class_name']))
+    row = c.fetchone()
+    c.close()
+    return ('vote', user_info['id'], user_info['name'], user_info['class_name'],
+            row['vote_version'], row['positions_version'])
+
+def admin_page_version():
+    """管理页面的版本：各库的数据代数（见 migrate_data_generation），每个库一次主键查找"""
+    generations = fan_out(lambda conn: conn.execute(
+        'SELECT generation FROM data_generation WHERE id = 1').fetchone()[0])
+    return ('admin', tuple(generations), session['user_id'], request.full_path)
+
+def statistics_page_version():
+    """统计页面的版本：管理页面的版本 + 报表快照的数据时间
+
+    启用报表快照时页面显示快照中的数据和数据时间，快照刷新后页面随之变化。
+    """
+    version = admin_page_version()
+    if report_snapshots.enabled and closed_round(request.args.get('round', type=int)) is None:
+        _, as_of = report_snapshots.acquire(statistics_databases(request.args.get('class', '')))
+        version += (as_of,)
+    return version
+
+# 密码哈希与登录校验
+def password_hash_options():
+    """generate_password_hash 的参数：只在配置了 PASSWORD_HASH_METHOD 时指定方法"""
+    method = app.config['PASSWORD_HASH_METHOD']
+    return {'method': method} if method else {}
+
+def hash_password(password):
+    """按配置的方法计算密码哈希"""
+    return generate_password_hash(password, **password_hash_options())
+
+_hash_method_prefixes = {}
+
+def password_hash_outdated(password_hash):
+    """已保存的哈希是否与当前配置的方法、参数不同"""
+    target = _hash_method_prefixes.get(app.config['PASSWORD_HASH_METHOD'])
+    if target is None:
+        # 配置可以是简写（如 scrypt）或不设置，计算一次得到完整的方法前缀
+        target = hash_password('').split('$', 1)[0]
+        _hash_method_prefixes[app.config['PASSWORD_HASH_METHOD']] = target
+    return password_hash.split('$', 1)[0] != target
+
+
+class VerifierBusy(Exception):
+    """登录校验排队已满或等待超时"""
+
+
+class PasswordVerifier:
+    """登录密码校验的并发闸门
+
+    密码哈希刻意消耗 CPU，大量学生同时登录时会拖慢所有页面。
+    同时校验的数量不超过 concurrency，排队不超过 max_queue，
+    超出或等待超时立即拒绝，由调用方返回 503。
+    """
+
+    def __init__(self, concurrency, max_queue, queue_timeout):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+        self._verified = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._rehashed = 0
+        self._rehash_skipped = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._hash_total = 0.0
+        self._hash_max = 0.0
+
+    def run(self, func, *args, wait=True):
+        """在并发限制内执行 func(*args)，排队满或超时抛出 VerifierBusy
+
+        wait 为 False 时不排队，没有空闲名额立即抛出 VerifierBusy（不计入拒绝次数）。
+        """
+        if not wait:
+            if not self._slots.acquire(blocking=False):
+                raise VerifierBusy('登录人数过多，请稍后重试')
+            with self._lock:
+                self._in_flight += 1
+        else:
+            self._wait_for_slot()
+        
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._slots.release()
+            with self._lock:
+                self._in_flight -= 1
+                self._verified += 1
+                self._hash_total += elapsed
+                self._hash_max = max(self._hash_max, elapsed)
+
+    def _wait_for_slot(self):
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self._rejected += 1
+                raise VerifierBusy('登录人数过多，请稍后重试')
+            self._waiting += 1
+        start = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._waiting -= 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            if not acquired:
+                self._timeouts += 1
+            else:
+                self._in_flight += 1
+        if not acquired:
+            raise VerifierBusy('登录人数过多，请稍后重试')
+
+    def record_rehash(self):
+        with self._lock:
+            self._rehashed += 1
+
+    def record_rehash_skipped(self):
+        with self._lock:
+            self._rehash_skipped += 1
+
+    def stats(self):
+        """校验统计信息"""
+        with self._lock:
+            count = self._verified
+            waits = count + self._timeouts
+            return {
+                'concurrency': self.concurrency,
+                'max_queue': self.max_queue,
+                'queue_length': self._waiting,
+                'in_flight': self._in_flight,
+                'verified': count,
+                'rejected': self._rejected,
+                'timeouts': self._timeouts,
+                'rehashed': self._rehashed,
+                'rehash_skipped': self._rehash_skipped,
+                'wait_avg_ms': round(self._wait_total / waits * 1000, 3) if waits else 0,
+                'wait_max_ms': round(self._wait_max * 1000, 3),
+                'hash_avg_ms': round(self._hash_total / count * 1000, 3) if count else 0,
+                'hash_max_ms': round(self._hash_max * 1000, 3),
+            }
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+def get_verifier():
+    """获取当前进程的登录校验闸门"""
+    global _verifier
+    verifier = _verifier
+    if verifier is None or verifier.pid != os.getpid():
+        with _verifier_lock:
+            verifier = _verifier
+            if verifier is None or verifier.pid != os.getpid():
+                verifier = PasswordVerifier(
+                    concurrency=app.config['LOGIN_VERIFY_CONCURRENCY'],
+                    max_queue=app.config['LOGIN_VERIFY_MAX_QUEUE'],
+                    queue_timeout=app.config['LOGIN_VERIFY_QUEUE_TIMEOUT'],
+                )
+                _verifier = verifier
+    return verifier
+
+def verify_login(user, password):
+    """校验密码；开启 LOGIN_REHASH 时顺带把旧参数的哈希升级为当前配置"""
+    verifier = get_verifier()
+    if not verifier.run(check_password_hash, user['password_hash'], password):
+        return False
+    
+    if app.config['LOGIN_REHASH'] and password_hash_outdated(user['password_hash']):
+        # 升级哈希不是登录所必需的：没有空闲名额时不排队，留到下次登录，不让已通过校验的用户登录失败
+        try:
+            new_hash = verifier.run(hash_password, password, wait=False)
+        except VerifierBusy:
+            verifier.record_rehash_skipped()
+            return True
+        conn = get_db()
+        conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user['id']))
+        conn.commit()
+        verifier.record_rehash()
+    return True
+
+# 列表分页
+def encode_cursor(values):
+    """把上一页最后一行的排序键编码为分页游标"""
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token, size):
+    """解析分页游标，无效时返回 None（即从第一页开始）"""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+def like_prefix(text):
+    """构造前缀匹配的 LIKE 模式，转义通配符"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
 # 路由定义
 
 @app.route('/')
@@ -168,18 +2449,30 @@ def login():
             flash('请输入用户名和密码', 'error')
             return render_template('login.html')
         
+        # 分库时先在主库的账号目录中找到学生所在的分库，目录中没有的账号（管理员）在主库
+        shard_id = 0
+        if shard_router.enabled:
+            shard_id = find_user_shard(get_db(app.config['DATABASE']), username) or 0
+            use_shard(shard_router.database(shard_id))
         conn = get_db()
         c = conn.cursor()
         c.execute('SELECT * FROM users WHERE username = ?', (username,))
         user = c.fetchone()
         conn.close()
         
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            verified = user is not None and verify_login(user, password)
+        except VerifierBusy as e:
+            flash(str(e), 'error')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
+        
+        if verified:
             # 设置 session
             session['user_id'] = user['id']
             session['name'] = user['name']
             session['class_name'] = user['class_name']
             session['is_admin'] = bool(user['is_admin'])
+            session['shard_id'] = shard_id
             session.permanent = True
             
             flash(f'欢迎回来，{user["name"]}！', 'success')
@@ -207,29 +2500,332 @@ def logout():
 
 @app.route('/vote')
 @login_required
+@conditional_page(vote_page_version)
 def vote():
     """投票页面 - 显示本班级的班委"""
     user_info = get_user_info()
     if user_info['is_admin']:
         return redirect(url_for('admin_dashboard'))
     
+    # 本班岗位来自岗位目录，数据库只查本人的投票
     conn = get_db()
     c = conn.cursor()
-    
-    # 获取用户班级的所有班委岗位，按序号排序
-    c.execute('''SELECT p.*, 
-                 CASE WHEN v.id IS NOT NULL THEN v.is_satisfied ELSE NULL END as user_vote
-                 FROM positions p
-                 LEFT JOIN votes v ON p.id = v.position_id AND v.user_id = ?
-                 WHERE p.class_name = ?
-                 ORDER BY p.sort_order, p.id''', 
-              (user_info['id'], user_info['class_name']))
-    positions = c.fetchall()
-    
+    c.execute('SELECT position_id, is_satisfied FROM votes WHERE user_id = ?', (user_info['id'],))
+    user_votes = {row['position_id']: row['is_satisfied'] for row in c.fetchall()}
     conn.close()
     
+    positions = [dict(position, user_vote=user_votes.get(position['id']))
+                 for position in position_catalog.positions(user_info['class_name'])]
+    
     return render_template('index.html', positions=positions, user_info=user_info)
 
+# 投票写入
+class VoteQueueFull(Exception):
+    """投票写入队列已满"""
+
+
+class VoteWriteError(Exception):
+    """投票未能在限定时间内写入数据库"""
+
+
+class _PendingVotes:
+    """队列中的一组投票，提交完成后通知等待的请求"""
+
+    __slots__ = ('rows', 'round_id', 'seq', 'done', 'error')
+
+    def __init__(self, rows, round_id=None):
+        self.rows = rows
+        self.round_id = round_id  # 投票时进行中的轮次
+        self.seq = 0  # 入队序号
+        self.done = threading.Event()
+        self.error = None
+
+
+class VoteWriter:
+    """投票写入队列
+
+    请求线程只把投票放入内存队列，由单个后台线程按数量和时间攒批，
+    在一个事务中提交（group commit），避免大量请求同时争抢 SQLite 写锁。
+    分库时按投票人所在的库分组，每个库一个事务。
+    """
+
+    def __init__(self, max_pending=10000, batch_size=500, flush_interval=0.05, retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        # 写完一批后通知 flush()：已入队的最大序号和已写完的最大序号
+        self._progress = threading.Condition(self._lock)
+        self._last_seq = 0
+        self._done_seq = 0
+        # 入队与 stop() 共用这把锁：stop() 返回后不会再有投票进入队列
+        self._submit_lock = threading.Lock()
+        self._stopping = False
+        self._enqueued = 0
+        self._rejected = 0
+        self._committed_rows = 0
+        self._batches = 0
+        self._max_batch = 0
+        self._failed_rows = 0
+        self._conns = {}  # 数据库文件 → 写入连接
+        self._thread = threading.Thread(target=self._run, name='vote-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, rows, timeout=2.0, round_id=None):
+        """放入队列，队列满时最多等待 timeout 秒，仍然满则抛出 VoteQueueFull；已停止时直接拒绝
+
+        round_id 为投票时进行中的轮次，写入时该轮次已在投票人所在的库冻结则拒绝。
+        """
+        pending = _PendingVotes(rows, round_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # 队列满时持锁等待的只有一个请求，其余请求在锁上等待，总等待时间同样不超过 timeout
+        if not self._submit_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return self._reject()
+        try:
+            if self._stopping:
+                raise VoteQueueFull('投票队列已关闭')
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            pending.seq = self._last_seq + 1
+            self._queue.put(pending, timeout=remaining)
+            with self._lock:
+                self._enqueued += 1
+                self._last_seq = pending.seq
+        except queue.Full:
+            return self._reject()
+        finally:
+            self._submit_lock.release()
+        return pending
+
+    def _reject(self):
+        with self._lock:
+            self._rejected += 1
+        raise VoteQueueFull('系统繁忙，请稍后重试')
+
+    def _collect(self):
+        """取出一批待写入的投票，按数量或时间截止"""
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        count = len(first.rows)
+        deadline = time.monotonic() + self.flush_interval
+        while count < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            count += len(item.rows)
+        return batch
+
+    def _commit(self, batch):
+        groups = {}
+        for item in batch:
+            if item.rows:
+                # 同一组投票来自同一个学生，都写入该学生所在的库
+                groups.setdefault(shard_router.database_for_id(item.rows[0][0]), []).append(item)
+        for database, items in groups.items():
+            self._commit_group(database, items)
+        # 空的组没有要写入的投票，在它之前的投票都写完后完成
+        for item in batch:
+            if not item.rows:
+                item.done.set()
+        self._mark_done(batch[-1].seq)
+
+    def _mark_done(self, seq):
+        # 队列先进先出，序号不超过 seq 的投票都已写完（或已失败）
+        with self._progress:
+            self._done_seq = max(self._done_seq, seq)
+            self._progress.notify_all()
+
+    def _commit_group(self, database, items):
+        rows = [row for item in items for row in item.rows]
+        error = None if database is not None else VoteWriteError('投票人所在的分库不存在')
+        closed = set()
+        for attempt in range(self.retries if database is not None else 0):
+            conn = self._conns.get(database)
+            try:
+                # 写入线程使用独立连接，不与等待结果的请求线程争抢连接池
+                if conn is None:
+                    conn = self._conns[database] = get_pool(database).connect()
+                # 在写事务中检查轮次：结束轮次时其他进程队列里还没写入的投票不会计入下一轮
+                conn.execute('BEGIN IMMEDIATE')
+                closed = closed_round_ids(conn, {item.round_id for item in items})
+                rows = [row for item in items if item.round_id not in closed for row in item.rows]
+                write_votes(conn, rows)
+                conn.commit()
+                data_version.bump()
+                publish_statistics(row[1] for row in rows)
+                error = None
+                break
+            except Exception as e:
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+                error = e
+                time.sleep(0.05 * (attempt + 1))
+        late = [item for item in items if item.round_id in closed] if error is None else []
+        late_rows = sum(len(item.rows) for item in late)
+        with self._lock:
+            if error is None:
+                self._committed_rows += len(rows)
+                self._batches += 1
+                self._max_batch = max(self._max_batch, len(rows))
+                self._failed_rows += late_rows
+            else:
+                self._failed_rows += len(rows)
+        if error is not None:
+            app.logger.error('投票批量写入失败（%d 条）：%s', len(rows), error)
+        if late:
+            app.logger.warning('%d 条投票写入时所在轮次已结束，未计入', late_rows)
+        for item in items:
+            item.error = VoteWriteError(ROUND_CLOSED_MESSAGE) if item in late else error
+            item.done.set()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                self._commit(batch)
+            elif self._stopping:
+                break
+        for conn in self._conns.values():
+            conn.discard()
+        self._conns = {}
+
+    def flush(self, timeout=None):
+        """等待此刻已入队的投票全部写完，返回是否在 timeout 秒内完成
+
+        只等待写入线程的进度，不向队列放入标记，队列已满或正在停止时同样可用。
+        """
+        with self._progress:
+            target = self._last_seq
+            return self._progress.wait_for(lambda: self._done_seq >= target, timeout)
+
+    def stop(self, timeout=30):
+        """停止写入线程，退出前写完队列中的所有投票
+
+        写入线程未能在 timeout 秒内写完时，仍在队列中的投票不再写入，以错误通知等待的请求。
+        """
+        with self._submit_lock:
+            self._stopping = True
+        self._thread.join(timeout)
+        error = VoteWriteError('服务正在停止，投票未能写入，请重试')
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._failed_rows += len(item.rows)
+            item.error = error
+            item.done.set()
+            self._mark_done(item.seq)
+
+    def stats(self):
+        """队列统计信息"""
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_pending': self._queue.maxsize,
+                'enqueued': self._enqueued,
+                'rejected': self._rejected,
+                'committed_rows': self._committed_rows,
+                'failed_rows': self._failed_rows,
+                'batches': self._batches,
+                'avg_batch_size': round(self._committed_rows / self._batches, 2) if self._batches else 0,
+                'max_batch_size': self._max_batch,
+            }
+
+
+_vote_writer = None
+_vote_writer_lock = threading.Lock()
+
+def get_vote_writer():
+    """获取当前进程的投票写入队列，未启用时返回 None"""
+    global _vote_writer
+    if not app.config['VOTE_QUEUE_ENABLED']:
+        return None
+    writer = _vote_writer
+    if writer is None or writer.pid != os.getpid():
+        with _vote_writer_lock:
+            writer = _vote_writer
+            if writer is None or writer.pid != os.getpid():
+                writer = VoteWriter(
+                    max_pending=app.config['VOTE_QUEUE_MAX_PENDING'],
+                    batch_size=app.config['VOTE_QUEUE_BATCH_SIZE'],
+                    flush_interval=app.config['VOTE_QUEUE_FLUSH_INTERVAL'],
+                )
+                _vote_writer = writer
+    return writer
+
+@atexit.register
+def stop_vote_writer():
+    """进程退出时写完队列中的投票"""
+    writer = _vote_writer
+    if writer is not None and writer.pid == os.getpid():
+        writer.stop()
+
+def write_votes(conn, rows):
+    """写入投票记录 [(user_id, position_id, is_satisfied), ...]，由调用方提交事务"""
+    # 使用 UPSERT 而不是 INSERT OR REPLACE：REPLACE 删除旧行时不会触发删除触发器，计票表会失准
+    conn.executemany('''INSERT INTO votes (user_id, position_id, is_satisfied) 
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(user_id, position_id) DO UPDATE SET
+                            is_satisfied = excluded.is_satisfied,
+                            created_at = CURRENT_TIMESTAMP''', rows)
+
+ROUND_CLOSED_MESSAGE = '本轮投票已结束，请刷新页面后重新投票'
+
+def open_round_id():
+    """进行中轮次的编号（按全局数据版本缓存），投票时记下，写入时据此拒绝已结束轮次的投票"""
+    return query_cache.get_or_load('open_round_id',
+                                   lambda: current_round(get_db(app.config['DATABASE']))['id'])
+
+def closed_round_ids(conn, round_ids):
+    """round_ids 中已在本库冻结的轮次
+
+    在写事务中调用：冻结（freeze_round）同样在写事务中进行，检查与随后的写入之间不会插入冻结。
+    """
+    round_ids = [round_id for round_id in round_ids if round_id is not None]
+    if not round_ids:
+        return set()
+    placeholders = ','.join('?' * len(round_ids))
+    return {row[0] for row in conn.execute(
+        f'SELECT round_id FROM round_closures WHERE round_id IN ({placeholders})', round_ids)}
+
+def save_votes(conn, user_id, votes):
+    """保存一组投票 [(position_id, is_satisfied), ...]
+
+    启用写入队列时交给后台线程批量提交，否则直接在当前连接的一个事务中写入。
+    """
+    rows = [(user_id, position_id, is_satisfied) for position_id, is_satisfied in votes]
+    round_id = open_round_id()
+    writer = get_vote_writer()
+    if writer is None:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if closed_round_ids(conn, [round_id]):
+                raise VoteWriteError(ROUND_CLOSED_MESSAGE)
+            write_votes(conn, rows)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        data_version.bump()
+        publish_statistics(position_id for position_id, _ in votes)
+        return
+    
+    pending = writer.submit(rows, timeout=app.config['VOTE_QUEUE_PUT_TIMEOUT'], round_id=round_id)
+    if app.config['VOTE_QUEUE_ACK'] == 'flushed':
+        if not pending.done.wait(app.config['VOTE_QUEUE_FLUSH_TIMEOUT']):
+            raise VoteWriteError('投票处理超时，请刷新页面确认结果')
+        if pending.error is not None:
+            raise VoteWriteError(str(pending.error))
+
 @app.route('/submit_vote', methods=['POST'])
 @login_required
 def submit_vote():
@@ -244,24 +2840,85 @@ def submit_vote():
     if not position_id or is_satisfied is None:
         return jsonify({'success': False, 'message': '参数错误'})
     
+    try:
+        position_id = int(position_id)
+        is_satisfied = int(is_satisfied)
+    except ValueError:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
     conn = get_db()
-    c = conn.cursor()
     
     try:
         # 验证岗位是否属于用户班级
-        c.execute('SELECT class_name FROM positions WHERE id = ?', (position_id,))
-        position = c.fetchone()
-        
-        if not position or position['class_name'] != user_info['class_name']:
+        if position_catalog.get(user_info['class_name'], position_id) is None:
             return jsonify({'success': False, 'message': '无权对此岗位投票'})
         
         # 插入或更新投票记录
-        c.execute('''INSERT OR REPLACE INTO votes (user_id, position_id, is_satisfied) 
-                     VALUES (?, ?, ?)''', 
-                  (user_info['id'], position_id, int(is_satisfied)))
-        conn.commit()
+        save_votes(conn, user_info['id'], [(position_id, is_satisfied)])
         
         return jsonify({'success': True, 'message': '投票成功！'})
+    except VoteQueueFull as e:
+        return jsonify({'success': False, 'message': str(e)}), 503, {'Retry-After': '1'}
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'投票失败：{str(e)}'})
+    finally:
+        conn.close()
+
+@app.route('/submit_ballot', methods=['POST'])
+@login_required
+def submit_ballot():
+    """一次提交整张选票
+
+    请求体为 JSON：{"votes": {"<position_id>": 0 或 1, ...}}，
+    所有岗位用一条查询校验，并在同一个事务中写入。
+    """
+    user_info = get_user_info()
+    if user_info['is_admin']:
+        return jsonify({'success': False, 'message': '管理员不能参与投票'})
+    
+    data = request.get_json(silent=True) or {}
+    ballot = data.get('votes')
+    if not isinstance(ballot, dict) or not ballot:
+        return jsonify({'success': False, 'message': '参数错误'})
+    
+    # 解析选票，记录每个岗位的结果
+    results = {}
+    votes = []
+    for key, value in ballot.items():
+        try:
+            position_id = int(key)
+            is_satisfied = int(value)
+        except (TypeError, ValueError):
+            results[str(key)] = {'success': False, 'message': '参数错误'}
+            continue
+        if is_satisfied not in (0, 1):
+            results[str(key)] = {'success': False, 'message': '参数错误'}
+            continue
+        votes.append((position_id, is_satisfied))
+    
+    conn = get_db()
+    
+    try:
+        # 按岗位目录验证岗位是否属于用户班级
+        accepted = []
+        for position_id, is_satisfied in votes:
+            if position_catalog.get(user_info['class_name'], position_id) is not None:
+                accepted.append((position_id, is_satisfied))
+            else:
+                results[str(position_id)] = {'success': False, 'message': '无权对此岗位投票'}
+        
+        if accepted:
+            save_votes(conn, user_info['id'], accepted)
+            for position_id, _ in accepted:
+                results[str(position_id)] = {'success': True, 'message': '投票成功！'}
+        
+        return jsonify({
+            'success': len(accepted) == len(ballot),
+            'message': f'已提交 {len(accepted)} 项投票' if accepted else '没有可提交的投票',
+            'results': results
+        })
+    except VoteQueueFull as e:
+        return jsonify({'success': False, 'message': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'success': False, 'message': f'投票失败：{str(e)}'})
     finally:
@@ -269,63 +2926,64 @@ def submit_vote():
 
 # 管理员路由
 
+def dashboard_stats():
+    """仪表板数据"""
+    stats = class_stats_cache.totals()
+    user_count = stats['user_count']
+    stats['vote_rate'] = f"{(stats['voted_count'] / user_count * 100):.1f}" if user_count > 0 else "0"
+    return stats
+
 @app.route('/admin')
 @admin_required
+@conditional_page(admin_page_version)
 def admin_dashboard():
     """管理员仪表板"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # 统计数据
-    c.execute('SELECT COUNT(*) as count FROM users WHERE is_admin = 0')
-    user_count = c.fetchone()['count']
-    
-    c.execute('SELECT COUNT(DISTINCT class_name) as count FROM users WHERE is_admin = 0')
-    class_count = c.fetchone()['count']
-    
-    c.execute('SELECT COUNT(*) as count FROM positions')
-    position_count = c.fetchone()['count']
-    
-    c.execute('SELECT COUNT(DISTINCT user_id) as count FROM votes')
-    voted_count = c.fetchone()['count']
-    
-    conn.close()
-    
-    stats = {
-        'user_count': user_count,
-        'class_count': class_count,
-        'position_count': position_count,
-        'voted_count': voted_count,
-        'vote_rate': f"{(voted_count / user_count * 100):.1f}" if user_count > 0 else "0"
-    }
+    # 统计数据（来自班级统计缓存）
+    stats = query_cache.get_or_load('dashboard', dashboard_stats)
     
     return render_template('admin/dashboard.html', stats=stats)
 
 @app.route('/admin/users')
 @admin_required
+@conditional_page(admin_page_version)
 def admin_users():
     """用户管理页面"""
     class_filter = request.args.get('class', '')
-    
-    conn = get_db()
-    c = conn.cursor()
+    search = request.args.get('q', '').strip()
+    cursor = decode_cursor(request.args.get('after', ''), 3)
+    page_size = app.config['ADMIN_PAGE_SIZE']
     
     # 获取所有班级列表
-    c.execute('SELECT DISTINCT class_name FROM users WHERE is_admin = 0 ORDER BY class_name')
-    classes = [row['class_name'] for row in c.fetchall()]
+    classes = class_stats_cache.user_classes()
     
-    # 获取用户列表
+    # 获取用户列表：按 (班级, 姓名, id) 键集分页，只读取一页
+    conditions = ['is_admin = 0']
+    params = []
     if class_filter:
-        c.execute('SELECT * FROM users WHERE is_admin = 0 AND class_name = ? ORDER BY name', 
-                  (class_filter,))
-    else:
-        c.execute('SELECT * FROM users WHERE is_admin = 0 ORDER BY class_name, name')
+        conditions.append('class_name = ?')
+        params.append(class_filter)
+    if search:
+        conditions.append("(name LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\')")
+        params += [like_prefix(search)] * 2
+    if cursor:
+        conditions.append('(class_name, name, id) > (?, ?, ?)')
+        params += cursor
+    # 指定班级时只查所在的库，否则各库各取一页后归并
+    databases = [shard_router.database_for_class(class_filter)] if class_filter else None
+    users = read_shards(f'''SELECT * FROM users WHERE {' AND '.join(conditions)}
+                           ORDER BY class_name, name, id LIMIT ?''', params + [page_size + 1],
+                        key=lambda row: (row['class_name'], row['name'], row['id']),
+                        limit=page_size + 1, databases=databases)
     
-    users = c.fetchall()
-    conn.close()
+    next_cursor = None
+    if len(users) > page_size:
+        users = users[:page_size]
+        last = users[-1]
+        next_cursor = encode_cursor([last['class_name'], last['name'], last['id']])
     
     return render_template('admin/users.html', users=users, classes=classes, 
-                         current_class=class_filter)
+                         current_class=class_filter, search=search,
+                         next_cursor=next_cursor, is_first_page=cursor is None)
 
 @app.route('/admin/users/add', methods=['POST'])
 @admin_required
@@ -340,22 +2998,19 @@ def admin_add_user():
         flash('所有字段都必须填写', 'error')
         return redirect(url_for('admin_users'))
     
-    conn = get_db()
-    c = conn.cursor()
-    
     try:
-        password_hash = generate_password_hash(password)
-        c.execute('''INSERT INTO users (name, class_name, username, password_hash) 
-                     VALUES (?, ?, ?, ?)''', 
-                  (name, class_name, username, password_hash))
-        conn.commit()
-        flash('用户添加成功', 'success')
-    except sqlite3.IntegrityError:
-        flash('用户名已存在', 'error')
+        user = (name, class_name, username, hash_password(password))
+        if shard_router.enabled:
+            failed = insert_sharded_users([user])
+        else:
+            failed = insert_users(get_db(), [user])
+        data_version.bump()
+        if failed:
+            flash('用户名已存在', 'error')
+        else:
+            flash('用户添加成功', 'success')
     except Exception as e:
         flash(f'添加失败：{str(e)}', 'error')
-    finally:
-        conn.close()
     
     return redirect(url_for('admin_users'))
 
@@ -363,17 +3018,25 @@ def admin_add_user():
 @admin_required
 def admin_delete_user(user_id):
     """删除用户"""
-    conn = get_db()
+    database = shard_router.database_for_id(user_id)
+    if database is None:
+        flash('用户不存在或无法删除', 'error')
+        return redirect(url_for('admin_users'))
+    conn = get_db(database)
     c = conn.cursor()
     
     try:
         # 删除用户的投票记录
         c.execute('DELETE FROM votes WHERE user_id = ?', (user_id,))
         # 删除用户
-        c.execute('DELETE FROM users WHERE id = ? AND is_admin = 0', (user_id,))
+        c.execute('DELETE FROM users WHERE id = ? AND is_admin = 0 RETURNING username', (user_id,))
+        deleted = c.fetchall()
         conn.commit()
+        data_version.bump()
+        if deleted and database != app.config['DATABASE']:
+            release_usernames(get_db(app.config['DATABASE']), [row['username'] for row in deleted])
         
-        if c.rowcount > 0:
+        if deleted:
             flash('用户删除成功', 'success')
         else:
             flash('用户不存在或无法删除', 'error')
@@ -384,6 +3047,142 @@ def admin_delete_user(user_id):
     
     return redirect(url_for('admin_users'))
 
+# 批量导入用户
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+def get_hash_executor():
+    """获取计算密码哈希的进程池，只配置 1 个进程时返回 None（在当前线程计算）"""
+    global _hash_executor
+    workers = app.config['IMPORT_HASH_WORKERS']
+    if workers <= 1:
+        return None
+    executor = _hash_executor
+    if executor is None or executor.pid != os.getpid():
+        with _hash_executor_lock:
+            executor = _hash_executor
+            if executor is None or executor.pid != os.getpid():
+                # 使用 spawn：应用进程中有后台线程，fork 出的子进程可能继承被占用的锁
+                executor = ProcessPoolExecutor(max_workers=workers,
+                                               mp_context=multiprocessing.get_context('spawn'))
+                executor.pid = os.getpid()
+                _hash_executor = executor
+    return executor
+
+def hash_passwords(passwords):
+    """按顺序返回各密码的哈希，有多个进程时并行计算"""
+    executor = get_hash_executor()
+    if executor is None or len(passwords) < 2:
+        return map(hash_password, passwords)
+    chunksize = max(1, len(passwords) // (app.config['IMPORT_HASH_WORKERS'] * 4))
+    func = partial(generate_password_hash, **password_hash_options())
+    return executor.map(func, passwords, chunksize=chunksize)
+
+USER_INSERT_SQL = '''INSERT INTO users (name, class_name, username, password_hash) 
+                     VALUES (?, ?, ?, ?)'''
+
+def insert_users(conn, users):
+    """在一个事务中写入用户 [(姓名, 班级, 账号, 密码哈希), ...]，返回因账号重复未能写入的用户"""
+    c = conn.cursor()
+    try:
+        c.executemany(USER_INSERT_SQL, users)
+        conn.commit()
+        return []
+    except sqlite3.IntegrityError:
+        # 有重复账号（如导入期间有其他人添加了同名账号），逐条重试
+        conn.rollback()
+        failed = []
+        for user in users:
+            try:
+                c.execute(USER_INSERT_SQL, user)
+            except sqlite3.IntegrityError:
+                failed.append(user)
+        conn.commit()
+        return failed
+
+def insert_sharded_users(users):
+    """分库时写入用户：先在主库的账号目录中登记，再按班级写入各自的分库，返回未能写入的用户"""
+    groups = {}
+    for user in users:
+        groups.setdefault(shard_router.shard_for_class(user[1], create=True), []).append(user)
+    
+    main = get_db(app.config['DATABASE'])
+    failed = []
+    for shard_id, group in groups.items():
+        claimed = claim_usernames(main, [(user[2], shard_id) for user in group])
+        failed += [user for user in group if str(user[2]) not in claimed]
+        group = [user for user in group if str(user[2]) in claimed]
+        if not group:
+            continue
+        rejected = insert_users(get_db(shard_router.database(shard_id)), group)
+        if rejected:
+            release_usernames(main, [user[2] for user in rejected])
+            failed += rejected
+    return failed
+
+def existing_usernames(conn, usernames):
+    """已被占用的账号：分库时查主库的账号目录和主库用户（管理员），否则查用户表"""
+    tables = ['users'] + (['user_directory'] if shard_router.enabled else [])
+    existing = set()
+    for i in range(0, len(usernames), 500):
+        batch = usernames[i:i + 500]
+        placeholders = ",".join("?" * len(batch))
+        for table in tables:
+            c = conn.execute(f'SELECT username FROM {table} WHERE username IN ({placeholders})', batch)
+            existing.update(row['username'] for row in c.fetchall())
+    return existing
+
+def import_users(conn, rows, progress=None):
+    """导入用户行 (姓名, 班级, 账号, 密码, ...)，返回 (成功数, 失败数)
+
+    先在内存中剔除重复账号（文件内重复或数据库中已存在），再并行计算密码哈希，
+    按块用 executemany 在各自的事务中写入；分库时 conn 为主库连接，每块按班级写入各分库。
+    progress(processed, succeeded, failed, total) 在剔除重复账号后、每块提交后和结束时调用。
+    """
+    chunk_size = app.config['IMPORT_CHUNK_SIZE']
+    
+    candidates = []
+    for row in rows:
+        if len(row) >= 4 and all(row[:4]):  # 确保有足够的列且不为空
+            candidates.append(row[:4])
+    
+    # 查询文件中已存在于数据库的账号
+    existing = existing_usernames(conn, list({str(row[2]) for row in candidates}))
+    
+    # 剔除重复账号
+    seen = set(existing)
+    users = []
+    error_count = 0
+    for name, class_name, username, password in candidates:
+        if str(username) in seen:
+            error_count += 1
+            continue
+        seen.add(str(username))
+        users.append((name, class_name, username, str(password)))
+    
+    # 预先剔除的行也计入进度，全部被剔除或文件为空时任务记录同样与结果一致
+    if progress:
+        progress(error_count, 0, error_count, len(candidates))
+    
+    success_count = 0
+    hashes = hash_passwords([password for _, _, _, password in users])
+    for i in range(0, len(users), chunk_size):
+        chunk = [(name, class_name, username, next(hashes))
+                 for name, class_name, username, _ in users[i:i + chunk_size]]
+        if shard_router.enabled:
+            failed = insert_sharded_users(chunk)
+        else:
+            failed = insert_users(conn, chunk)
+        success_count += len(chunk) - len(failed)
+        error_count += len(failed)
+        data_version.bump()
+        if progress:
+            progress(success_count + error_count, success_count, error_count, len(candidates))
+    
+    if progress:
+        progress(success_count + error_count, success_count, error_count, len(candidates))
+    return success_count, error_count
+
 @app.route('/admin/users/import', methods=['POST'])
 @admin_required
 def admin_import_users():
@@ -398,47 +3197,20 @@ def admin_import_users():
         return redirect(url_for('admin_users'))
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         try:
-            # 读取 Excel 文件
-            workbook = openpyxl.load_workbook(filepath)
-            sheet = workbook.active
-            
-            conn = get_db()
-            c = conn.cursor()
-            
-            success_count = 0
-            error_count = 0
-            
-            # 跳过标题行
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                if len(row) >= 4 and all(row[:4]):  # 确保有足够的列且不为空
-                    name, class_name, username, password = row[:4]
-                    
-                    try:
-                        password_hash = generate_password_hash(str(password))
-                        c.execute('''INSERT INTO users (name, class_name, username, password_hash) 
-                                     VALUES (?, ?, ?, ?)''', 
-                                  (name, class_name, username, password_hash))
-                        success_count += 1
-                    except sqlite3.IntegrityError:
-                        error_count += 1
-                        continue
-            
-            conn.commit()
-            conn.close()
-            
-            # 删除上传的文件
-            os.remove(filepath)
+            # 直接从上传缓冲区以只读模式逐行读取 Excel 文件
+            workbook = open_upload_workbook(file.stream)
+            try:
+                conn = get_db()
+                success_count, error_count = import_users(
+                    conn, workbook.active.iter_rows(min_row=2, values_only=True))
+                conn.close()
+            finally:
+                workbook.close()
             
             flash(f'导入完成：成功 {success_count} 条，失败 {error_count} 条', 'success')
         except Exception as e:
             flash(f'导入失败：{str(e)}', 'error')
-            if os.path.exists(filepath):
-                os.remove(filepath)
     else:
         flash('不支持的文件格式', 'error')
     
@@ -446,29 +3218,46 @@ def admin_import_users():
 
 @app.route('/admin/positions')
 @admin_required
+@conditional_page(admin_page_version)
 def admin_positions():
     """岗位管理页面"""
     class_filter = request.args.get('class', '')
-    
-    conn = get_db()
-    c = conn.cursor()
+    search = request.args.get('q', '').strip()
+    cursor = decode_cursor(request.args.get('after', ''), 3)
+    page_size = app.config['ADMIN_PAGE_SIZE']
     
     # 获取所有班级列表
-    c.execute('SELECT DISTINCT class_name FROM positions ORDER BY class_name')
-    classes = [row['class_name'] for row in c.fetchall()]
+    classes = class_stats_cache.position_classes()
     
-    # 获取岗位列表，按序号排序
+    # 获取岗位列表：按 (班级, 序号, id) 键集分页，只读取一页
+    conditions = []
+    params = []
     if class_filter:
-        c.execute('SELECT * FROM positions WHERE class_name = ? ORDER BY sort_order, id', 
-                  (class_filter,))
-    else:
-        c.execute('SELECT * FROM positions ORDER BY class_name, sort_order, id')
+        conditions.append('class_name = ?')
+        params.append(class_filter)
+    if search:
+        conditions.append("(position_name LIKE ? ESCAPE '\\' OR member_name LIKE ? ESCAPE '\\')")
+        params += [like_prefix(search)] * 2
+    if cursor:
+        conditions.append('(class_name, sort_order, id) > (?, ?, ?)')
+        params += cursor
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    # 指定班级时只查所在的库，否则各库各取一页后归并
+    databases = [shard_router.database_for_class(class_filter)] if class_filter else None
+    positions = read_shards(f'''SELECT * FROM positions {where}
+                               ORDER BY class_name, sort_order, id LIMIT ?''', params + [page_size + 1],
+                            key=lambda row: (row['class_name'], row['sort_order'], row['id']),
+                            limit=page_size + 1, databases=databases)
     
-    positions = c.fetchall()
-    conn.close()
+    next_cursor = None
+    if len(positions) > page_size:
+        positions = positions[:page_size]
+        last = positions[-1]
+        next_cursor = encode_cursor([last['class_name'], last['sort_order'], last['id']])
     
     return render_template('admin/positions.html', positions=positions, classes=classes, 
-                         current_class=class_filter)
+                         current_class=class_filter, search=search,
+                         next_cursor=next_cursor, is_first_page=cursor is None)
 
 @app.route('/admin/positions/add', methods=['POST'])
 @admin_required
@@ -482,7 +3271,7 @@ def admin_add_position():
         flash('所有字段都必须填写', 'error')
         return redirect(url_for('admin_positions'))
     
-    conn = get_db()
+    conn = get_db(shard_router.database_for_class(class_name, create=True))
     c = conn.cursor()
     
     try:
@@ -494,6 +3283,8 @@ def admin_add_position():
                      VALUES (?, ?, ?, ?)''', 
                   (class_name, position_name, member_name, max_order + 1))
         conn.commit()
+        data_version.bump()
+        position_catalog.invalidate(class_name)
         flash('岗位添加成功', 'success')
     except sqlite3.IntegrityError:
         flash('该班级的此岗位已存在', 'error')
@@ -508,7 +3299,11 @@ def admin_add_position():
 @admin_required
 def admin_delete_position(position_id):
     """删除岗位"""
-    conn = get_db()
+    database = shard_router.database_for_id(position_id)
+    if database is None:
+        flash('岗位不存在', 'error')
+        return redirect(url_for('admin_positions'))
+    conn = get_db(database)
     c = conn.cursor()
     
     try:
@@ -517,6 +3312,8 @@ def admin_delete_position(position_id):
         # 删除岗位
         c.execute('DELETE FROM positions WHERE id = ?', (position_id,))
         conn.commit()
+        data_version.bump()
+        position_catalog.invalidate()
         
         if c.rowcount > 0:
             flash('岗位删除成功', 'success')
@@ -529,6 +3326,59 @@ def admin_delete_position(position_id):
     
     return redirect(url_for('admin_positions'))
 
+def import_positions(conn, rows, progress=None):
+    """导入岗位行 (班级, 岗位名称, 班委姓名, ...)，返回 (成功数, 失败数)
+
+    按班级分组，每个班级在一个事务中写入，确保同一班级的序号连续；分库时写入班级所在的分库。
+    progress(processed, succeeded, failed, total) 在每个班级提交后调用。
+    """
+    success_count = 0
+    error_count = 0
+    
+    # 按班级分组处理，确保同一班级的序号连续
+    class_positions = {}
+    
+    # 收集数据
+    for row in rows:
+        if len(row) >= 3 and all(row[:3]):  # 确保有足够的列且不为空
+            class_name, position_name, member_name = row[:3]
+            class_name = str(class_name).strip()
+            position_name = str(position_name).strip()
+            member_name = str(member_name).strip()
+            
+            if class_name not in class_positions:
+                class_positions[class_name] = []
+            class_positions[class_name].append((position_name, member_name))
+    
+    total = sum(len(positions) for positions in class_positions.values())
+    
+    # 按班级批量插入
+    for class_name, positions in class_positions.items():
+        class_conn = get_db(shard_router.database_for_class(class_name, create=True)) \
+            if shard_router.enabled else conn
+        c = class_conn.cursor()
+        # 获取该班级当前的最大序号
+        c.execute('SELECT MAX(sort_order) as max_order FROM positions WHERE class_name = ?', (class_name,))
+        max_order = c.fetchone()['max_order'] or 0
+        
+        for i, (position_name, member_name) in enumerate(positions):
+            try:
+                c.execute('''INSERT INTO positions (class_name, position_name, member_name, sort_order) 
+                             VALUES (?, ?, ?, ?)''', 
+                          (class_name, position_name, member_name, max_order + i + 1))
+                success_count += 1
+            except sqlite3.IntegrityError:
+                error_count += 1
+                continue
+        
+        class_conn.commit()
+        data_version.bump()
+        position_catalog.invalidate(class_name)
+        if progress:
+            progress(success_count + error_count, success_count, error_count, total)
+    
+    return success_count, error_count
+
 @app.route('/admin/positions/import', methods=['POST'])
 @admin_required
 def admin_import_positions():
@@ -543,110 +3393,215 @@ def admin_import_positions():
         return redirect(url_for('admin_positions'))
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         try:
-            # 读取 Excel 文件
-            workbook = openpyxl.load_workbook(filepath)
-            sheet = workbook.active
-            
-            conn = get_db()
-            c = conn.cursor()
-            
-            success_count = 0
-            error_count = 0
-            
-            # 按班级分组处理，确保同一班级的序号连续
-            class_positions = {}
-            
-            # 跳过标题行，收集数据
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                if len(row) >= 3 and all(row[:3]):  # 确保有足够的列且不为空
-                    class_name, position_name, member_name = row[:3]
-                    class_name = str(class_name).strip()
-                    position_name = str(position_name).strip()
-                    member_name = str(member_name).strip()
-                    
-                    if class_name not in class_positions:
-                        class_positions[class_name] = []
-                    class_positions[class_name].append((position_name, member_name))
-            
-            # 按班级批量插入
-            for class_name, positions in class_positions.items():
-                # 获取该班级当前的最大序号
-                c.execute('SELECT MAX(sort_order) as max_order FROM positions WHERE class_name = ?', (class_name,))
-                max_order = c.fetchone()['max_order'] or 0
-                
-                for i, (position_name, member_name) in enumerate(positions):
-                    try:
-                        c.execute('''INSERT INTO positions (class_name, position_name, member_name, sort_order) 
-                                     VALUES (?, ?, ?, ?)''', 
-                                  (class_name, position_name, member_name, max_order + i + 1))
-                        success_count += 1
-                    except sqlite3.IntegrityError:
-                        error_count += 1
-                        continue
-            
-            conn.commit()
-            conn.close()
-            
-            # 删除上传的文件
-            os.remove(filepath)
+            # 直接从上传缓冲区以只读模式逐行读取 Excel 文件
+            workbook = open_upload_workbook(file.stream)
+            try:
+                conn = get_db()
+                success_count, error_count = import_positions(
+                    conn, workbook.active.iter_rows(min_row=2, values_only=True))
+                conn.close()
+            finally:
+                workbook.close()
             
             flash(f'导入完成：成功 {success_count} 条，失败 {error_count} 条', 'success')
         except Exception as e:
             flash(f'导入失败：{str(e)}', 'error')
-            if os.path.exists(filepath):
-                os.remove(filepath)
     else:
         flash('不支持的文件格式', 'error')
     
     return redirect(url_for('admin_positions'))
 
-@app.route('/admin/statistics')
-@admin_required
-def admin_statistics():
-    """投票统计页面"""
-    class_filter = request.args.get('class', '')
+# 投票轮次：进行中的轮次读写 votes 表，结束后计票结果冻结在各库的 round_results、round_class_stats 中
+def current_round(conn):
+    """进行中的轮次（conn 为主库连接）"""
+    return conn.execute('SELECT * FROM rounds WHERE closed_at IS NULL ORDER BY id DESC LIMIT 1').fetchone()
+
+def list_rounds(conn):
+    """全部轮次，最近的在前"""
+    return conn.execute('SELECT * FROM rounds ORDER BY id DESC').fetchall()
+
+def closed_round(round_id):
+    """已结束的轮次；round_id 为空、不存在或轮次仍在进行时返回 None"""
+    if not round_id:
+        return None
+    row = get_db(app.config['DATABASE']).execute(
+        'SELECT * FROM rounds WHERE id = ? AND closed_at IS NOT NULL', (round_id,)).fetchone()
+    return dict(row) if row else None
+
+def freeze_round(conn, round_id):
+    """在一个库中冻结进行中轮次的计票结果并清空投票，返回清理的投票数
+
+    冻结和清空在同一个写事务中完成。之后写入的投票若是在本轮结束前投出的（如其他进程队列中的投票），
+    写入时会因本库已冻结该轮次而被拒绝（见 closed_round_ids），不会计入下一轮。
+    本库已冻结过该轮次时（上次结束轮次中途失败后重试）什么也不做，返回 0。
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if conn.execute('SELECT 1 FROM round_closures WHERE round_id = ?', (round_id,)).fetchone():
+            conn.rollback()
+            return 0
+        conn.execute('''INSERT INTO round_results (round_id, class_name, position_name, position_id, member_name,
+                                                   sort_order, total_votes, satisfied_votes)
+                        SELECT ?, p.class_name, p.position_name, p.id, p.member_name, COALESCE(p.sort_order, 0),
+                               COALESCE(t.total_votes, 0), COALESCE(t.satisfied_votes, 0)
+                        FROM positions p
+                        LEFT JOIN position_tallies t ON t.position_id = p.id''', (round_id,))
+        conn.execute('''INSERT INTO round_class_stats (round_id, class_name, user_count, position_count, voter_count)
+                        SELECT ?, class_name, user_count, position_count, voter_count FROM class_stats
+                        WHERE user_count > 0 OR position_count > 0''', (round_id,))
+        # 计票表、班级统计和投票页面版本由触发器随删除同步清零
+        pruned = conn.execute('DELETE FROM votes').rowcount
+        conn.execute('''INSERT INTO round_closures (round_id, closed_at, pruned_votes, last_event_id)
+                        VALUES (?, ?, ?, (SELECT COALESCE(MAX(id), 0) FROM vote_events))''',
+                     (round_id, time.time(), pruned))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return pruned
+
+def close_round(next_name=''):
+    """结束进行中的轮次并开始下一轮，返回 (结束的轮次, 清理的投票数)
+
+    各库分别冻结（分库时并行），全部完成后再在主库记录汇总并开始下一轮；
+    中途失败时轮次仍在进行，再次结束会跳过已冻结的库。本进程写入队列中的投票
+    未能在 VOTE_QUEUE_FLUSH_TIMEOUT 秒内写完时抛出 VoteWriteError，轮次不会结束。
+    """
+    main = get_db(app.config['DATABASE'])
+    current = current_round(main)
+    round_id = current['id']
     
-    conn = get_db()
-    c = conn.cursor()
+    # 队列中已确认的投票属于本轮，先写入
+    writer = get_vote_writer()
+    if writer is not None and not writer.flush(app.config['VOTE_QUEUE_FLUSH_TIMEOUT']):
+        raise VoteWriteError('投票队列仍在写入')
     
-    # 获取所有班级列表
-    c.execute('SELECT DISTINCT class_name FROM positions ORDER BY class_name')
-    classes = [row['class_name'] for row in c.fetchall()]
+    pruned = sum(fan_out(lambda conn: freeze_round(conn, round_id)))
+    totals = fan_out(lambda conn: conn.execute(
+        '''SELECT (SELECT COUNT(*) FROM round_results WHERE round_id = :id) as position_count,
+                  (SELECT COALESCE(SUM(total_votes), 0) FROM round_results WHERE round_id = :id) as total_votes,
+                  (SELECT COALESCE(SUM(voter_count), 0) FROM round_class_stats WHERE round_id = :id) as voter_count''',
+        {'id': round_id}).fetchone())
     
-    # 获取统计数据
+    main.execute('BEGIN IMMEDIATE')
+    c = main.execute('''UPDATE rounds SET closed_at = ?, position_count = ?, voter_count = ?, total_votes = ?
+                        WHERE id = ? AND closed_at IS NULL''',
+                     (time.time(), sum(row['position_count'] for row in totals),
+                      sum(row['voter_count'] for row in totals), sum(row['total_votes'] for row in totals),
+                      round_id))
+    if c.rowcount:
+        count = main.execute('SELECT COUNT(*) FROM rounds').fetchone()[0]
+        main.execute('INSERT INTO rounds (name, opened_at) VALUES (?, ?)',
+                     (next_name or f'第 {count + 1} 轮', time.time()))
+    main.commit()
+    data_version.bump()
+    return closed_round(round_id), pruned
+
+def statistics_databases(class_filter=''):
+    """统计要读取的库：指定班级时只有它所在的库，否则为全部库"""
     if class_filter:
-        c.execute('''
-            SELECT 
-                p.*,
-                COUNT(v.id) as total_votes,
-                SUM(CASE WHEN v.is_satisfied = 1 THEN 1 ELSE 0 END) as satisfied_votes,
-                (SELECT COUNT(*) FROM users WHERE class_name = p.class_name AND is_admin = 0) as class_users
-            FROM positions p
-            LEFT JOIN votes v ON p.id = v.position_id
-            WHERE p.class_name = ?
-            GROUP BY p.id
-            ORDER BY p.position_name
-        ''', (class_filter,))
+        return [shard_router.database_for_class(class_filter)]
+    return shard_router.databases()
+
+
+class ReportView:
+    """一次统计报表读取的数据来源
+
+    databases 为要读取的库或它们的快照文件，as_of 为快照的数据时间（读取实时数据时为 None）；
+    voting_round 为已结束的轮次时读取该轮冻结的结果。
+    同一份报表的各次查询使用同一个 ReportView，列宽、行数据和班级人数来自同一份数据。
+    """
+
+    def __init__(self, databases, as_of=None, voting_round=None):
+        self.databases = databases
+        self.as_of = as_of
+        self.voting_round = voting_round
+        self._class_stats = None
+
+    @property
+    def class_stats(self):
+        if self.as_of is None and self.voting_round is None:
+            return class_stats_cache.get()
+        if self._class_stats is None:
+            if self.voting_round is None:
+                self._class_stats = load_class_stats(self.databases)
+            else:
+                self._class_stats = load_round_class_stats(self.databases, self.voting_round['id'])
+        return self._class_stats
+
+def load_round_class_stats(databases, round_id):
+    """读取某个已结束轮次冻结的班级统计，格式同 load_class_stats()"""
+    merged = {}
+    for rows in fan_out(lambda conn: conn.execute(
+            'SELECT * FROM round_class_stats WHERE round_id = ?', (round_id,)).fetchall(), databases):
+        for row in rows:
+            merged[row['class_name']] = {key: row[key] for key in ('user_count', 'position_count', 'voter_count')}
+    return dict(sorted(merged.items()))
+
+def report_view(class_filter='', voting_round=None):
+    """统计报表的数据来源
+
+    voting_round 为已结束的轮次时读取冻结的结果（不会再变化，不需要快照）；否则启用报表快照时
+    为不超过 REPORT_SNAPSHOT_MAX_AGE 秒的快照，未启用时为实时数据。
+    """
+    databases = statistics_databases(class_filter)
+    if voting_round is not None:
+        return ReportView(databases, voting_round=voting_round)
+    if not report_snapshots.enabled:
+        return ReportView(databases)
+    paths, taken = report_snapshots.acquire(databases)
+    return ReportView(paths, datetime.fromtimestamp(taken))
+
+# 已结束轮次的统计：直接读取冻结的结果，按主键顺序输出
+ROUND_STATISTICS_SQL = '''
+    SELECT position_id as id, class_name, position_name, member_name, sort_order, total_votes, satisfied_votes
+    FROM round_results WHERE round_id = ?
+'''
+
+def iter_statistics(class_filter='', chunk_size=500, view=None):
+    """逐批读取各岗位的计票结果（来自岗位计票表和班级统计缓存，无需聚合 votes、users 表）
+
+    不指定班级时并行读取各库，按 (班级, 岗位) 边读边归并。view 默认为 report_view(class_filter)。
+    """
+    view = view or report_view(class_filter)
+    class_stats = view.class_stats
+    if view.voting_round is not None:
+        sql, params = ROUND_STATISTICS_SQL, (view.voting_round['id'],)
+        if class_filter:
+            sql, params = sql + ' AND class_name = ?', params + (class_filter,)
+        sql += ' ORDER BY class_name, position_name'
     else:
-        c.execute('''
+        sql = '''
             SELECT 
                 p.*,
-                COUNT(v.id) as total_votes,
-                SUM(CASE WHEN v.is_satisfied = 1 THEN 1 ELSE 0 END) as satisfied_votes,
-                (SELECT COUNT(*) FROM users WHERE class_name = p.class_name AND is_admin = 0) as class_users
+                COALESCE(t.total_votes, 0) as total_votes,
+                COALESCE(t.satisfied_votes, 0) as satisfied_votes
             FROM positions p
-            LEFT JOIN votes v ON p.id = v.position_id
-            GROUP BY p.id
-            ORDER BY p.class_name, p.position_name
-        ''')
+            LEFT JOIN position_tallies t ON t.position_id = p.id
+        '''
+        if class_filter:
+            sql, params = sql + ' WHERE p.class_name = ? ORDER BY p.position_name', (class_filter,)
+        else:
+            sql, params = sql + ' ORDER BY p.class_name, p.position_name', ()
     
+    rows = iter_shards(sql, params, key=lambda row: (row['class_name'], row['position_name']),
+                       databases=view.databases, chunk_size=chunk_size)
+    with closing(rows):
+        for row in rows:
+            row = dict(row)
+            stats = class_stats.get(row['class_name'])
+            row['class_users'] = stats['user_count'] if stats else 0
+            yield row
+
+def fetch_statistics(class_filter='', view=None):
+    """读取各岗位的计票结果"""
+    return list(iter_statistics(class_filter, view=view))
+
+def load_statistics(class_filter='', view=None):
+    """读取统计页面所需的数据，附带满意度和参与率"""
     statistics = []
-    for row in c.fetchall():
+    for row in fetch_statistics(class_filter, view):
         stat = dict(row)
         if stat['total_votes'] > 0:
             stat['satisfaction_rate'] = (stat['satisfied_votes'] / stat['total_votes']) * 100
@@ -660,116 +3615,974 @@ def admin_statistics():
         
         statistics.append(stat)
     
-    conn.close()
+    return statistics
+
+class StatisticsStreamBusy(Exception):
+    """实时统计的订阅者已满"""
+
+
+class StatisticsBroker:
+    """统计结果的进程内发布/订阅
+
+    投票写入后调用 publish() 登记变化的岗位，后台线程每隔 interval 秒把这段时间内的变化合并成一次推送：
+    只读取这些岗位的计票和所属班级的统计，与上次推送的值比较，把差异发给所有订阅者。
+    查询量只与变化量有关，与打开页面的人数无关。
+    其他进程的写入和增删岗位、用户等变化没有经过 publish()，由数据版本发现，
+    这时按主键读取整个计票表和班级统计表对比（不聚合 votes 表），最多每 resync 秒一次。
+    """
+
+    def __init__(self, interval=1.0, max_subscribers=50, resync=10.0):
+        self.interval = interval
+        self.max_subscribers = max_subscribers
+        self.resync = resync
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._dirty = set()
+        self._thread = None
+        self._tallies = None  # {岗位 id: (总票数, 满意票数)}
+        self._classes = None  # {班级: (人数, 已投票人数)}
+        self._seen_version = None
+        self._synced_version = None
+        self._synced_at = 0.0
+        self._events = 0
+        self._full_syncs = 0
+        self._partial_syncs = 0
+
+    def subscribe(self):
+        """新增一个订阅者，返回它的事件队列"""
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise StatisticsStreamBusy('实时统计连接数已满，请稍后再试')
+            subscriber = queue.Queue(maxsize=100)
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='statistics-broker', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, position_ids):
+        """登记发生变化的岗位（没有订阅者时直接忽略）"""
+        if not self._subscribers:
+            return
+        with self._lock:
+            self._dirty.update(position_ids)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._subscribers:
+                    # 没有订阅者时退出线程并丢弃快照，下次订阅时重新开始
+                    self._thread = None
+                    self._tallies = self._classes = None
+                    self._dirty.clear()
+                    return
+                dirty, self._dirty = self._dirty, set()
+            try:
+                event = self._collect(dirty)
+            except sqlite3.Error as e:
+                app.logger.warning('实时统计读取失败：%s', e)
+                continue
+            if event:
+                self._broadcast(event)
+
+    def _collect(self, dirty):
+        """读取变化并与快照比较，返回要推送的事件（没有变化时返回 None）"""
+        version = data_version.current()
+        now = time.monotonic()
+        full = (self._tallies is None
+                or (not dirty and version != self._seen_version)
+                or (version != self._synced_version and now - self._synced_at >= self.resync))
+        if not full and not dirty:
+            return None
+        
+        tallies, classes = {}, {}
+        if full:
+            # 分库时并行读取各库（岗位 id 全局唯一，班级只在一个库中）
+            for shard_tallies, shard_classes in fan_out(self._read_all):
+                tallies.update(shard_tallies)
+                classes.update(shard_classes)
+        else:
+            groups = {}
+            for position_id in dirty:
+                groups.setdefault(shard_router.database_for_id(position_id), []).append(position_id)
+            groups.pop(None, None)
+            for database, ids in groups.items():
+                conn = get_pool(database).acquire()
+                try:
+                    shard_tallies, shard_classes = self._read_positions(conn, ids)
+                finally:
+                    conn.close()
+                tallies.update(shard_tallies)
+                classes.update(shard_classes)
+        
+        self._seen_version = version
+        if full:
+            self._synced_version = version
+            self._synced_at = now
+            self._full_syncs += 1
+            if self._tallies is None:
+                self._tallies, self._classes = tallies, classes
+                return None
+            # 增删岗位后页面结构变了，让页面重新加载
+            reload = tallies.keys() != self._tallies.keys()
+        else:
+            self._partial_syncs += 1
+            reload = False
+        
+        changed_positions = {position_id: value for position_id, value in tallies.items()
+                             if self._tallies.get(position_id) != value}
+        changed_classes = {name: value for name, value in classes.items()
+                           if self._classes.get(name) != value}
+        if full:
+            self._tallies, self._classes = tallies, classes
+        else:
+            self._tallies.update(tallies)
+            self._classes.update(classes)
+        
+        if not (changed_positions or changed_classes or reload):
+            return None
+        return {
+            'positions': {str(position_id): list(value) for position_id, value in changed_positions.items()},
+            'classes': {name: list(value) for name, value in changed_classes.items()},
+            'reload': reload,
+        }
+
+    @staticmethod
+    def _read_all(conn):
+        """读取一个库的整个计票表和班级统计表"""
+        tallies = {row[0]: (row[1], row[2]) for row in conn.execute(
+            'SELECT position_id, total_votes, satisfied_votes FROM position_tallies')}
+        classes = {row[0]: (row[1], row[2]) for row in conn.execute(
+            'SELECT class_name, user_count, voter_count FROM class_stats')}
+        return tallies, classes
+
+    @staticmethod
+    def _read_positions(conn, ids):
+        """读取一个库中指定岗位的计票和所属班级的统计"""
+        tallies, class_names = {}, set()
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            for row in conn.execute(f'''SELECT t.position_id, t.total_votes, t.satisfied_votes, p.class_name
+                                       FROM position_tallies t JOIN positions p ON p.id = t.position_id
+                                       WHERE t.position_id IN ({",".join("?" * len(batch))})''', batch):
+                tallies[row[0]] = (row[1], row[2])
+                class_names.add(row[3])
+        names = list(class_names)
+        classes = {row[0]: (row[1], row[2]) for row in conn.execute(
+            f'SELECT class_name, user_count, voter_count FROM class_stats '
+            f'WHERE class_name IN ({",".join("?" * len(names))})', names)} if names else {}
+        return tallies, classes
+
+    def _broadcast(self, event):
+        data = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._events += 1
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(data)
+            except queue.Full:
+                # 客户端读取太慢，丢弃积压的增量，改为通知它重新加载
+                while True:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        break
+                subscriber.put_nowait(json.dumps({'positions': {}, 'classes': {}, 'reload': True}))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'max_subscribers': self.max_subscribers,
+                'pending_positions': len(self._dirty),
+                'events': self._events,
+                'full_syncs': self._full_syncs,
+                'partial_syncs': self._partial_syncs,
+            }
+
+
+_statistics_broker = None
+_statistics_broker_lock = threading.Lock()
+
+def get_statistics_broker():
+    """获取当前进程的统计推送"""
+    global _statistics_broker
+    broker = _statistics_broker
+    if broker is None or broker.pid != os.getpid():
+        with _statistics_broker_lock:
+            broker = _statistics_broker
+            if broker is None or broker.pid != os.getpid():
+                broker = StatisticsBroker(
+                    interval=app.config['STATS_STREAM_INTERVAL'],
+                    max_subscribers=app.config['STATS_STREAM_MAX_SUBSCRIBERS'],
+                    resync=app.config['STATS_STREAM_RESYNC'],
+                )
+                _statistics_broker = broker
+    return broker
+
+def publish_statistics(position_ids):
+    """通知统计推送这些岗位的计票有变化（本进程没有订阅者时不做任何事）"""
+    broker = _statistics_broker
+    if broker is not None and broker.pid == os.getpid():
+        broker.publish(position_ids)
+
+@app.route('/admin/statistics')
+@admin_required
+@conditional_page(statistics_page_version)
+def admin_statistics():
+    """投票统计页面"""
+    class_filter = request.args.get('class', '')
+    voting_round = closed_round(request.args.get('round', type=int))
+    
+    # 获取所有班级列表
+    if voting_round is None:
+        classes = class_stats_cache.position_classes()
+    else:
+        round_stats = load_round_class_stats(shard_router.databases(), voting_round['id'])
+        classes = [name for name, stats in round_stats.items() if stats['position_count'] > 0]
     
+    # 获取统计数据（数据版本和快照不变时直接使用缓存）
+    view = report_view(class_filter, voting_round)
+    round_id = voting_round and voting_round['id']
+    statistics = query_cache.get_or_load(('statistics', class_filter, view.as_of, round_id),
+                                         lambda: load_statistics(class_filter, view))
+    
+    rounds = [dict(row, opened_at=datetime.fromtimestamp(row['opened_at']),
+                   closed_at=row['closed_at'] and datetime.fromtimestamp(row['closed_at']))
+              for row in list_rounds(get_db(app.config['DATABASE']))]
     return render_template('admin/statistics.html', statistics=statistics, classes=classes, 
-                         current_class=class_filter)
+                         current_class=class_filter, as_of=view.as_of, rounds=rounds,
+                         current_round=round_id)
 
-@app.route('/admin/statistics/export')
+@app.route('/admin/rounds/close', methods=['POST'])
 @admin_required
-def export_statistics():
-    """导出投票统计报表"""
-    class_filter = request.args.get('class', '')
+def admin_close_round():
+    """结束本轮投票：冻结计票结果、清空投票并开始下一轮"""
+    next_name = request.form.get('name', '').strip()
     
-    conn = get_db()
-    c = conn.cursor()
+    try:
+        voting_round, pruned = close_round(next_name)
+    except (sqlite3.Error, VoteWriteError) as e:
+        flash(f'结束本轮投票失败，请重试：{e}', 'error')
+        return redirect(url_for('admin_statistics'))
+    
+    flash(f"{voting_round['name']}已结束：冻结 {voting_round['position_count']} 个岗位的结果，"
+          f"清理 {pruned} 张投票", 'success')
+    return redirect(url_for('admin_statistics', round=voting_round['id']))
+
+# 统计报表导出
+EXPORT_HEADERS = ['班级', '岗位', '班委姓名', '满意票数', '总票数', '满意度(%)', '班级人数', '参与率(%)']
+
+def statistics_export_row(row):
+    """把一行统计结果转换为导出格式"""
+    total_votes = row['total_votes']
+    satisfied_votes = row['satisfied_votes'] or 0
+    class_users = row['class_users']
+    
+    satisfaction_rate = (satisfied_votes / total_votes * 100) if total_votes > 0 else 0
+    participation_rate = (total_votes / class_users * 100) if class_users > 0 else 0
     
-    # 获取统计数据（与统计页面相同的查询）
+    return [
+        row['class_name'],
+        row['position_name'],
+        row['member_name'],
+        satisfied_votes,
+        total_votes,
+        f"{satisfaction_rate:.1f}",
+        class_users,
+        f"{participation_rate:.1f}"
+    ]
+
+def statistics_export_name(class_filter, view=None, title='投票统计'):
+    """导出文件名（不含扩展名）：标题[_轮次][_班级]_时间
+
+    读取快照时为快照的数据时间，已结束的轮次为结束时间。
+    """
+    parts = [title]
+    when = datetime.now()
+    if view is not None and view.voting_round is not None:
+        parts.append(view.voting_round['name'])
+        when = datetime.fromtimestamp(view.voting_round['closed_at'])
+    elif view is not None and view.as_of is not None:
+        when = view.as_of
     if class_filter:
-        c.execute('''
-            SELECT 
-                p.*,
-                COUNT(v.id) as total_votes,
-                SUM(CASE WHEN v.is_satisfied = 1 THEN 1 ELSE 0 END) as satisfied_votes,
-                (SELECT COUNT(*) FROM users WHERE class_name = p.class_name AND is_admin = 0) as class_users
-            FROM positions p
-            LEFT JOIN votes v ON p.id = v.position_id
-            WHERE p.class_name = ?
-            GROUP BY p.id
-            ORDER BY p.position_name
-        ''', (class_filter,))
+        parts.append(class_filter)
+    parts.append(when.strftime('%Y%m%d_%H%M%S'))
+    return '_'.join(parts)
+
+def statistics_column_widths(class_filter='', view=None):
+    """计算导出列宽
+
+    只写模式必须在写入第一行前设置列宽，因此用一次聚合查询求出各列最长值（分库时各库并行查询后取最大），
+    而不是先把所有单元格读入内存再遍历。
+    """
+    view = view or report_view(class_filter)
+    if view.voting_round is not None:
+        sql = '''
+            SELECT MAX(LENGTH(class_name)) as class_name,
+                   MAX(LENGTH(position_name)) as position_name,
+                   MAX(LENGTH(member_name)) as member_name,
+                   MAX(satisfied_votes) as satisfied_votes,
+                   MAX(total_votes) as total_votes
+            FROM round_results WHERE round_id = ?
+        '''
+        params, class_condition = (view.voting_round['id'],), ' AND class_name = ?'
     else:
-        c.execute('''
-            SELECT 
-                p.*,
-                COUNT(v.id) as total_votes,
-                SUM(CASE WHEN v.is_satisfied = 1 THEN 1 ELSE 0 END) as satisfied_votes,
-                (SELECT COUNT(*) FROM users WHERE class_name = p.class_name AND is_admin = 0) as class_users
+        sql = '''
+            SELECT MAX(LENGTH(p.class_name)) as class_name,
+                   MAX(LENGTH(p.position_name)) as position_name,
+                   MAX(LENGTH(p.member_name)) as member_name,
+                   MAX(COALESCE(t.satisfied_votes, 0)) as satisfied_votes,
+                   MAX(COALESCE(t.total_votes, 0)) as total_votes
             FROM positions p
-            LEFT JOIN votes v ON p.id = v.position_id
-            GROUP BY p.id
-            ORDER BY p.class_name, p.position_name
-        ''')
+            LEFT JOIN position_tallies t ON t.position_id = p.id
+        '''
+        params, class_condition = (), ' WHERE p.class_name = ?'
+    if class_filter:
+        sql, params = sql + class_condition, params + (class_filter,)
+        stats = view.class_stats.get(class_filter)
+        class_users = stats['user_count'] if stats else 0
+    else:
+        class_users = max([s['user_count'] for s in view.class_stats.values()], default=0)
+    rows = fan_out(lambda conn: conn.execute(sql, params).fetchone(), view.databases)
+    row = {key: max((r[key] or 0 for r in rows), default=0)
+           for key in ('class_name', 'position_name', 'member_name', 'satisfied_votes', 'total_votes')}
     
-    rows = c.fetchall()
-    conn.close()
+    lengths = [
+        row['class_name'],
+        row['position_name'],
+        row['member_name'],
+        len(str(row['satisfied_votes'])),
+        len(str(row['total_votes'])),
+        len('100.0'),
+        len(str(class_users)),
+        len('100.0'),
+    ]
+    return [min(max(length, len(header)) + 2, 30) for length, header in zip(lengths, EXPORT_HEADERS)]
+
+def append_xlsx_headers(ws, headers):
+    """向只写模式的工作表写入加粗、灰底的标题行"""
+    header_font = openpyxl.styles.Font(bold=True)
+    header_fill = openpyxl.styles.PatternFill(start_color="E0E0E0", end_color="E0E0E0", fill_type="solid")
+    cells = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cells.append(cell)
+    ws.append(cells)
+
+def write_statistics_xlsx(class_filter, output, progress=None, view=None):
+    """以只写模式把统计结果写成 Excel 文件，progress(已写入行数) 每 500 行调用一次"""
+    with timed_phase('xlsx_export'):
+        view = view or report_view(class_filter)
+        widths = statistics_column_widths(class_filter, view)
+        
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("投票统计")
+        
+        # 调整列宽（只写模式下必须在写入数据前设置）
+        for index, width in enumerate(widths, start=1):
+            ws.column_dimensions[openpyxl.utils.get_column_letter(index)].width = width
+        
+        append_xlsx_headers(ws, EXPORT_HEADERS)
+        
+        # 添加数据
+        count = 0
+        for count, row in enumerate(iter_statistics(class_filter, view=view), start=1):
+            ws.append(statistics_export_row(row))
+            if progress and count % 500 == 0:
+                progress(count)
+        
+        wb.save(output)
+        if progress:
+            progress(count)
+
+def iter_statistics_csv(class_filter='', progress=None, view=None):
+    """逐批生成 CSV 内容（带 BOM，便于 Excel 直接打开），progress(已写入行数) 每批调用一次"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_HEADERS)
+    yield '\ufeff' + buffer.getvalue()
+    
+    buffer.seek(0)
+    buffer.truncate()
+    index = 0
+    for index, row in enumerate(iter_statistics(class_filter, view=view), start=1):
+        writer.writerow(statistics_export_row(row))
+        if index % 500 == 0:
+            if progress:
+                progress(index)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if progress:
+        progress(index)
+    yield buffer.getvalue()
+
+@app.route('/admin/statistics/stream')
+@admin_required
+def admin_statistics_stream():
+    """统计结果实时推送（Server-Sent Events）"""
+    try:
+        subscriber = get_statistics_broker().subscribe()
+    except StatisticsStreamBusy as e:
+        return jsonify({'success': False, 'message': str(e)}), 503, {'Retry-After': '30'}
+    
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    data = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # 定期发送注释行，防止代理断开空闲连接，也能及时发现客户端已离开
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'event: statistics\ndata: {data}\n\n'
+        finally:
+            get_statistics_broker().unsubscribe(subscriber)
     
-    # 创建 Excel 文件
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "投票统计"
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/admin/statistics/export')
+@admin_required
+def export_statistics():
+    """导出投票统计报表"""
+    class_filter = request.args.get('class', '')
     
-    # 设置标题
-    headers = ['班级', '岗位', '班委姓名', '满意票数', '总票数', '满意度(%)', '班级人数', '参与率(%)']
-    ws.append(headers)
+    export_format = request.args.get('format', 'xlsx')
+    view = report_view(class_filter, closed_round(request.args.get('round', type=int)))
+    basename = statistics_export_name(class_filter, view)
     
-    # 设置标题行样式
-    for cell in ws[1]:
-        cell.font = openpyxl.styles.Font(bold=True)
-        cell.fill = openpyxl.styles.PatternFill(start_color="E0E0E0", end_color="E0E0E0", fill_type="solid")
+    if export_format == 'csv':
+        # CSV 边查询边输出，首字节无需等待全部数据
+        return Response(
+            stream_with_context(iter_statistics_csv(class_filter, view=view)),
+            mimetype='text/csv; charset=utf-8',
+            headers={'Content-Disposition': f"attachment; filename=statistics.csv; "
+                                            f"filename*=UTF-8''{quote(basename + '.csv')}"}
+        )
     
-    # 添加数据
-    for row in rows:
-        total_votes = row['total_votes']
-        satisfied_votes = row['satisfied_votes'] or 0
-        class_users = row['class_users']
-        
-        satisfaction_rate = (satisfied_votes / total_votes * 100) if total_votes > 0 else 0
-        participation_rate = (total_votes / class_users * 100) if class_users > 0 else 0
-        
-        ws.append([
-            row['class_name'],
-            row['position_name'],
-            row['member_name'],
-            satisfied_votes,
-            total_votes,
-            f"{satisfaction_rate:.1f}",
-            class_users,
-            f"{participation_rate:.1f}"
-        ])
-    
-    # 调整列宽
-    for column in ws.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 30)
-        ws.column_dimensions[column_letter].width = adjusted_width
-    
-    # 保存到内存并返回
-    from io import BytesIO
-    from flask import send_file
-    
-    output = BytesIO()
-    wb.save(output)
+    # Excel 以只写模式逐行写入临时文件，内存占用与数据量无关
+    output = tempfile.TemporaryFile()
+    write_statistics_xlsx(class_filter, output, view=view)
     output.seek(0)
     
-    filename = f"投票统计_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=basename + '.xlsx'
+    )
+
+# 未投票名单
+NON_VOTER_HEADERS = ['班级', '姓名', '账号']
+
+def non_voter_query(class_filter='', cursor=None):
+    """未投票学生的查询条件和参数（走部分索引 idx_users_non_voters，按 (班级, 姓名, id) 有序）"""
+    conditions = ['is_admin = 0', 'has_voted = 0']
+    params = []
     if class_filter:
-        filename = f"投票统计_{class_filter}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        conditions.append('class_name = ?')
+        params.append(class_filter)
+    if cursor:
+        conditions.append('(class_name, name, id) > (?, ?, ?)')
+        params += cursor
+    return ' AND '.join(conditions), params
+
+def non_voter_key(row):
+    return (row['class_name'], row['name'], row['id'])
+
+def iter_non_voters(class_filter='', chunk_size=500, view=None):
+    """逐批读取未投票的学生，分库时各库并行读取后归并"""
+    view = view or report_view(class_filter)
+    conditions, params = non_voter_query(class_filter)
+    yield from iter_shards(f'''SELECT id, class_name, name, username FROM users WHERE {conditions}
+                              ORDER BY class_name, name, id''', params,
+                           key=non_voter_key, databases=view.databases, chunk_size=chunk_size)
+
+def iter_non_voters_csv(class_filter='', view=None):
+    """逐批生成未投票名单的 CSV 内容（带 BOM）"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(NON_VOTER_HEADERS)
+    yield '\ufeff' + buffer.getvalue()
+    
+    buffer.seek(0)
+    buffer.truncate()
+    for index, row in enumerate(iter_non_voters(class_filter, view=view), start=1):
+        writer.writerow([row['class_name'], row['name'], row['username']])
+        if index % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def write_non_voters_xlsx(class_filter, output, view=None):
+    """以只写模式把未投票名单写成 Excel 文件，列宽由一次聚合查询求出"""
+    with timed_phase('xlsx_export'):
+        view = view or report_view(class_filter)
+        conditions, params = non_voter_query(class_filter)
+        sql = f'''SELECT MAX(LENGTH(class_name)), MAX(LENGTH(name)), MAX(LENGTH(username))
+                  FROM users WHERE {conditions}'''
+        rows = fan_out(lambda conn: conn.execute(sql, params).fetchone(), view.databases)
+        
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("未投票名单")
+        for index, header in enumerate(NON_VOTER_HEADERS):
+            length = max((row[index] or 0 for row in rows), default=0)
+            ws.column_dimensions[openpyxl.utils.get_column_letter(index + 1)].width = \
+                min(max(length, len(header)) + 2, 30)
+        append_xlsx_headers(ws, NON_VOTER_HEADERS)
+        
+        for row in iter_non_voters(class_filter, view=view):
+            ws.append([row['class_name'], row['name'], row['username']])
+        wb.save(output)
+
+@app.route('/admin/non_voters')
+@admin_required
+@conditional_page(admin_page_version)
+def admin_non_voters():
+    """未投票名单：各班级参与情况，以及按 (班级, 姓名, id) 键集分页的未投票学生"""
+    class_filter = request.args.get('class', '')
+    cursor = decode_cursor(request.args.get('after', ''), 3)
+    page_size = app.config['ADMIN_PAGE_SIZE']
+    
+    # 各班级人数与已投票人数来自班级统计缓存
+    stats = class_stats_cache.get()
+    classes = class_stats_cache.user_classes()
+    summary = []
+    for class_name in classes:
+        if class_filter and class_name != class_filter:
+            continue
+        class_stats = stats[class_name]
+        summary.append({
+            'class_name': class_name,
+            'user_count': class_stats['user_count'],
+            'voter_count': class_stats['voter_count'],
+            'non_voter_count': class_stats['user_count'] - class_stats['voter_count'],
+            'vote_rate': round(class_stats['voter_count'] / class_stats['user_count'] * 100, 1),
+        })
+    
+    conditions, params = non_voter_query(class_filter, cursor)
+    students = read_shards(f'''SELECT id, class_name, name, username FROM users WHERE {conditions}
+                              ORDER BY class_name, name, id LIMIT ?''', params + [page_size + 1],
+                           key=non_voter_key, limit=page_size + 1,
+                           databases=statistics_databases(class_filter))
+    
+    next_cursor = None
+    if len(students) > page_size:
+        students = students[:page_size]
+        last = students[-1]
+        next_cursor = encode_cursor([last['class_name'], last['name'], last['id']])
+    
+    return render_template('admin/non_voters.html', students=students, summary=summary, classes=classes,
+                         current_class=class_filter, next_cursor=next_cursor, is_first_page=cursor is None)
+
+@app.route('/admin/non_voters/export')
+@admin_required
+def export_non_voters():
+    """导出未投票名单"""
+    class_filter = request.args.get('class', '')
+    export_format = request.args.get('format', 'xlsx')
+    view = report_view(class_filter)
+    basename = statistics_export_name(class_filter, view, title='未投票名单')
+    
+    if export_format == 'csv':
+        return Response(
+            stream_with_context(iter_non_voters_csv(class_filter, view=view)),
+            mimetype='text/csv; charset=utf-8',
+            headers={'Content-Disposition': f"attachment; filename=non_voters.csv; "
+                                            f"filename*=UTF-8''{quote(basename + '.csv')}"}
+        )
+    
+    output = tempfile.TemporaryFile()
+    write_non_voters_xlsx(class_filter, output, view=view)
+    output.seek(0)
     
     return send_file(
         output,
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
         as_attachment=True,
-        download_name=filename
+        download_name=basename + '.xlsx'
     )
 
+# 后台任务
+class Job:
+    """一个后台任务的进度，按间隔写入 jobs 表"""
+
+    def __init__(self, job_id, report_interval=0.5):
+        self.id = job_id
+        self.report_interval = report_interval
+        self.total = None
+        self.processed = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.result_path = None
+        self.result_name = None
+        self._last_report = 0.0
+
+    def _save(self, **fields):
+        # 使用单独的连接，任务本身的事务不受进度写入影响
+        conn = get_pool().acquire()
+        try:
+            columns = ', '.join(f'{name} = ?' for name in fields)
+            conn.execute(f'UPDATE jobs SET {columns}, updated_at = ? WHERE id = ?',
+                         list(fields.values()) + [time.time(), self.id])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def start(self):
+        self._save(status='running', started_at=time.time())
+
+    def update(self, processed, succeeded=None, failed=None, total=None):
+        """更新进度，调用方必须处于没有未提交写事务的状态"""
+        self.processed = processed
+        if succeeded is not None:
+            self.succeeded = succeeded
+        if failed is not None:
+            self.failed = failed
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if now - self._last_report >= self.report_interval:
+            self._last_report = now
+            self._save(total=self.total, processed=self.processed,
+                       succeeded=self.succeeded, failed=self.failed)
+
+    def set_result(self, path, name):
+        """记录任务生成的文件"""
+        self.result_path = path
+        self.result_name = name
+
+    def finish(self, message):
+        self._save(status='done', message=message, total=self.total, processed=self.processed,
+                   succeeded=self.succeeded, failed=self.failed, result_path=self.result_path,
+                   result_name=self.result_name, finished_at=time.time())
+
+    def fail(self, message):
+        self._save(status='failed', message=message, total=self.total, processed=self.processed,
+                   succeeded=self.succeeded, failed=self.failed, finished_at=time.time())
+
+
+class JobRunner:
+    """后台任务执行器
+
+    批量导入、导出在线程池中执行，提交后立即返回任务编号；进度保存在 jobs 表中，
+    因此任意工作进程都能查询，不需要额外的消息队列。
+    """
+
+    def __init__(self, workers=2):
+        self.pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def submit(self, kind, func, *args, created_by=None):
+        """提交任务 func(job, *args)，返回任务编号；func 的返回值作为完成消息"""
+        job_id = uuid.uuid4().hex
+        conn = get_pool().acquire()
+        try:
+            conn.execute('INSERT INTO jobs (id, kind, created_by) VALUES (?, ?, ?)',
+                         (job_id, kind, created_by))
+            conn.commit()
+        finally:
+            conn.close()
+        self._executor.submit(self._run, job_id, func, args)
+        return job_id
+
+    def _run(self, job_id, func, args):
+        job = Job(job_id)
+        try:
+            job.start()
+            with app.app_context():
+                message = func(job, *args)
+            job.finish(message)
+        except Exception as e:
+            app.logger.exception('后台任务 %s 失败', job_id)
+            job.fail(str(e))
+
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+def get_job_runner():
+    """获取当前进程的后台任务执行器"""
+    global _job_runner
+    runner = _job_runner
+    if runner is None or runner.pid != os.getpid():
+        with _job_runner_lock:
+            runner = _job_runner
+            if runner is None or runner.pid != os.getpid():
+                runner = JobRunner(workers=app.config['JOB_WORKERS'])
+                _job_runner = runner
+    return runner
+
+def cleanup_jobs(conn):
+    """删除过期任务及其生成的文件"""
+    cutoff = time.time() - app.config['JOB_RESULT_TTL']
+    c = conn.cursor()
+    c.execute('SELECT id, result_path FROM jobs WHERE finished_at < ?', (cutoff,))
+    for row in c.fetchall():
+        if row['result_path'] and os.path.exists(row['result_path']):
+            os.remove(row['result_path'])
+    c.execute('DELETE FROM jobs WHERE finished_at < ?', (cutoff,))
+    conn.commit()
+
+def spool_upload_for_job(file):
+    """复制上传文件供后台任务读取（请求结束时原缓冲区会被关闭）"""
+    upload = spooled_upload_buffer()
+    file.stream.seek(0)
+    shutil.copyfileobj(file.stream, upload)
+    upload.seek(0)
+    return upload
+
+def run_import_users_job(job, upload):
+    """后台任务：导入用户"""
+    try:
+        workbook = open_upload_workbook(upload)
+        try:
+            conn = get_db()
+            success_count, error_count = import_users(
+                conn, workbook.active.iter_rows(min_row=2, values_only=True), progress=job.update)
+            conn.close()
+        finally:
+            workbook.close()
+    finally:
+        upload.close()
+    return f'导入完成：成功 {success_count} 条，失败 {error_count} 条'
+
+def run_import_positions_job(job, upload):
+    """后台任务：导入岗位"""
+    try:
+        workbook = open_upload_workbook(upload)
+        try:
+            conn = get_db()
+            success_count, error_count = import_positions(
+                conn, workbook.active.iter_rows(min_row=2, values_only=True), progress=job.update)
+            conn.close()
+        finally:
+            workbook.close()
+    finally:
+        upload.close()
+    return f'导入完成：成功 {success_count} 条，失败 {error_count} 条'
+
+def run_export_statistics_job(job, class_filter, export_format, voting_round=None):
+    """后台任务：导出投票统计报表，voting_round 为已结束的轮次时导出该轮冻结的结果"""
+    view = report_view(class_filter, voting_round)
+    basename = statistics_export_name(class_filter, view)
+    if class_filter:
+        stats = view.class_stats.get(class_filter)
+        total = stats['position_count'] if stats else 0
+    else:
+        total = sum(stats['position_count'] for stats in view.class_stats.values())
+    job.update(0, total=total)
+    
+    def progress(count):
+        job.update(count, succeeded=count)
+    
+    # 记录绝对路径：send_file 按应用目录而不是当前工作目录解析相对路径
+    path = os.path.abspath(os.path.join(app.config['JOB_RESULT_FOLDER'], f'{job.id}.{export_format}'))
+    if export_format == 'csv':
+        with open(path, 'w', encoding='utf-8', newline='') as output:
+            for chunk in iter_statistics_csv(class_filter, progress=progress, view=view):
+                output.write(chunk)
+    else:
+        with open(path, 'wb') as output:
+            write_statistics_xlsx(class_filter, output, progress=progress, view=view)
+    
+    job.set_result(path, f'{basename}.{export_format}')
+    if view.as_of:
+        return f"导出完成：共 {job.processed} 条（数据截至 {view.as_of.strftime('%H:%M:%S')}）"
+    return f'导出完成：共 {job.processed} 条'
+
+def job_import_request(kind, func):
+    """处理导入任务的上传请求"""
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'success': False, 'message': '请选择文件'}), 400
+    if not allowed_file(file.filename):
+        return jsonify({'success': False, 'message': '不支持的文件格式'}), 400
+    
+    upload = spool_upload_for_job(file)
+    try:
+        cleanup_jobs(get_db())
+        job_id = get_job_runner().submit(kind, func, upload, created_by=session['user_id'])
+    except Exception:
+        upload.close()
+        raise
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('admin_job_status', job_id=job_id)
+    }), 202
+
+@app.route('/admin/jobs/users/import', methods=['POST'])
+@admin_required
+def admin_job_import_users():
+    """后台批量导入用户"""
+    return job_import_request('import_users', run_import_users_job)
+
+@app.route('/admin/jobs/positions/import', methods=['POST'])
+@admin_required
+def admin_job_import_positions():
+    """后台批量导入岗位"""
+    return job_import_request('import_positions', run_import_positions_job)
+
+@app.route('/admin/jobs/statistics/export', methods=['POST'])
+@admin_required
+def admin_job_export_statistics():
+    """后台导出投票统计报表"""
+    class_filter = request.form.get('class', '')
+    export_format = 'csv' if request.form.get('format') == 'csv' else 'xlsx'
+    voting_round = closed_round(request.form.get('round', type=int))
+    
+    cleanup_jobs(get_db())
+    job_id = get_job_runner().submit('export_statistics', run_export_statistics_job,
+                                     class_filter, export_format, voting_round,
+                                     created_by=session['user_id'])
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('admin_job_status', job_id=job_id)
+    }), 202
+
+@app.route('/admin/jobs/<job_id>')
+@admin_required
+def admin_job_status(job_id):
+    """查询后台任务进度（JSON）"""
+    conn = get_db()
+    job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    conn.close()
+    
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    
+    # 按目前的处理速度估算剩余时间
+    eta = None
+    elapsed = None
+    if job['started_at']:
+        elapsed = (job['finished_at'] or time.time()) - job['started_at']
+        if job['status'] == 'running' and job['total'] and job['processed']:
+            rate = job['processed'] / elapsed if elapsed > 0 else 0
+            if rate > 0:
+                eta = round((job['total'] - job['processed']) / rate, 1)
+    
+    result = {
+        'success': True,
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'total': job['total'],
+        'processed': job['processed'],
+        'succeeded': job['succeeded'],
+        'failed': job['failed'],
+        'message': job['message'],
+        'elapsed_seconds': round(elapsed, 1) if elapsed is not None else None,
+        'eta_seconds': eta,
+    }
+    if job['status'] == 'done' and job['result_path']:
+        result['download_url'] = url_for('admin_job_download', job_id=job_id)
+    return jsonify(result)
+
+@app.route('/admin/jobs/<job_id>/download')
+@admin_required
+def admin_job_download(job_id):
+    """下载后台任务生成的文件"""
+    conn = get_db()
+    job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    conn.close()
+    
+    if job is None or job['status'] != 'done' or not job['result_path'] \
+            or not os.path.exists(job['result_path']):
+        flash('文件不存在或已过期', 'error')
+        return redirect(url_for('admin_statistics'))
+    
+    mimetype = 'text/csv' if job['result_path'].endswith('.csv') else \
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    return send_file(job['result_path'], mimetype=mimetype, as_attachment=True,
+                     download_name=job['result_name'])
+
+@app.route('/admin/auth/verifier')
+@admin_required
+def admin_auth_verifier():
+    """登录密码校验排队状态（JSON）"""
+    return jsonify(dict(get_verifier().stats(), rehash=app.config['LOGIN_REHASH'],
+                        hash_method=app.config['PASSWORD_HASH_METHOD']))
+
+@app.route('/admin/db/cache')
+@admin_required
+def admin_query_cache():
+    """查询结果缓存状态（JSON）"""
+    local_version, db_version = data_version.current()
+    return jsonify(dict(query_cache.stats(), local_version=local_version, db_version=db_version,
+                        position_catalog=position_catalog.stats()))
+
+@app.route('/admin/db/pool')
+@admin_required
+def admin_db_pool():
+    """数据库连接池状态（JSON），分库时附带各分库的连接池"""
+    stats = get_pool().stats()
+    if shard_router.enabled:
+        stats['shards'] = {os.path.basename(database): get_pool(database).stats()
+                           for database in shard_router.databases()[1:]}
+    return jsonify(stats)
+
+@app.route('/admin/db/snapshot')
+@admin_required
+def admin_report_snapshot():
+    """报表快照状态（JSON）"""
+    return jsonify(report_snapshots.stats())
+
+@app.route('/admin/db/vote_queue')
+@admin_required
+def admin_vote_queue():
+    """投票写入队列状态（JSON）"""
+    writer = get_vote_writer()
+    if writer is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(writer.stats(), enabled=True, ack=app.config['VOTE_QUEUE_ACK']))
+
+def render_gauges(prefix, stats, keys):
+    """把 stats() 返回的数值输出为 gauge"""
+    lines = []
+    for key in keys:
+        name = f'{prefix}_{key}'
+        lines += [f'# TYPE {name} gauge', f'{name} {stats[key]}']
+    return lines
+
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    """Prometheus 文本格式的性能指标（当前进程）"""
+    lines = []
+    for metric in (request_count, request_latency, request_sql_queries, request_sql_seconds,
+                   request_template_seconds, query_latency, slow_query_count, phase_latency):
+        lines += metric.render()
+    lines += render_gauges('db_pool', get_pool().stats(),
+                           ('size', 'created', 'in_use', 'idle', 'acquire_count', 'timeout_count', 'wait_total_ms'))
+    lines += render_gauges('query_cache', query_cache.stats(), ('entries', 'hits', 'misses', 'evictions'))
+    lines += render_gauges('position_catalog', position_catalog.stats(), ('classes', 'positions', 'checks', 'loads'))
+    lines += render_gauges('login_verifier', get_verifier().stats(),
+                           ('queue_length', 'in_flight', 'verified', 'rejected', 'timeouts'))
+    lines += render_gauges('statistics_stream', get_statistics_broker().stats(),
+                           ('subscribers', 'events', 'full_syncs', 'partial_syncs'))
+    if report_snapshots.enabled:
+        lines += render_gauges('report_snapshot', report_snapshots.stats(), ('refresh_count', 'refresh_avg_ms'))
+    writer = get_vote_writer()
+    if writer is not None:
+        lines += render_gauges('vote_queue', writer.stats(),
+                               ('queue_depth', 'enqueued', 'rejected', 'committed_rows', 'failed_rows', 'batches'))
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # 错误处理
 @app.errorhandler(404)
 def page_not_found(e):
@@ -779,7 +4592,26 @@ def page_not_found(e):
 def internal_error(e):
     return render_template('500.html'), 500
 
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    app.logger.warning('数据库连接池耗尽：%s', get_pool().stats())
+    return render_template('500.html'), 503, {'Retry-After': '1'}
+
 # 主程序入口
-if __name__ == '__main__':
+def create_app(config=None):
+    """应用工厂：应用配置覆盖，初始化数据库并预热缓存，返回 app
+
+    路由都注册在模块级的 app 上，工厂不会创建新实例。init_db() 会把未完成的后台任务标记为
+    中断，所以多进程部署时只能在主进程调用一次（gunicorn 需加 --preload，或使用 serve.py）。
+    返回前关闭数据库连接，随后 fork 出的工作进程各自连接。
+    """
+    if config:
+        app.config.update(config)
     init_db()
-    app.run(host='0.0.0.0', port=32244, debug=True)
+    close_pool()
+    return app
+
+if __name__ == '__main__':
+    # 开发服务器，生产环境请使用 serve.py
+    create_app()
+    app.run(host='0.0.0.0', port=32244, debug=os.environ.get('FLASK_DEBUG') == '1')
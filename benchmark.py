@@ -0,0 +1,445 @@
+"""投票系统压力测试
+
+生成 N 个班级 × M 名学生 × K 个岗位的数据，模拟学生并发登录、打开投票页、逐项投票，
+同时有管理员反复刷新统计页面、导出统计报表（--export-threads）。分别通过 Flask 测试客户端和真实的多线程 WSGI 服务器运行
+（--mode prefork 则通过 serve.py 启动的多进程服务器），
+统计各路由的吞吐量、p50/p95/p99 延迟和数据库锁错误率，结果写入 JSON 文件便于跨提交对比。
+--replay-events 另外追加随机改票事件，测量按投票事件日志重建全部投票的速度（事件/秒）。
+
+用法：
+    python benchmark.py --classes 10 --students 40 --positions 6 --threads 16 -o bench.json
+
+密码哈希参数、投票写入队列、分库等按环境变量配置（与运行应用时相同），例如
+    PASSWORD_HASH_METHOD=pbkdf2:sha256:1000 VOTE_QUEUE_ENABLED=1 python benchmark.py
+    DB_SHARD_BY=class python benchmark.py --mode prefork
+    REPORT_SNAPSHOT_MAX_AGE=5 python benchmark.py --export-threads 2
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import queue
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from datetime import datetime
+
+from flask import got_request_exception, request
+from werkzeug.serving import make_server
+
+from app import (app, data_version, get_db, hash_password, insert_sharded_users, insert_users, replay_vote_log,
+                 shard_router, write_votes)
+
+ROUTES = ['login', 'vote', 'submit_vote', 'admin_statistics', 'export_statistics']
+STUDENT_PASSWORD = 'bench123'
+ADMIN_USERNAME, ADMIN_PASSWORD = 'admin', 'admin123'
+
+
+def is_lock_error(message):
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+class Recorder:
+    """线程安全地记录各路由的延迟、状态码和错误"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {route: [] for route in ROUTES}
+        self.status = {route: Counter() for route in ROUTES}
+        self.errors = Counter()
+        self.lock_errors = Counter()  # 按路由统计 database is locked 错误
+
+    def record(self, route, seconds, status, ok, lock_error=False):
+        with self._lock:
+            self.samples[route].append(seconds)
+            self.status[route][str(status)] += 1
+            if not ok:
+                self.errors[route] += 1
+            if lock_error:
+                self.lock_errors[route] += 1
+
+    def record_lock_error(self, route):
+        with self._lock:
+            self.lock_errors[route] += 1
+
+    def summary(self, elapsed):
+        routes = {}
+        for route in ROUTES:
+            samples = sorted(self.samples[route])
+            count = len(samples)
+            routes[route] = {
+                'count': count,
+                'throughput': round(count / elapsed, 2) if elapsed else 0,
+                'errors': self.errors[route],
+                'error_rate': round(self.errors[route] / count, 4) if count else 0,
+                'lock_errors': self.lock_errors[route],
+                'lock_error_rate': round(self.lock_errors[route] / count, 4) if count else 0,
+                'status': dict(self.status[route]),
+                'latency_ms': {
+                    'p50': percentile(samples, 50),
+                    'p95': percentile(samples, 95),
+                    'p99': percentile(samples, 99),
+                    'mean': round(sum(samples) / count * 1000, 3) if count else None,
+                    'max': round(samples[-1] * 1000, 3) if count else None,
+                },
+            }
+        total = sum(r['count'] for r in routes.values())
+        lock_errors = sum(r['lock_errors'] for r in routes.values())
+        return {
+            'elapsed': round(elapsed, 3),
+            'requests': total,
+            'throughput': round(total / elapsed, 2) if elapsed else 0,
+            'lock_errors': lock_errors,
+            'lock_error_rate': round(lock_errors / total, 4) if total else 0,
+            'routes': routes,
+        }
+
+
+def percentile(samples, p):
+    """最近秩法求百分位（毫秒），samples 需已排序"""
+    if not samples:
+        return None
+    rank = max(0, min(len(samples) - 1, round(p / 100 * len(samples) + 0.5) - 1))
+    return round(samples[rank] * 1000, 3)
+
+
+class TestClientSession:
+    """通过 Flask 测试客户端发送请求，每个虚拟用户一个实例（各自的 Cookie）"""
+
+    def __init__(self, base_url=None):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class HttpSession:
+    """通过 HTTP 访问真实服务器，每个虚拟用户一个实例（各自的 Cookie）"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def timed(recorder, session, route, method, path, data=None, expect=200):
+    """发送一个请求并记录；submit_vote 还要检查返回的 JSON"""
+    start = time.perf_counter()
+    status, body = session.request(method, path, data)
+    elapsed = time.perf_counter() - start
+
+    ok = status == expect
+    lock_error = False
+    if route == 'submit_vote' and status == 200:
+        result = json.loads(body)
+        ok = result.get('success', False)
+        lock_error = is_lock_error(result.get('message', ''))
+    recorder.record(route, elapsed, status, ok, lock_error)
+    return ok
+
+
+def seed(classes, students, positions):
+    """写入测试数据，返回 {班级: [岗位 id]} 和学生账号列表
+
+    设置了 DB_SHARD_BY 时按分库规则写入各分库（与通过管理页面添加相同）。
+    """
+    password_hash = hash_password(STUDENT_PASSWORD)
+    with app.app_context():
+        for database in shard_router.databases():
+            conn = get_db(database)
+            conn.execute('DELETE FROM votes')
+            conn.execute('DELETE FROM positions')
+            conn.execute('DELETE FROM users WHERE is_admin = 0')
+            conn.execute('DELETE FROM user_directory')
+            conn.commit()
+
+        users = [(f'学生{s}', f'班级{k}', f'bench_{k}_{s}', password_hash)
+                 for k in range(classes) for s in range(students)]
+        if shard_router.enabled:
+            insert_sharded_users(users)
+        else:
+            insert_users(get_db(), users)
+        for k in range(classes):
+            conn = get_db(shard_router.database_for_class(f'班级{k}', create=True))
+            conn.executemany('INSERT INTO positions (class_name, position_name, member_name, sort_order) '
+                             'VALUES (?, ?, ?, ?)',
+                             [(f'班级{k}', f'岗位{p}', f'成员{p}', p + 1) for p in range(positions)])
+            conn.commit()
+        data_version.bump()
+
+        class_positions = {}
+        accounts = []
+        for database in shard_router.databases():
+            conn = get_db(database)
+            for row in conn.execute('SELECT id, class_name FROM positions ORDER BY sort_order'):
+                class_positions.setdefault(row['class_name'], []).append(row['id'])
+            accounts += [(row['username'], row['class_name'])
+                         for row in conn.execute('SELECT username, class_name FROM users WHERE is_admin = 0')]
+    return class_positions, accounts
+
+
+def reset_votes():
+    with app.app_context():
+        for database in shard_router.databases():
+            conn = get_db(database)
+            conn.execute('DELETE FROM votes')
+            conn.commit()
+        data_version.bump()
+
+
+def run(session_class, base_url, class_positions, accounts, threads, admin_threads, duration, export_threads=0):
+    """运行一轮压力测试：voter 线程从队列中取学生账号完成整套投票，admin 线程刷新统计页，export 线程导出报表"""
+    recorder = Recorder()
+    pending = queue.Queue()
+    for account in random.sample(accounts, len(accounts)):
+        pending.put(account)
+    deadline = time.perf_counter() + duration if duration else None
+    voters_done = threading.Event()
+
+    def voter():
+        while deadline is None or time.perf_counter() < deadline:
+            try:
+                username, class_name = pending.get_nowait()
+            except queue.Empty:
+                return
+            session = session_class(base_url)
+            if not timed(recorder, session, 'login', 'POST', '/login',
+                         {'username': username, 'password': STUDENT_PASSWORD}, expect=302):
+                continue
+            timed(recorder, session, 'vote', 'GET', '/vote')
+            for position_id in class_positions[class_name]:
+                timed(recorder, session, 'submit_vote', 'POST', '/submit_vote',
+                      {'position_id': position_id, 'is_satisfied': random.randint(0, 1)})
+
+    def admin():
+        session = session_class(base_url)
+        timed(recorder, session, 'login', 'POST', '/login',
+              {'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD}, expect=302)
+        while not voters_done.is_set():
+            timed(recorder, session, 'admin_statistics', 'GET', '/admin/statistics')
+
+    def exporter():
+        session = session_class(base_url)
+        timed(recorder, session, 'login', 'POST', '/login',
+              {'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD}, expect=302)
+        while not voters_done.is_set():
+            timed(recorder, session, 'export_statistics', 'GET', '/admin/statistics/export?format=csv')
+
+    def on_exception(sender, exception, **extra):
+        # 未捕获的锁错误以 500 返回，在这里按路由计数
+        if isinstance(exception, sqlite3.OperationalError) and is_lock_error(str(exception)):
+            recorder.record_lock_error(request.endpoint)
+
+    got_request_exception.connect(on_exception, app)
+    voter_threads = [threading.Thread(target=voter) for _ in range(threads)]
+    admin_workers = [threading.Thread(target=admin) for _ in range(admin_threads)]
+    admin_workers += [threading.Thread(target=exporter) for _ in range(export_threads)]
+    start = time.perf_counter()
+    try:
+        for t in voter_threads + admin_workers:
+            t.start()
+        for t in voter_threads:
+            t.join()
+        voters_done.set()
+        for t in admin_workers:
+            t.join()
+    finally:
+        got_request_exception.disconnect(on_exception, app)
+    return recorder.summary(time.perf_counter() - start)
+
+
+def run_server(class_positions, accounts, args):
+    """在后台线程中启动多线程 WSGI 服务器并运行一轮"""
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        return run(HttpSession, f'http://127.0.0.1:{server.server_port}', class_positions, accounts,
+                   args.threads, args.admin_threads, args.duration, args.export_threads)
+    finally:
+        server.shutdown()
+
+
+def run_prefork(class_positions, accounts, args):
+    """用 serve.py 启动多进程服务器并运行一轮（锁错误只能作为 500 响应计入错误数）"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    serve = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+    proc = subprocess.Popen([sys.executable, serve, '--host', '127.0.0.1', '--port', str(port),
+                             '--workers', str(args.workers)],
+                            env=dict(os.environ, DATABASE=app.config['DATABASE']))
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError('serve.py 启动失败')
+                time.sleep(0.1)
+        return run(HttpSession, f'http://127.0.0.1:{port}', class_positions, accounts,
+                   args.threads, args.admin_threads, args.duration, args.export_threads)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+
+
+def run_replay(events, batch_size=1000):
+    """向各库追加共约 events 个随机改票事件，再按事件日志重建全部投票，检查结果与重建前一致"""
+    with app.app_context():
+        pairs = {}
+        for database in shard_router.databases():
+            conn = get_db(database)
+            pairs[database] = conn.execute('''SELECT u.id, p.id FROM users u
+                                              JOIN positions p ON p.class_name = u.class_name
+                                              WHERE u.is_admin = 0''').fetchall()
+        total_pairs = sum(len(rows) for rows in pairs.values()) or 1
+        for database, rows in pairs.items():
+            conn = get_db(database)
+            remaining = events * len(rows) // total_pairs if rows else 0
+            while remaining > 0:
+                batch = [(*random.choice(rows), random.randint(0, 1)) for _ in range(min(batch_size, remaining))]
+                write_votes(conn, batch)
+                conn.commit()
+                remaining -= len(batch)
+        data_version.bump()
+
+        def current_votes():
+            votes = []
+            for database in shard_router.databases():
+                votes += get_db(database).execute(
+                    'SELECT user_id, position_id, is_satisfied FROM votes ORDER BY user_id, position_id').fetchall()
+            return [tuple(row) for row in votes]
+
+        expected = current_votes()
+        replayed = rebuilt = 0
+        start = time.perf_counter()
+        for database in shard_router.databases():
+            database_events, database_votes = replay_vote_log(get_db(database))
+            replayed += database_events
+            rebuilt += database_votes
+        elapsed = time.perf_counter() - start
+        return {
+            'events': replayed,
+            'votes': rebuilt,
+            'elapsed': round(elapsed, 3),
+            'events_per_second': round(replayed / elapsed) if elapsed else None,
+            'consistent': current_votes() == expected,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(name, result):
+    print(f"\n== {name}: {result['requests']} 个请求，{result['elapsed']} 秒，"
+          f"{result['throughput']} 请求/秒，锁错误 {result['lock_errors']}")
+    print(f"{'路由':<18}{'次数':>8}{'请求/秒':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'错误':>8}")
+    for route, r in result['routes'].items():
+        if not r['count']:
+            continue
+        latency = r['latency_ms']
+        print(f"{route:<18}{r['count']:>8}{r['throughput']:>10}"
+              f"{latency['p50']:>10}{latency['p95']:>10}{latency['p99']:>10}{r['errors']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='投票系统压力测试')
+    parser.add_argument('--classes', type=int, default=10, help='班级数')
+    parser.add_argument('--students', type=int, default=40, help='每班学生数')
+    parser.add_argument('--positions', type=int, default=6, help='每班岗位数')
+    parser.add_argument('--threads', type=int, default=16, help='并发投票的虚拟学生数')
+    parser.add_argument('--admin-threads', type=int, default=1, help='同时刷新统计页的管理员数')
+    parser.add_argument('--export-threads', type=int, default=0, help='同时反复导出 CSV 报表的管理员数')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='每轮最长运行秒数，0 表示所有学生投完为止')
+    parser.add_argument('--mode', choices=['client', 'server', 'both', 'prefork'], default='both',
+                        help='client 为 Flask 测试客户端，server 为真实 WSGI 服务器，'
+                             'prefork 为 serve.py 启动的多进程服务器')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='prefork 模式的工作进程数')
+    parser.add_argument('--replay-events', type=int, default=0,
+                        help='压力测试后追加的随机改票事件数，之后测量按事件日志重建投票的速度，0 表示不测')
+    parser.add_argument('--database', help='数据库文件路径，默认使用临时文件')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='结果 JSON 文件')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = args.database or os.path.join(tmp, 'benchmark.db')
+        class_positions, accounts = seed(args.classes, args.students, args.positions)
+
+        runs = {}
+        if args.mode in ('client', 'both'):
+            runs['test_client'] = run(TestClientSession, None, class_positions, accounts,
+                                      args.threads, args.admin_threads, args.duration, args.export_threads)
+            print_summary('Flask 测试客户端', runs['test_client'])
+        if args.mode in ('server', 'both'):
+            reset_votes()
+            runs['wsgi_server'] = run_server(class_positions, accounts, args)
+            print_summary('多线程 WSGI 服务器', runs['wsgi_server'])
+        if args.mode == 'prefork':
+            runs['prefork_server'] = run_prefork(class_positions, accounts, args)
+            print_summary(f'多进程服务器（{args.workers} 个工作进程）', runs['prefork_server'])
+        if args.replay_events:
+            runs['replay'] = run_replay(args.replay_events)
+            replay = runs['replay']
+            print(f"\n== 事件日志重放: {replay['events']} 个事件，重建 {replay['votes']} 张投票，"
+                  f"{replay['elapsed']} 秒，{replay['events_per_second']} 事件/秒，"
+                  f"结果{'一致' if replay['consistent'] else '不一致'}")
+
+    result = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            **vars(args),
+            'password_hash_method': app.config['PASSWORD_HASH_METHOD'],
+            'vote_queue_enabled': app.config['VOTE_QUEUE_ENABLED'],
+            'db_pool_size': app.config['DB_POOL_SIZE'],
+            'db_shard_by': app.config['DB_SHARD_BY'],
+            'report_snapshot_max_age': app.config['REPORT_SNAPSHOT_MAX_AGE'],
+        },
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'\n结果已写入 {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+"""SQL 查询计划回归检查
+
+对 app.py 中每一条 SQL 运行 EXPLAIN QUERY PLAN，确认热点查询都走索引。
+新增或修改 SQL 时，请同步更新下面的 QUERIES 清单。
+
+用法：python check_query_plans.py [-v]
+存在未走索引的热点查询时以状态码 1 退出。
+"""
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+from app import app, get_pool, init_db
+
+# 每条查询：name 唯一标识；hot 为 True 时要求不出现全表扫描；
+# allow_scan 列出允许全表扫描的表（或别名），用于本身就要读取整表的查询；
+# ordered 为 True 时要求按索引顺序输出，不允许临时排序（键集分页只读一页的前提）。
+# 触发器体中的 NEW./OLD. 引用以参数代替。
+QUERIES = [
+    # 登录与投票
+    {'name': 'login_user', 'hot': True,
+     'sql': 'SELECT * FROM users WHERE username = ?', 'params': ('u0_0',)},
+    {'name': 'rehash_password', 'hot': True,
+     'sql': 'UPDATE users SET password_hash = ? WHERE id = ?', 'params': ('x', 1)},
+    {'name': 'login_directory', 'hot': True,
+     'sql': 'SELECT shard_id FROM user_directory WHERE username = ?', 'params': ('u0_0',)},
+    {'name': 'vote_page_votes', 'hot': True,
+     'sql': 'SELECT position_id, is_satisfied FROM votes WHERE user_id = ?', 'params': (2,)},
+    {'name': 'catalog_class_version', 'hot': True,
+     'sql': 'SELECT positions_version FROM class_versions WHERE class_name = ?', 'params': ('班级0',)},
+    {'name': 'catalog_class_positions', 'hot': True, 'ordered': True,
+     'sql': 'SELECT * FROM positions WHERE class_name = ? ORDER BY sort_order, id', 'params': ('班级0',)},
+    {'name': 'catalog_load_versions', 'hot': False,
+     'sql': 'SELECT class_name, positions_version FROM class_versions', 'params': ()},
+    {'name': 'catalog_load_all', 'hot': False, 'ordered': True,
+     'sql': 'SELECT * FROM positions ORDER BY class_name, sort_order, id', 'params': ()},
+    {'name': 'write_votes', 'hot': True,
+     'sql': '''INSERT INTO votes (user_id, position_id, is_satisfied) VALUES (?, ?, ?)
+               ON CONFLICT(user_id, position_id) DO UPDATE SET
+                   is_satisfied = excluded.is_satisfied, created_at = CURRENT_TIMESTAMP''',
+     'params': (2, 1, 1)},
+
+    # 触发器体
+    {'name': 'trg_tally_update', 'hot': True,
+     'sql': '''UPDATE position_tallies SET total_votes = total_votes + 1,
+               satisfied_votes = satisfied_votes + (? = 1) WHERE position_id = ?''',
+     'params': (1, 1)},
+    {'name': 'trg_tally_delete', 'hot': True,
+     'sql': 'DELETE FROM position_tallies WHERE position_id = ?', 'params': (1,)},
+    {'name': 'trg_class_stats_first_vote', 'hot': True,
+     'sql': 'SELECT COUNT(*) FROM (SELECT 1 FROM votes WHERE user_id = ? LIMIT 2)', 'params': (2,)},
+    {'name': 'trg_class_stats_last_vote', 'hot': True,
+     'sql': 'SELECT NOT EXISTS (SELECT 1 FROM votes WHERE user_id = ?)', 'params': (2,)},
+    {'name': 'trg_class_stats_voter', 'hot': True,
+     'sql': '''UPDATE class_stats SET voter_count = voter_count + 1
+               WHERE class_name = (SELECT class_name FROM users WHERE id = ? AND is_admin = 0)''',
+     'params': (2,)},
+    {'name': 'trg_class_stats_user_delete', 'hot': True,
+     'sql': '''UPDATE class_stats SET user_count = user_count - 1,
+               voter_count = voter_count - EXISTS (SELECT 1 FROM votes WHERE user_id = ?)
+               WHERE class_name = ?''', 'params': (2, '班级0')},
+    {'name': 'trg_class_stats_count', 'hot': True,
+     'sql': 'UPDATE class_stats SET position_count = position_count + 1 WHERE class_name = ?',
+     'params': ('班级0',)},
+    {'name': 'trg_vote_version', 'hot': True,
+     'sql': 'UPDATE users SET vote_version = vote_version + 1 WHERE id IN (?, ?)', 'params': (2, 2)},
+    {'name': 'trg_vote_event', 'hot': True,
+     'sql': 'INSERT INTO vote_events (user_id, position_id, is_satisfied) VALUES (?, ?, ?)', 'params': (2, 1, 1)},
+    {'name': 'trg_participation_insert', 'hot': True,
+     'sql': 'UPDATE users SET has_voted = 1 WHERE id = ? AND has_voted = 0', 'params': (2,)},
+    {'name': 'trg_participation_delete', 'hot': True,
+     'sql': 'UPDATE users SET has_voted = 0 WHERE id = ?', 'params': (2,)},
+    {'name': 'trg_positions_version', 'hot': True,
+     'sql': '''UPDATE class_versions SET positions_version = positions_version + 1
+               WHERE class_name IN (?, ?)''', 'params': ('班级0', '班级1')},
+    {'name': 'trg_data_generation', 'hot': True,
+     'sql': 'UPDATE data_generation SET generation = generation + 1 WHERE id = 1', 'params': ()},
+
+    # 条件请求
+    {'name': 'admin_page_version', 'hot': True,
+     'sql': 'SELECT generation FROM data_generation WHERE id = 1', 'params': ()},
+    {'name': 'vote_page_version', 'hot': True,
+     'sql': '''SELECT (SELECT vote_version FROM users WHERE id = ?) as vote_version,
+                      (SELECT positions_version FROM class_versions WHERE class_name = ?) as positions_version''',
+     'params': (2, '班级0')},
+
+    # 管理后台
+    {'name': 'admin_count', 'hot': True,
+     'sql': 'SELECT COUNT(*) as count FROM users WHERE is_admin = 1', 'params': ()},
+    {'name': 'class_stats_all', 'hot': True, 'allow_scan': {'class_stats'},
+     'sql': 'SELECT * FROM class_stats ORDER BY class_name', 'params': ()},
+    {'name': 'admin_users_page', 'hot': True, 'ordered': True,
+     'sql': '''SELECT * FROM users WHERE is_admin = 0 AND (class_name, name, id) > (?, ?, ?)
+               ORDER BY class_name, name, id LIMIT ?''', 'params': ('班级0', '用户0', 2, 21)},
+    {'name': 'admin_users_class_page', 'hot': True, 'ordered': True,
+     'sql': '''SELECT * FROM users WHERE is_admin = 0 AND class_name = ?
+               AND (class_name, name, id) > (?, ?, ?)
+               ORDER BY class_name, name, id LIMIT ?''', 'params': ('班级1', '班级1', '', 0, 21)},
+    {'name': 'admin_users_search', 'hot': True, 'ordered': True,
+     'sql': '''SELECT * FROM users WHERE is_admin = 0 AND class_name = ?
+               AND (name LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\')
+               ORDER BY class_name, name, id LIMIT ?''', 'params': ('班级1', '用户1%', '用户1%', 21)},
+    {'name': 'admin_add_user', 'hot': False,
+     'sql': 'INSERT INTO users (name, class_name, username, password_hash) VALUES (?, ?, ?, ?)',
+     'params': ('新用户', '班级0', 'new_user', 'x')},
+    {'name': 'admin_delete_user_votes', 'hot': True,
+     'sql': 'DELETE FROM votes WHERE user_id = ?', 'params': (2,)},
+    {'name': 'admin_delete_user', 'hot': True,
+     'sql': 'DELETE FROM users WHERE id = ? AND is_admin = 0 RETURNING username', 'params': (2,)},
+    {'name': 'import_existing_usernames', 'hot': True,
+     'sql': 'SELECT username FROM users WHERE username IN (?, ?, ?)', 'params': ('a', 'b', 'c')},
+    {'name': 'import_existing_directory', 'hot': True,
+     'sql': 'SELECT username FROM user_directory WHERE username IN (?, ?, ?)', 'params': ('a', 'b', 'c')},
+    {'name': 'admin_positions_page', 'hot': True, 'ordered': True,
+     'sql': '''SELECT * FROM positions WHERE (class_name, sort_order, id) > (?, ?, ?)
+               ORDER BY class_name, sort_order, id LIMIT ?''', 'params': ('班级0', 3, 3, 21)},
+    {'name': 'admin_positions_class_page', 'hot': True, 'ordered': True,
+     'sql': '''SELECT * FROM positions WHERE class_name = ?
+               ORDER BY class_name, sort_order, id LIMIT ?''', 'params': ('班级1', 21)},
+    {'name': 'position_max_order', 'hot': True,
+     'sql': 'SELECT MAX(sort_order) as max_order FROM positions WHERE class_name = ?',
+     'params': ('班级0',)},
+    {'name': 'admin_delete_position_votes', 'hot': True,
+     'sql': 'DELETE FROM votes WHERE position_id = ?', 'params': (1,)},
+    {'name': 'admin_delete_position', 'hot': True,
+     'sql': 'DELETE FROM positions WHERE id = ?', 'params': (1,)},
+
+    # 统计与导出：不按班级筛选时本来就要读取全部岗位
+    {'name': 'statistics_all', 'hot': True, 'allow_scan': {'p'},
+     'sql': '''SELECT p.*, COALESCE(t.total_votes, 0) as total_votes,
+               COALESCE(t.satisfied_votes, 0) as satisfied_votes
+               FROM positions p LEFT JOIN position_tallies t ON t.position_id = p.id
+               ORDER BY p.class_name, p.position_name''', 'params': ()},
+    {'name': 'statistics_class', 'hot': True,
+     'sql': '''SELECT p.*, COALESCE(t.total_votes, 0) as total_votes,
+               COALESCE(t.satisfied_votes, 0) as satisfied_votes
+               FROM positions p LEFT JOIN position_tallies t ON t.position_id = p.id
+               WHERE p.class_name = ? ORDER BY p.position_name''', 'params': ('班级0',)},
+    {'name': 'export_column_widths_class', 'hot': True,
+     'sql': '''SELECT MAX(LENGTH(p.class_name)), MAX(LENGTH(p.position_name)),
+               MAX(LENGTH(p.member_name)), MAX(COALESCE(t.satisfied_votes, 0)),
+               MAX(COALESCE(t.total_votes, 0))
+               FROM positions p LEFT JOIN position_tallies t ON t.position_id = p.id
+               WHERE p.class_name = ?''', 'params': ('班级0',)},
+
+    # 投票轮次与已结束轮次的冻结结果：按主键范围读取，与投票数无关
+    # 按 id 倒序扫描，进行中的轮次总是最后一行，读到第一行就结束
+    {'name': 'round_current', 'hot': True, 'allow_scan': {'rounds'},
+     'sql': 'SELECT * FROM rounds WHERE closed_at IS NULL ORDER BY id DESC LIMIT 1', 'params': ()},
+    {'name': 'round_list', 'hot': True, 'allow_scan': {'rounds'},
+     'sql': 'SELECT * FROM rounds ORDER BY id DESC', 'params': ()},
+    {'name': 'round_closed', 'hot': True,
+     'sql': 'SELECT * FROM rounds WHERE id = ? AND closed_at IS NOT NULL', 'params': (1,)},
+    {'name': 'round_statistics_all', 'hot': True, 'ordered': True,
+     'sql': '''SELECT position_id as id, class_name, position_name, member_name, sort_order, total_votes,
+               satisfied_votes FROM round_results WHERE round_id = ?
+               ORDER BY class_name, position_name''', 'params': (1,)},
+    {'name': 'round_statistics_class', 'hot': True, 'ordered': True,
+     'sql': '''SELECT position_id as id, class_name, position_name, member_name, sort_order, total_votes,
+               satisfied_votes FROM round_results WHERE round_id = ? AND class_name = ?
+               ORDER BY class_name, position_name''', 'params': (1, '班级0')},
+    {'name': 'round_column_widths', 'hot': True,
+     'sql': '''SELECT MAX(LENGTH(class_name)), MAX(LENGTH(position_name)), MAX(LENGTH(member_name)),
+               MAX(satisfied_votes), MAX(total_votes) FROM round_results WHERE round_id = ?''', 'params': (1,)},
+    {'name': 'round_class_stats', 'hot': True,
+     'sql': 'SELECT * FROM round_class_stats WHERE round_id = ?', 'params': (1,)},
+    {'name': 'round_closure', 'hot': True,
+     'sql': 'SELECT 1 FROM round_closures WHERE round_id = ?', 'params': (1,)},
+    {'name': 'closed_round_ids', 'hot': True,
+     'sql': 'SELECT round_id FROM round_closures WHERE round_id IN (?,?)', 'params': (1, 2)},
+    {'name': 'round_totals', 'hot': True,
+     'sql': '''SELECT (SELECT COUNT(*) FROM round_results WHERE round_id = :id),
+                      (SELECT COALESCE(SUM(total_votes), 0) FROM round_results WHERE round_id = :id),
+                      (SELECT COALESCE(SUM(voter_count), 0) FROM round_class_stats WHERE round_id = :id)''',
+     'params': {'id': 1}},
+    {'name': 'round_freeze_results', 'hot': False,
+     'sql': '''INSERT INTO round_results (round_id, class_name, position_name, position_id, member_name,
+                                          sort_order, total_votes, satisfied_votes)
+               SELECT ?, p.class_name, p.position_name, p.id, p.member_name, COALESCE(p.sort_order, 0),
+                      COALESCE(t.total_votes, 0), COALESCE(t.satisfied_votes, 0)
+               FROM positions p LEFT JOIN position_tallies t ON t.position_id = p.id''', 'params': (1,)},
+    {'name': 'round_prune_votes', 'hot': False,
+     'sql': 'DELETE FROM votes', 'params': ()},
+    {'name': 'round_last_event', 'hot': True,
+     'sql': 'SELECT COALESCE(MAX(id), 0) FROM vote_events', 'params': ()},
+
+    # 未投票名单：只读取部分索引 idx_users_non_voters
+    {'name': 'non_voters_page', 'hot': True, 'ordered': True,
+     'sql': '''SELECT id, class_name, name, username FROM users
+               WHERE is_admin = 0 AND has_voted = 0 AND (class_name, name, id) > (?, ?, ?)
+               ORDER BY class_name, name, id LIMIT ?''', 'params': ('班级0', '', 0, 51)},
+    {'name': 'non_voters_class', 'hot': True, 'ordered': True,
+     'sql': '''SELECT id, class_name, name, username FROM users
+               WHERE is_admin = 0 AND has_voted = 0 AND class_name = ?
+               ORDER BY class_name, name, id''', 'params': ('班级0',)},
+    {'name': 'non_voters_export_widths', 'hot': True,
+     'sql': '''SELECT MAX(LENGTH(class_name)), MAX(LENGTH(name)), MAX(LENGTH(username))
+               FROM users WHERE is_admin = 0 AND has_voted = 0''', 'params': ()},
+
+    # 分库登记与账号目录
+    {'name': 'shard_lookup', 'hot': True,
+     'sql': 'SELECT id FROM shards WHERE key = ?', 'params': ('2021',)},
+    {'name': 'shard_list', 'hot': True, 'allow_scan': {'shards'},
+     'sql': 'SELECT id FROM shards', 'params': ()},
+    {'name': 'claim_username', 'hot': True,
+     'sql': '''INSERT OR IGNORE INTO user_directory (username, shard_id)
+               SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM users WHERE username = ?)''',
+     'params': ('new_user', 1, 'new_user')},
+    {'name': 'release_username', 'hot': True,
+     'sql': 'DELETE FROM user_directory WHERE username = ?', 'params': ('new_user',)},
+
+    # 后台任务
+    {'name': 'job_get', 'hot': True,
+     'sql': 'SELECT * FROM jobs WHERE id = ?', 'params': ('x',)},
+    {'name': 'job_update', 'hot': True,
+     'sql': 'UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?', 'params': ('running', 0, 'x')},
+    {'name': 'job_cleanup_select', 'hot': True,
+     'sql': 'SELECT id, result_path FROM jobs WHERE finished_at < ?', 'params': (0,)},
+    {'name': 'job_cleanup_delete', 'hot': True,
+     'sql': 'DELETE FROM jobs WHERE finished_at < ?', 'params': (0,)},
+
+    # 启动与维护命令：只在启动或手动修复时运行，允许全表扫描
+    {'name': 'init_fail_jobs', 'hot': False,
+     'sql': "UPDATE jobs SET status = 'failed' WHERE status IN ('pending', 'running')", 'params': ()},
+    {'name': 'rebuild_tallies', 'hot': False,
+     'sql': '''SELECT p.id, COUNT(v.id), COALESCE(SUM(v.is_satisfied = 1), 0)
+               FROM positions p LEFT JOIN votes v ON p.id = v.position_id GROUP BY p.id''',
+     'params': ()},
+    {'name': 'vote_log_start', 'hot': True, 'allow_scan': {'round_closures'},
+     'sql': 'SELECT COALESCE(MAX(last_event_id), 0) FROM round_closures', 'params': ()},
+    {'name': 'vote_log_count', 'hot': True,
+     'sql': 'SELECT COUNT(*) FROM vote_events WHERE id > ?', 'params': (0,)},
+    {'name': 'replay_vote_log', 'hot': False,
+     'sql': '''SELECT user_id, position_id, is_satisfied, created_at FROM (
+                   SELECT user_id, position_id, is_satisfied, created_at, MAX(id)
+                   FROM vote_events WHERE id > :start
+                   GROUP BY user_id, position_id
+               )
+               WHERE is_satisfied IS NOT NULL
+                 AND user_id IN (SELECT id FROM users)
+                 AND position_id IN (SELECT id FROM positions)''', 'params': {'start': 0}},
+    {'name': 'rebuild_participation', 'hot': False,
+     'sql': '''UPDATE users SET has_voted = EXISTS (SELECT 1 FROM votes WHERE user_id = users.id)
+               WHERE is_admin = 0 AND has_voted != EXISTS (SELECT 1 FROM votes WHERE user_id = users.id)''',
+     'params': ()},
+    {'name': 'rebuild_class_stats_voters', 'hot': False,
+     'sql': '''SELECT u.class_name, COUNT(*) FROM users u
+               WHERE u.is_admin = 0 AND EXISTS (SELECT 1 FROM votes v WHERE v.user_id = u.id)
+               GROUP BY u.class_name''', 'params': ()},
+]
+
+# EXPLAIN QUERY PLAN 中不借助索引的全表扫描，如 "SCAN users" 或 "SCAN p"；
+# 子查询结果的扫描 "SCAN (subquery-1)" 不算
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+TEMP_SORT = re.compile(r'^USE TEMP B-TREE FOR .*ORDER BY')
+
+
+def seed(conn, classes=20, users_per_class=50, positions_per_class=8):
+    """写入接近真实规模的数据，避免小表让查询计划失真"""
+    c = conn.cursor()
+    c.executemany('INSERT INTO users (name, class_name, username, password_hash) VALUES (?, ?, ?, ?)',
+                  [(f'用户{u}', f'班级{k}', f'u{k}_{u}', 'x')
+                   for k in range(classes) for u in range(users_per_class)])
+    c.executemany('INSERT INTO positions (class_name, position_name, member_name, sort_order) VALUES (?, ?, ?, ?)',
+                  [(f'班级{k}', f'岗位{p}', f'成员{p}', p + 1)
+                   for k in range(classes) for p in range(positions_per_class)])
+    c.execute('''INSERT INTO votes (user_id, position_id, is_satisfied)
+                 SELECT u.id, p.id, (u.id + p.id) % 2 FROM users u
+                 JOIN positions p ON p.class_name = u.class_name
+                 WHERE u.is_admin = 0 AND u.id % 2 = 0''')
+    conn.commit()
+
+
+def explain(conn, query):
+    """返回查询计划各步骤的描述"""
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + query['sql'], query['params']).fetchall()
+    return [row[3] for row in rows]
+
+
+def check(conn, verbose=False):
+    """检查全部查询，返回未通过的查询列表"""
+    names = [q['name'] for q in QUERIES]
+    assert len(names) == len(set(names)), '查询名称重复'
+
+    failures = []
+    for query in QUERIES:
+        plan = explain(conn, query)
+        scans = [m.group(1) for m in map(FULL_SCAN.match, plan) if m]
+        bad = [f'SCAN {t}' for t in scans if t not in query.get('allow_scan', set())]
+        if query.get('ordered'):
+            bad += [step for step in plan if TEMP_SORT.match(step)]
+        failed = query['hot'] and bad
+        if failed:
+            failures.append((query['name'], bad))
+        if failed or verbose:
+            mark = 'FAIL' if failed else ('ok  ' if query['hot'] else 'cold')
+            print(f"[{mark}] {query['name']}")
+            for step in plan:
+                print(f'         {step}')
+    return failures
+
+
+def main():
+    verbose = '-v' in sys.argv[1:]
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'plans.db')
+        init_db()
+        get_pool().close_all()
+
+        conn = sqlite3.connect(app.config['DATABASE'])
+        try:
+            seed(conn)
+            failures = check(conn, verbose)
+        finally:
+            conn.close()
+
+    if failures:
+        print(f'\n{len(failures)} 条热点查询未通过：')
+        for name, problems in failures:
+            print(f"  {name}: {'; '.join(problems)}")
+        return 1
+    print(f'全部 {len(QUERIES)} 条查询检查通过')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""生产环境启动脚本（预派生多进程 + 线程池）
+
+主进程执行数据库迁移、清理中断的任务并预热缓存，然后监听端口，fork 出若干工作进程共享
+同一个监听套接字。每个工作进程用固定大小的线程池处理请求。工作进程异常退出时由主进程
+重新拉起；收到 SIGTERM/SIGINT 时通知工作进程停止接受新连接，等待处理中的请求完成。
+
+进程内的缓存（查询缓存、班级统计、岗位目录）以 SQLite PRAGMA data_version 为版本，
+任一工作进程写入后，其他进程下次读取时都会发现并重新加载。
+
+用法：
+    python serve.py --workers 4 --threads 16 --port 32244
+
+参数也可以用环境变量设置（SERVER_WORKERS、SERVER_THREADS 等，见 --help），
+应用本身的配置与直接运行 app.py 时相同。
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger('serve')
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """用固定大小线程池处理连接的 WSGI 服务器
+
+    werkzeug 自带的多线程服务器为每个连接新建线程，并发连接多时线程数不受控制。
+    线程全部占满时不再 accept()，连接留在监听队列中，由有空闲线程的进程接走，
+    而不是在本进程的线程池里无限排队。
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd, keepalive):
+        handler = type('RequestHandler', (WSGIRequestHandler,), {
+            'protocol_version': 'HTTP/1.1',
+            # 空闲的长连接最多占用一个线程这么久
+            'timeout': keepalive,
+        })
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        # 多个进程等待同一个套接字，连接被别的进程接走时 accept() 不能阻塞
+        self.socket.setblocking(False)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='http')
+        self._idle = threading.BoundedSemaphore(threads)
+        self._dispatched = False
+
+    def _handle_request_noblock(self):
+        # 等待空闲线程最多 poll 间隔那么久，然后回到 serve_forever() 的循环，以便及时响应 shutdown()
+        if not self._idle.acquire(timeout=0.5):
+            return
+        self._dispatched = False
+        try:
+            super()._handle_request_noblock()
+        finally:
+            # 连接已被其他进程接走（accept() 失败）或未能交给线程池时，归还名额
+            if not self._dispatched:
+                self._idle.release()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+        self._dispatched = True
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._idle.release()
+
+
+def tune_config(workers, threads):
+    """按进程数和线程数调整未通过环境变量指定的配置"""
+    from app import app
+
+    # 实时统计的每个连接一直占用一个线程，最多占四分之一，其余线程留给普通请求
+    max_streams = max(1, threads // 4)
+    if 'STATS_STREAM_MAX_SUBSCRIBERS' not in os.environ:
+        app.config['STATS_STREAM_MAX_SUBSCRIBERS'] = max_streams
+    elif app.config['STATS_STREAM_MAX_SUBSCRIBERS'] > threads // 2:
+        logger.warning('STATS_STREAM_MAX_SUBSCRIBERS=%d 会占满每个进程的 %d 个线程，已降为 %d',
+                       app.config['STATS_STREAM_MAX_SUBSCRIBERS'], threads, max_streams)
+        app.config['STATS_STREAM_MAX_SUBSCRIBERS'] = max_streams
+
+    # 每个线程都能拿到连接，不必在连接池上排队
+    if 'DB_POOL_SIZE' not in os.environ:
+        app.config['DB_POOL_SIZE'] = threads
+    # 登录哈希是 CPU 密集的，所有进程合计不超过核数
+    if 'LOGIN_VERIFY_CONCURRENCY' not in os.environ:
+        app.config['LOGIN_VERIFY_CONCURRENCY'] = max(1, (os.cpu_count() or 1) // workers)
+
+
+def run_worker(app, sock, args):
+    """工作进程：在继承来的套接字上处理请求，收到 SIGTERM 后停止"""
+    server = PooledWSGIServer(args.host, args.port, app, args.threads, sock.fileno(), args.keepalive)
+
+    def stop(signum, frame):
+        # shutdown() 会等待 serve_forever() 退出，不能在运行它的主线程里直接调用
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    server.serve_forever()
+    # 等待处理中的请求完成；实时统计等长连接由主进程在超时后强制结束
+    server.executor.shutdown(wait=True)
+
+
+class Arbiter:
+    """主进程：派生工作进程，异常退出时重新拉起，停止时逐个结束"""
+
+    def __init__(self, app, sock, args):
+        self.app = app
+        self.sock = sock
+        self.args = args
+        self.workers = {}  # pid → 工作进程编号
+        self.stopping = False
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = number
+            return
+        # 子进程：正常退出以执行 atexit（写完投票队列等），不回到主进程的循环
+        code = 0
+        try:
+            run_worker(self.app, self.sock, self.args)
+        except Exception:
+            logger.exception('工作进程 %d 异常退出', os.getpid())
+            code = 1
+        sys.exit(code)
+
+    def run(self):
+        for number in range(self.args.workers):
+            self.spawn(number)
+        logger.info('已启动 %d 个工作进程，每个 %d 个线程，监听 %s:%d',
+                    self.args.workers, self.args.threads, self.args.host, self.args.port)
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+
+        last_failure = 0.0
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            number = self.workers.pop(pid, None)
+            if number is None or self.stopping:
+                continue
+            logger.warning('工作进程 %d 已退出（状态 %d），重新启动', pid, status)
+            # 连续崩溃时放慢重启速度
+            if time.monotonic() - last_failure < 1:
+                time.sleep(1)
+            last_failure = time.monotonic()
+            self.spawn(number)
+
+    def handle_stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info('正在停止工作进程')
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGTERM)
+        threading.Thread(target=self.force_stop, daemon=True).start()
+
+    def force_stop(self):
+        deadline = time.monotonic() + self.args.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            logger.warning('工作进程 %d 未在 %.0f 秒内退出，强制结束', pid, self.args.graceful_timeout)
+            self.kill(pid, signal.SIGKILL)
+
+    @staticmethod
+    def kill(pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def main():
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='以多进程方式运行投票系统')
+    parser.add_argument('--host', default=env('SERVER_HOST', '0.0.0.0'), help='监听地址')
+    parser.add_argument('--port', type=int, default=int(env('SERVER_PORT', 32244)), help='监听端口')
+    parser.add_argument('--workers', type=int, default=int(env('SERVER_WORKERS', os.cpu_count() or 1)),
+                        help='工作进程数，默认等于 CPU 核数')
+    parser.add_argument('--threads', type=int, default=int(env('SERVER_THREADS', 16)),
+                        help='每个工作进程的线程数，实时统计的每个连接占用一个线程')
+    parser.add_argument('--backlog', type=int, default=int(env('SERVER_BACKLOG', 1024)),
+                        help='监听队列长度')
+    parser.add_argument('--keepalive', type=float, default=float(env('SERVER_KEEPALIVE', 5)),
+                        help='长连接空闲超时（秒）')
+    parser.add_argument('--graceful-timeout', type=float, default=float(env('SERVER_GRACEFUL_TIMEOUT', 30)),
+                        help='停止时等待处理中请求的时间（秒）')
+    parser.add_argument('--access-log', action='store_true', help='输出每个请求的访问日志')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+    if not args.access_log:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    tune_config(args.workers, args.threads)
+    from app import create_app
+    app = create_app()
+
+    sock = socket.socket(socket.AF_INET6 if ':' in args.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(args.backlog)
+
+    Arbiter(app, sock, args).run()
+    logger.info('已停止')
+
+
+if __name__ == '__main__':
+    main()
@@ -128,6 +128,91 @@ function setLoading(element, isLoading) {
     }
 }
 
+// 后台任务：提交后轮询进度，完成或失败时结束
+function runJob(url, formData, onProgress) {
+    return fetch(url, {
+        method: 'POST',
+        body: formData
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success) {
+            throw new Error(data.message);
+        }
+        return pollJob(data.status_url, onProgress);
+    });
+}
+
+function pollJob(statusUrl, onProgress) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(statusUrl)
+            .then(response => response.json())
+            .then(job => {
+                if (onProgress) {
+                    onProgress(job);
+                }
+                if (job.status === 'done') {
+                    resolve(job);
+                } else if (job.status === 'failed') {
+                    reject(new Error(job.message || '任务失败'));
+                } else {
+                    setTimeout(poll, 1000);
+                }
+            })
+            .catch(reject);
+        };
+        poll();
+    });
+}
+
+// 任务进度文字
+function formatJobProgress(job) {
+    if (job.status === 'pending') {
+        return '等待处理...';
+    }
+    let text = `已处理 ${job.processed}` + (job.total ? ` / ${job.total}` : '') + ' 条';
+    if (job.failed) {
+        text += `，失败 ${job.failed} 条`;
+    }
+    if (job.eta_seconds !== null && job.eta_seconds !== undefined) {
+        text += `，预计剩余 ${Math.ceil(job.eta_seconds)} 秒`;
+    }
+    return text;
+}
+
+// 导入表单改为后台任务提交，在模态框中显示进度
+function bindJobForm(form) {
+    form.addEventListener('submit', function(e) {
+        if (e.defaultPrevented) {
+            return;
+        }
+        e.preventDefault();
+        
+        const submitButton = form.querySelector('[type="submit"]');
+        const progress = form.querySelector('.job-progress');
+        setLoading(submitButton, true);
+        progress.style.display = 'block';
+        
+        runJob(form.dataset.jobUrl, new FormData(form), job => {
+            progress.textContent = formatJobProgress(job);
+        })
+        .then(job => {
+            showMessage(job.message, 'success');
+            setTimeout(() => window.location.reload(), 1500);
+        })
+        .catch(error => {
+            setLoading(submitButton, false);
+            progress.style.display = 'none';
+            showMessage(error.message || '导入失败，请重试', 'error');
+        });
+    });
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('form[data-job-url]').forEach(bindJobForm);
+});
+
 // 文件上传验证
 document.addEventListener('change', function(e) {
     if (e.target.type === 'file') {
@@ -0,0 +1,94 @@
+"""全局数据版本与查询缓存测试：python -m pytest -q tests"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as voting
+
+
+class DataVersionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        voting.close_pool()
+        voting.create_app({'DATABASE': os.path.join(self.tmp.name, 'test.db'), 'TESTING': True,
+                           'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000'})
+
+    def tearDown(self):
+        voting.close_pool()
+        self.tmp.cleanup()
+
+    def external_write(self):
+        """模拟其他进程提交的修改"""
+        with closing(sqlite3.connect(voting.app.config['DATABASE'])) as conn:
+            conn.execute("INSERT INTO positions (class_name, position_name, member_name) VALUES ('班', '岗位', '人')")
+            conn.commit()
+
+    def test_version_stable_without_writes(self):
+        with voting.app.app_context():
+            first = voting.data_version.current()
+            self.assertEqual(voting.data_version.current(), first)
+
+    def test_external_write_seen_by_every_thread(self):
+        """每个线程在其他连接提交之后读到的版本都与提交之前不同"""
+        with voting.app.app_context():
+            before = voting.data_version.current()
+        start = threading.Barrier(8)
+        results = []
+
+        def worker():
+            with voting.app.app_context():
+                start.wait()
+                for _ in range(50):
+                    voting.data_version.current()
+                start.wait()
+                if threading.current_thread().name == 'writer':
+                    self.external_write()
+                start.wait()
+                results.append(voting.data_version.current())
+
+        threads = [threading.Thread(target=worker, name='writer' if i == 0 else f'reader-{i}') for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(version != before for version in results), (before, results))
+
+    def test_query_cache_reloads_after_external_write(self):
+        with voting.app.app_context():
+            count = lambda: voting.get_db().execute('SELECT COUNT(*) FROM positions').fetchone()[0]
+            self.assertEqual(voting.query_cache.get_or_load('test_positions', count), 0)
+            self.external_write()
+            self.assertEqual(voting.query_cache.get_or_load('test_positions', count), 1)
+
+
+class PositionCatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        voting.close_pool()
+        voting.create_app({'DATABASE': os.path.join(self.tmp.name, 'test.db'), 'TESTING': True,
+                           'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000'})
+
+    def tearDown(self):
+        voting.close_pool()
+        self.tmp.cleanup()
+
+    def test_background_reads_release_connections(self):
+        """没有应用上下文时（预热、后台线程）读取岗位目录，连接用完归还连接池"""
+        with closing(sqlite3.connect(voting.app.config['DATABASE'])) as conn:
+            conn.execute("INSERT INTO positions (class_name, position_name, member_name) VALUES ('班', '班长', '人')")
+            conn.commit()
+        for _ in range(voting.get_pool().size + 1):
+            voting.position_catalog.invalidate()
+            self.assertEqual([p['position_name'] for p in voting.position_catalog.positions('班')], ['班长'])
+        self.assertEqual(voting.get_pool().stats()['in_use'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
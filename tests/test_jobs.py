@@ -0,0 +1,84 @@
+"""后台任务测试：python -m pytest -q tests"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+from io import BytesIO
+
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as voting
+
+
+class JobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        voting.close_pool()
+        voting.create_app({'DATABASE': os.path.join(self.tmp.name, 'test.db'), 'TESTING': True,
+                           'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000'})
+        self.client = voting.app.test_client()
+        response = self.client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        self.assertEqual(response.status_code, 302)
+
+    def tearDown(self):
+        with voting.app.app_context():
+            conn = voting.get_db()
+            for row in conn.execute('SELECT result_path FROM jobs WHERE result_path IS NOT NULL'):
+                if os.path.exists(row['result_path']):
+                    os.remove(row['result_path'])
+            conn.close()
+        voting.close_pool()
+        self.tmp.cleanup()
+
+    def wait_for(self, job_id, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = self.client.get(f'/admin/jobs/{job_id}').get_json()
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(0.05)
+        self.fail('后台任务超时')
+
+    def test_download_from_other_working_directory(self):
+        """工作目录不是应用目录时，导出结果仍能下载"""
+        self.client.post('/admin/positions/add',
+                         data={'class_name': '测试班', 'position_name': '班长', 'member_name': '张三'})
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        try:
+            response = self.client.post('/admin/jobs/statistics/export', data={'format': 'csv'})
+            self.assertEqual(response.status_code, 202)
+            job = self.wait_for(response.get_json()['job_id'])
+            self.assertEqual(job['status'], 'done', job['message'])
+            response = self.client.get(job['download_url'])
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('班长', response.get_data(as_text=True))
+            response.close()
+        finally:
+            os.chdir(cwd)
+
+    def test_import_progress_when_all_rows_rejected(self):
+        """全部行都被剔除时，任务记录的进度与结果一致"""
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(['姓名', '班级', '账号', '密码'])
+        sheet.append(['管理员', '测试班', 'admin', 'pw'])
+        sheet.append(['管理员', '测试班', 'admin', 'pw'])
+        upload = BytesIO()
+        workbook.save(upload)
+        upload.seek(0)
+        response = self.client.post('/admin/jobs/users/import',
+                                    data={'file': (upload, 'users.xlsx')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for(response.get_json()['job_id'])
+        self.assertEqual(job['status'], 'done', job['message'])
+        self.assertEqual(job['message'], '导入完成：成功 0 条，失败 2 条')
+        self.assertEqual((job['total'], job['processed'], job['succeeded'], job['failed']), (2, 2, 0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""条件请求（ETag）测试：python -m pytest -q tests"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as voting
+
+
+class AdminPageVersionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        voting.close_pool()
+        voting.create_app({'DATABASE': os.path.join(self.tmp.name, 'test.db'), 'TESTING': True,
+                           'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000', 'REPORT_SNAPSHOT_MAX_AGE': 0})
+        self.client = voting.app.test_client()
+        response = self.client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        self.assertEqual(response.status_code, 302)
+        self.client.get('/admin')  # 显示并清除登录提示
+
+    def tearDown(self):
+        voting.app.config['REPORT_SNAPSHOT_MAX_AGE'] = 0
+        voting.close_pool()
+        self.tmp.cleanup()
+
+    def revalidate(self, path, etag):
+        return self.client.get(path, headers={'If-None-Match': f'"{etag}"'}).status_code
+
+    def test_etag_survives_new_connections(self):
+        """重新建立连接（如另一个工作进程）后 ETag 仍然有效，数据变化后失效"""
+        etag = self.client.get('/admin/positions').get_etag()[0]
+        voting.close_pool()
+        voting.data_version.close()
+        self.assertEqual(self.revalidate('/admin/positions', etag), 304)
+
+        self.client.post('/admin/positions/add',
+                         data={'class_name': '测试班', 'position_name': '班长', 'member_name': '张三'})
+        self.client.get('/admin/positions')  # 显示并清除提示消息
+        self.assertEqual(self.revalidate('/admin/positions', etag), 200)
+
+    def test_statistics_etag_follows_snapshot(self):
+        """报表快照刷新后，统计页面的 ETag 随之变化"""
+        voting.app.config['REPORT_SNAPSHOT_MAX_AGE'] = 0.2
+        etag = self.client.get('/admin/statistics').get_etag()[0]
+        self.assertEqual(self.revalidate('/admin/statistics', etag), 304)
+        time.sleep(0.3)
+        self.assertEqual(self.revalidate('/admin/statistics', etag), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()